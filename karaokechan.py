@@ -3,9 +3,15 @@
 
 from __future__ import division
 
+import time
+# Taken before the other imports, so that startup time includes them
+START_TIME = time.time()
+
 import os.path
 import user
 import re
+import socket
+import sqlite3
 import argparse
 
 import Tkinter as tk
@@ -18,6 +24,31 @@ import kchan.widgets as kcw
 import kchan.timedtext as timedtext
 import kchan.formats.lyrics3v2 as lyrics3v2
 import kchan.player as player
+import kchan.probe as probe
+import kchan.mp3index as mp3index
+import kchan.playlist as playlist
+import kchan.scheduler as scheduler
+import kchan.writer as writer
+import kchan.library as library
+import kchan.lyricscache as lyricscache
+import kchan.onsets as onsets
+import kchan.waveform as waveform
+import kchan.broadcast as broadcast
+import kchan.perf as perf
+
+
+# Milliseconds of editor inactivity before a draft is autosaved
+AUTOSAVE_DELAY = 5000
+# Milliseconds between checks for finished background saves
+WRITER_POLL_INTERVAL = 100
+# Milliseconds between checks on the next song's prefetch
+PLAYLIST_POLL_INTERVAL = 200
+# Milliseconds to wait after an edit before updating the lyrics preview
+PREVIEW_DELAY = 150
+# Milliseconds between checks on background analyses of the song
+ANALYZER_POLL_INTERVAL = 200
+# Milliseconds the time slider has to rest before seeking to it
+SEEK_DELAY = 150
 
 
 def brk(fn):
@@ -44,14 +75,59 @@ def save_dialog():
     raise CancelException
 
 
+def openCache(cacheClass):
+    """Open one of the persistent caches, or return None if it can't be
+
+    The caches only save time, so a locked or damaged database, or a
+    ~/.karaokechan that can't be written to, mustn't stop the player.
+    """
+    try:
+        return cacheClass()
+    except (sqlite3.Error, OSError) as e:
+        print 'not using {}: {}'.format(cacheClass.__name__, e)
+        return None
+
+
 class KaraokePlayer(tk.Frame):
-    def __init__(self, parent=None, filepath=None):
+    def __init__(self, parent=None, filepath=None, timing=False,
+                 perfOverlay=False, broadcastPort=None):
         tk.Frame.__init__(self, parent)
         self.parent = parent
         self.parent.title('Karaoke-chan')
 
         # media widget
-        self.player = player.Player(self.OnPlayer)
+        self.player = player.Player(self.OnPlayer,
+                                    openCache(probe.ProbeCache),
+                                    openCache(mp3index.SeekIndexCache))
+        # position the time slider was moved to, while it's being dragged
+        self.pendingSeek = None
+        self.seekTimer = None
+
+        # parsed lyrics of songs opened before
+        self.lyricsCache = openCache(lyricscache.LyricsCache)
+
+        # background writer for saves and autosaves
+        self.writer = writer.Writer(library.DEFAULT_DB_PATH, self.lyricsCache)
+        self.writerTimer = None
+        self.autosaveTimer = None
+
+        # upcoming songs
+        self.playlist = playlist.Playlist(self.player.Probe,
+                                          self.lyricsCache)
+        self.playlistTimer = None
+
+        # onset detection for the song being edited
+        self.analyzer = onsets.Analyzer()
+        self.analyzerTimer = None
+        # whether onsets are waiting for the waveform to be worked out
+        self.analyzePending = False
+        # waveform overview of the current song
+        self.waveformCache = openCache(waveform.WaveformCache)
+        self.waveformAnalyzer = onsets.Analyzer(
+            lambda filepath, cancelled:
+                waveform.loadPyramid(filepath, cancelled,
+                                     self.waveformCache))
+        self.waveformTimer = None
 
         lyricsFrame = tk.Frame(self)
         lyricsFrame.pack(fill=tk.BOTH, expand=1)
@@ -63,13 +139,19 @@ class KaraokePlayer(tk.Frame):
         self.lyricsViewer = kcw.LyricsCtrl(lyricsFrame, self.player, font)
         self.lyricsViewer.pack(fill=tk.BOTH, expand=1, side=tk.LEFT)
         # lyrics editor
-        self.lyricsEditor = kcw.LyricsEditor(lyricsFrame, self.player)
+        self.lyricsEditor = kcw.LyricsEditor(lyricsFrame, self.player,
+                                             self.OnEditorChange)
+        self.previewTimer = None
+        # performance measurements, drawn over the lyrics
+        self.perfOverlay = kcw.PerfOverlay(lyricsFrame)
 
         # Move the 'Text' class bindings to the end so we can override
         # keyboard shortcuts
         editor_tags = self.lyricsEditor.bindtags()
         self.lyricsEditor.bindtags(
             tuple(t for t in editor_tags if t != 'Text') + ('Text',))
+        self.lyricsEditor.bind('<KeyRelease>',
+                               lambda evt: self.ScheduleAutosave(), add='+')
 
         # menu bar
         self.menuBar = tk.Menu(parent)
@@ -82,6 +164,10 @@ class KaraokePlayer(tk.Frame):
         self.fileMenu.add_command(command=self.OnOpen, label='Open',
                                   accelerator='Ctrl+O')
         self.bind_all('<Control-o>', handler(self.OnOpen))
+        self.fileMenu.add_command(command=self.OnLibrary, label='Library',
+                                  accelerator='Ctrl+L')
+        self.bind_all('<Control-l>', handler(self.OnLibrary))
+        self.fileMenu.add_command(command=self.OnQueue, label='Add to Queue')
         self.fileMenu.add_command(command=self.OnEdit, label='Edit Lyrics',
                                   accelerator='Ctrl+E')
         self.editIndex = self.fileMenu.index(tk.END)
@@ -114,6 +200,15 @@ class KaraokePlayer(tk.Frame):
                                label='Set Timestamp',
                                accelerator='Ctrl+T')
         self.bind_all('<Control-t>', handler(self.lyricsEditor.SetTimestamp))
+        self.timingMenu.add_command(
+            command=self.lyricsEditor.SuggestTimestamp,
+            label='Suggest Timestamp', accelerator='Ctrl+G')
+        self.bind_all('<Control-g>',
+                      handler(self.lyricsEditor.SuggestTimestamp))
+        self.snapVar = tk.IntVar(value=1)
+        self.timingMenu.add_checkbutton(command=self.OnSnap,
+                                        label='Snap Timestamps to Onsets',
+                                        variable=self.snapVar)
 
         # playback menu
         playbackMenu = tk.Menu(self.menuBar, tearoff=False)
@@ -124,6 +219,9 @@ class KaraokePlayer(tk.Frame):
         playbackMenu.add_command(command=self.OnStop, label='Stop',
                                  accelerator='Ctrl+Shift+P')
         self.bind_all('<Control-P>', handler(self.OnStop))
+        playbackMenu.add_command(command=self.OnNext, label='Next Song',
+                                 accelerator='Ctrl+N')
+        self.bind_all('<Control-n>', handler(self.OnNext))
         playbackMenu.add_command(command=lambda: self.OnFontSize(True),
                                  label='Increase Font Size',
                                  accelerator='Ctrl+Plus')
@@ -134,6 +232,12 @@ class KaraokePlayer(tk.Frame):
                                  accelerator='Ctrl+Minus')
         self.bind_all('<Control-minus>',
                       handler(lambda: self.OnFontSize(False)))
+        playbackMenu.add_command(command=self.perfOverlay.Toggle,
+                                 label='Performance Overlay',
+                                 accelerator='F12')
+        self.bind_all('<F12>', handler(self.perfOverlay.Toggle))
+        playbackMenu.add_command(command=self.OnSavePerf,
+                                 label='Save Performance Data')
 
         # controls
         controlFrame = tk.Frame(self)
@@ -166,78 +270,207 @@ class KaraokePlayer(tk.Frame):
                                    tickinterval=10, resolution=1/1000,
                                    variable=self.timeSliderVar)
         self.timeSlider.pack(fill=tk.X, expand=1)
+        self.timeSlider.bind('<ButtonRelease-1>',
+                             lambda evt: self.CommitSeek(), add='+')
+        # only packed once there's a waveform to show
+        self.waveform = kcw.WaveformCtrl(timeFrame)
         self.timeLabel = tk.Label(timeFrame, text='0:00/0:00')
         self.timeLabel.pack(side=tk.RIGHT)
+        self.statusLabel = tk.Label(timeFrame, text='')
+        self.statusLabel.pack(side=tk.LEFT)
         timeFrame.pack(side=tk.BOTTOM, fill=tk.X, expand=0)
 
         # flag to indicate which mode we're in
         self.editMode = False
 
-        self.timer = None
+        # whether to print how long each file takes to load
+        self.timing = timing
+
+        self.libraryBrowser = None
+
+        # single timer driving the time display and lyrics highlighting
+        self.scheduler = scheduler.Scheduler(self, self.player,
+                                             self.CheckPlaylist)
+        self.scheduler.Add(self.UpdateTime)
+        self.scheduler.Add(self.lyricsViewer.Update)
+
+        # lyrics for other screens on the network
+        self.broadcaster = None
+        # title sent along with the lyrics
+        self.broadcastTitle = None
+        if broadcastPort is not None:
+            try:
+                self.broadcaster = broadcast.Broadcaster(port=broadcastPort)
+            except socket.error as e:
+                tkMessageBox.showerror(
+                    'Broadcast failed',
+                    'Could not listen on port {}:\n{}'.format(broadcastPort,
+                                                              e))
+            else:
+                self.broadcaster.Start()
+                self.scheduler.Add(self.broadcaster.Update)
 
         self.pack(fill=tk.BOTH, expand=1)
 
-        # currently loaded file
-        if filepath is None:
-            self.filepath = None
-        else:
+        if perfOverlay:
+            self.perfOverlay.Show()
+
+        # currently loaded file; a file given on the command line is
+        # only opened once the window is up
+        self.filepath = None
+        self.after_idle(self.OnStarted, filepath)
+
+    def OnStarted(self, filepath):
+        # draw the window before measuring how long it took to appear
+        self.update_idletasks()
+        elapsed = (time.time() - START_TIME) * 1000
+        perf.record('startup', elapsed)
+        if self.timing:
+            print 'first window: {:.1f} ms'.format(elapsed)
+        if filepath is not None:
             self.OpenFile(filepath)
 
+    def CheckPlaylist(self):
+        if self.player.CheckQueue():
+            # The next song has just started playing seamlessly
+            self.ShowSong(self.playlist.Pop())
+            self.PrefetchNext()
+        elif (self.player.Ended() and self.playlist.Peek() is not None
+              and not self.editMode):
+            # The next song couldn't be queued, so load it now. While
+            # editing, playback just stops at the end of the song, since
+            # moving on would replace the editor's text without asking;
+            # Next Song still works, after checking for unsaved changes.
+            self.PlayNext()
+            return True
+        return False
+
+    @perf.timed('KaraokePlayer.UpdateTime')
+    def UpdateTime(self, time=None, updateSliderTime=True):
+        """Update the time display
 
-    def UpdateTime(self, updateSliderTime=True):
+        Returns the time in ms at which the display will next change.
+        """
         length = self.player.Length()
-        time = self.player.Tell()
+        if time is None:
+            time = self.player.Tell()
+        if self.pendingSeek is not None:
+            # the slider is being dragged, and shows where it's going
+            time = self.pendingSeek
+            updateSliderTime = False
         if updateSliderTime:
             self.timeSlider.config(to=length / 1000)
             self.timeSlider.set(time / 1000)
         self.timeLabel.config(text="{}:{:02}/{}:{:02}".format(
                 int(time / 60000), int(time / 1000) % 60,
                 int(length / 60000), int(length / 1000) % 60))
-        if self.player.playing():
-            if self.timer is not None:
-                self.after_cancel(self.timer)
-            self.timer = self.after(100, self.UpdateTime)
+
+        nextUpdate = (int(time / 1000) + 1) * 1000
+        if self.player.queued is not None:
+            # wake up right at the end of the song to switch over
+            nextUpdate = min(nextUpdate, length)
+        return nextUpdate
 
     def PromptSave(self):
         try:
-            if save_dialog():
-                self.OnSave()
-            return True
+            save = save_dialog()
         except CancelException:
             return False
+        self.CancelAutosave()
+        if save:
+            self.OnSave()
+        # We're about to move on from this file, so make sure it's
+        # been written before going any further
+        self.writer.Wait()
+        if not save:
+            writer.discardDraft(self.filepath)
+        self.PollWriter()
+        return True
 
-    def OnPlayer(self):
-        self.UpdateTime()
+    def OnEditorChange(self):
+        # Keep the preview current while playing, but don't re-parse on
+        # every keystroke of a burst of typing
+        if (self.editMode and self.player.playing()
+            and self.previewTimer is None):
+            self.previewTimer = self.after(PREVIEW_DELAY, self.UpdatePreview)
+
+    def UpdatePreview(self):
+        self.previewTimer = None
+        self.PreviewLyrics()
+        self.scheduler.Wake()
+
+    def PreviewLyrics(self):
+        """Show the lyrics being edited, here and on other screens"""
+        lyrics = self.lyricsEditor.GetLyrics()
+        self.lyricsViewer.UpdateLyrics(lyrics)
+        self.waveform.SetLyrics(lyrics)
+        # GetLyrics returns the same instance until the text changes
+        if (self.broadcaster is not None
+            and lyrics is not self.broadcaster.lyrics):
+            self.broadcaster.SetLyrics(lyrics, self.broadcastTitle)
+            self.broadcaster.Sync(self.player.Tell(), self.player.playing())
 
+    def OnPlayer(self):
         if self.player.playing():
             if self.editMode:
                 self.lyricsEditor.focus_set()
-                self.lyricsViewer.SetLyrics(self.lyricsEditor.GetLyrics())
-        elif self.timer is not None:
-            self.after_cancel(self.timer)
+                self.PreviewLyrics()
+
+        if self.broadcaster is not None:
+            self.broadcaster.Sync(self.player.Tell(), self.player.playing())
+        self.scheduler.Wake()
+
+    def OpenFile(self, filepath, entry=None):
+        self.CancelSeek()
+        if entry is None:
+            if os.path.splitext(filepath)[1] == '.mp3':
+                # A save still being written has its journal in place, and
+                # recovering from it would undo the save; the lyrics
+                # should come from the saved file anyway
+                self.writer.Wait()
+                try:
+                    lyrics3v2.recover(filepath)
+                except (IOError, OSError, ValueError):
+                    # the lyrics are read as well as they can be below
+                    pass
+            entry = playlist.Entry(filepath,
+                                   playlist.loadLyrics(filepath,
+                                                       self.lyricsCache),
+                                   None)
+
+        self.player.Load(filepath)
+        if self.timing:
+            t = self.player.load_timing
+            print ('load {}: {:.1f} ms (probe {:.1f} ms{}, mixer {:.1f} ms{}, '
+                   'music {:.1f} ms)'.format(
+                       self.filepath, t.total * 1000, t.probe * 1000,
+                       ' cached' if t.cached else '', t.mixer * 1000,
+                       ' reused' if t.reused else '', t.load * 1000))
+
+        self.ShowSong(entry)
 
-        self.lyricsViewer.OnPlayer()
+        self.volumeSlider.set(int(self.player.GetVolume() * 100))
+        self.UpdateTime()
+        self.PrefetchNext()
 
-    def OpenFile(self, filepath):
-        self.filepath = filepath
+    def ShowSong(self, entry):
+        self.filepath = entry.filepath
         # Show lyrics, if available
         self.lyricsViewer.ClearLyrics()
-        haveLyrics = False
-        if os.path.splitext(self.filepath)[1] == '.mp3':
-            try:
-                self.lyricsViewer.SetLyrics(
-                    lyrics3v2.load(lyrics3v2.read(self.filepath)))
-                haveLyrics = True
-            except ValueError:
-                pass
+        if entry.lyrics is not None:
+            self.lyricsViewer.SetLyrics(entry.lyrics)
 
-        self.player.Load(self.filepath)
+        self.waveform.Clear()
+        self.waveform.SetLyrics(entry.lyrics)
+        self.waveformAnalyzer.Start(self.filepath)
+        self.PollWaveform()
 
         if self.editMode:
             self.lyricsEditor.LoadLyrics(self.lyricsViewer.lyrics)
+            self.AnalyzeSong()
 
         # Hide lyrics viewer if there are no lyrics
-        if not haveLyrics and not self.editMode:
+        if entry.lyrics is None and not self.editMode:
             self.lyricsViewer.pack_forget()
         else:
             self.lyricsViewer.pack(side=tk.LEFT, fill=tk.BOTH, expand=1)
@@ -245,15 +478,72 @@ class KaraokePlayer(tk.Frame):
         title = os.path.basename(self.filepath)
         self.parent.title(u'{} - Karaoke-chan'.format(title))
 
-        self.volumeSlider.set(int(self.player.GetVolume() * 100))
-        self.UpdateTime()
+        if self.broadcaster is not None:
+            metadata = (entry.lyrics.getMetadata()
+                        if entry.lyrics is not None else {})
+            self.broadcastTitle = metadata.get('title', title)
+            self.broadcaster.SetLyrics(entry.lyrics, self.broadcastTitle)
+            self.broadcaster.Sync(self.player.Tell(), self.player.playing())
 
-    def OnOpen(self):
+    def PrefetchNext(self):
+        self.playlist.Prefetch()
+        self.PollPlaylist()
+
+    def PollPlaylist(self):
+        if self.playlistTimer is not None:
+            self.after_cancel(self.playlistTimer)
+            self.playlistTimer = None
+
+        if self.playlist.Peek() is None:
+            return
+        entry = self.playlist.Ready()
+        if entry is None:
+            # a fetch for a song that was taken off the queue in the
+            # meantime may have kept this one from being started; this
+            # does nothing while a fetch is still running
+            self.playlist.Prefetch()
+            self.playlistTimer = self.after(PLAYLIST_POLL_INTERVAL,
+                                            self.PollPlaylist)
+            return
+
+        # Gapless playback isn't possible while editing, since the
+        # editor would have to switch files without asking
+        if (not self.editMode and entry.info is not None
+            and self.player.queued is None):
+            self.player.Enqueue(entry.filepath, entry.info)
+            self.scheduler.Wake()
+
+    def PlayNext(self):
+        if self.playlist.Peek() is None:
+            return
+        entry = self.playlist.Pop()
+        self.OpenFile(entry.filepath, entry)
+        self.player.Play()
+
+    def OnNext(self):
+        if self.ConfirmLeaveFile():
+            self.PlayNext()
+
+    def OnQueue(self):
+        paths = tkFileDialog.askopenfilenames(
+            defaultextension='.mp3',
+            filetypes=[('MP3 files', '*.mp3'), ('All files', '*')])
+        for path in self.parent.tk.splitlist(paths):
+            self.QueueFile(path)
+
+    def QueueFile(self, path):
+        self.playlist.Add(path)
+        self.PrefetchNext()
+
+    def ConfirmLeaveFile(self):
         self.OnStop()
 
-        if (self.editMode and self.filepath is not None
-            and self.lyricsEditor.edit_modified()
-            and not self.PromptSave()):
+        return not (self.editMode and self.filepath is not None
+                    and self.lyricsEditor.edit_modified()
+                    and not self.PromptSave())
+
+    def OnOpen(self):
+        if not self.ConfirmLeaveFile():
             return
 
         path = tkFileDialog.askopenfilename(
@@ -263,6 +553,22 @@ class KaraokePlayer(tk.Frame):
         if path:
             self.OpenFile(path)
 
+    def OnLibrary(self):
+        if self.libraryBrowser is not None and self.libraryBrowser.winfo_exists():
+            self.libraryBrowser.lift()
+            return
+        self.libraryBrowser = kcw.LibraryBrowser(self.parent,
+                                                 library.DEFAULT_DB_PATH,
+                                                 self.OnLibraryOpen,
+                                                 self.QueueFile)
+
+    def OnLibraryOpen(self, path, time=None):
+        if self.ConfirmLeaveFile():
+            self.OpenFile(path)
+            if time is not None:
+                # library times are in hundredths of a second
+                self.player.Seek(time * 10)
+
     def OnClose(self):
         self.player.Stop()
         if (self.editMode and self.lyricsEditor.edit_modified() and not
@@ -294,6 +600,9 @@ class KaraokePlayer(tk.Frame):
         if self.editMode:
             return
         self.editMode = True
+        # a song queued for gapless playback would take over the editor
+        # when the current one ends
+        self.player.Dequeue()
 
         self.fileMenu.entryconfig(self.editIndex, state=tk.DISABLED)
         self.fileMenu.entryconfig(self.saveIndex, state=tk.NORMAL)
@@ -305,15 +614,76 @@ class KaraokePlayer(tk.Frame):
 
         self.lyricsEditor.LoadLyrics(self.lyricsViewer.lyrics)
 
+        if self.filepath is not None:
+            draft = writer.loadDraft(self.filepath)
+            if draft is not None and tkMessageBox.askyesno(
+                    'Restore draft?',
+                    'There are unsaved edits from a previous session. '
+                    'Restore them?'):
+                self.lyricsEditor.LoadText(draft)
+                self.lyricsEditor.edit_modified(True)
+
         self.lyricsEditor.focus_set()
+        self.AnalyzeSong()
 
     def OnSave(self):
+        if self.filepath is None:
+            return
         try:
-            lyrics3v2.write(self.filepath,
-                            lyrics3v2.dump(self.lyricsEditor.GetLyrics()))
-            self.lyricsEditor.DiscardEdits()
-        except:
-            print "write error"
+            lyricsData = lyrics3v2.dump(self.lyricsEditor.GetLyrics())
+        except ValueError as e:
+            tkMessageBox.showerror('Save failed', str(e))
+            return
+        self.CancelAutosave()
+        self.writer.SaveLyrics(self.filepath, lyricsData)
+        self.lyricsEditor.DiscardEdits()
+        self.statusLabel.config(text='Saving...')
+        self.PollWriter()
+
+    def ScheduleAutosave(self):
+        if not self.editMode or self.filepath is None:
+            return
+        self.CancelAutosave()
+        self.autosaveTimer = self.after(AUTOSAVE_DELAY, self.Autosave)
+
+    def CancelAutosave(self):
+        if self.autosaveTimer is not None:
+            self.after_cancel(self.autosaveTimer)
+            self.autosaveTimer = None
+
+    def Autosave(self):
+        self.autosaveTimer = None
+        if self.editMode and self.lyricsEditor.edit_modified():
+            self.writer.SaveDraft(self.filepath, self.lyricsEditor.GetText())
+            self.PollWriter()
+
+    def PollWriter(self):
+        if self.writerTimer is not None:
+            self.after_cancel(self.writerTimer)
+            self.writerTimer = None
+
+        # Check this before collecting results, so that a job finishing
+        # in between still gets picked up on the next poll
+        busy = self.writer.Busy()
+        for (kind, filepath, changed, error) in self.writer.Results():
+            if kind == writer.DRAFT:
+                if error is not None:
+                    self.statusLabel.config(text='Autosave failed')
+            elif error is not None:
+                self.statusLabel.config(text='Save failed')
+                if filepath == self.filepath:
+                    self.lyricsEditor.edit_modified(True)
+                tkMessageBox.showerror(
+                    'Save failed', u'Could not save {}:\n{}'.format(
+                        os.path.basename(filepath), error))
+            elif changed:
+                self.statusLabel.config(text='Saved')
+            else:
+                self.statusLabel.config(text='No changes to save')
+
+        if busy:
+            self.writerTimer = self.after(WRITER_POLL_INTERVAL,
+                                          self.PollWriter)
 
     def OnCloseEditor(self):
         self.player.Stop()
@@ -322,6 +692,7 @@ class KaraokePlayer(tk.Frame):
             return
 
         self.editMode = False
+        self.StopAnalysis()
 
         self.fileMenu.entryconfig(self.editIndex, state=tk.NORMAL)
         self.fileMenu.entryconfig(self.saveIndex, state=tk.DISABLED)
@@ -332,15 +703,116 @@ class KaraokePlayer(tk.Frame):
         if self.filepath:
             self.OpenFile(self.filepath)
 
+    def AnalyzeSong(self):
+        """Start finding onsets in the current song for the editor
+
+        While the song is being decoded for its waveform, this waits
+        until that's done rather than decoding it twice at once.
+        """
+        if not self.editMode or self.filepath is None:
+            return
+        self.lyricsEditor.SetOnsets([])
+        self.statusLabel.config(text='Finding onsets...')
+        if self.waveformAnalyzer.Busy():
+            self.analyzer.Cancel()
+            self.analyzePending = True
+            return
+        self.analyzePending = False
+        self.analyzer.Start(self.filepath)
+        self.PollAnalyzer()
+
+    def StopAnalysis(self):
+        self.analyzePending = False
+        self.analyzer.Cancel()
+        self.lyricsEditor.SetOnsets([])
+        if self.analyzerTimer is not None:
+            self.after_cancel(self.analyzerTimer)
+            self.analyzerTimer = None
+
+    def PollAnalyzer(self):
+        if self.analyzerTimer is not None:
+            self.after_cancel(self.analyzerTimer)
+            self.analyzerTimer = None
+
+        result = self.analyzer.Result()
+        if result is None:
+            if self.analyzer.Busy():
+                self.analyzerTimer = self.after(ANALYZER_POLL_INTERVAL,
+                                                self.PollAnalyzer)
+            return
+
+        filepath, found = result
+        if isinstance(found, ImportError):
+            self.statusLabel.config(text='Finding onsets needs NumPy')
+        elif isinstance(found, Exception):
+            self.statusLabel.config(text='Could not find onsets')
+        elif filepath == self.filepath:
+            self.lyricsEditor.SetOnsets(found)
+            self.statusLabel.config(text='{} onsets'.format(len(found)))
+
+    def PollWaveform(self):
+        if self.waveformTimer is not None:
+            self.after_cancel(self.waveformTimer)
+            self.waveformTimer = None
+
+        result = self.waveformAnalyzer.Result()
+        if result is None and self.waveformAnalyzer.Busy():
+            self.waveformTimer = self.after(ANALYZER_POLL_INTERVAL,
+                                            self.PollWaveform)
+            return
+        if self.analyzePending:
+            self.AnalyzeSong()
+        if result is None:
+            return
+
+        # without NumPy, or for files audioread can't decode, there's
+        # just no waveform
+        filepath, pyramid = result
+        if not isinstance(pyramid, Exception) and filepath == self.filepath:
+            self.waveform.pack(fill=tk.X, after=self.timeSlider)
+            self.waveform.SetPyramid(pyramid)
+
+    def OnSnap(self):
+        self.lyricsEditor.snap = bool(self.snapVar.get())
+
     def OnTimeAny(self):
-        current = self.player.Tell()
         slider = self.timeSliderVar.get() * 1000
-        if abs(current - slider) < 100:
+        if (self.pendingSeek is None
+            and abs(self.player.Tell() - slider) < 100):
             return
-        self.player.Seek(slider)
-        self.UpdateTime(updateSliderTime=False)
+        # Show where the slider is straight away, but only seek once it
+        # stops moving, since every seek restarts the decoder
+        self.pendingSeek = slider
+        self.scheduler.Cancel()
+        self.UpdateTime()
+        self.lyricsViewer.Update(slider)
+        if self.seekTimer is not None:
+            self.after_cancel(self.seekTimer)
+        self.seekTimer = self.after(SEEK_DELAY, self.CommitSeek)
+
+    def CancelSeek(self):
+        if self.seekTimer is not None:
+            self.after_cancel(self.seekTimer)
+            self.seekTimer = None
+        self.pendingSeek = None
+
+    def CommitSeek(self):
+        pos = self.pendingSeek
+        self.CancelSeek()
+        if pos is not None:
+            # wakes the scheduler up again
+            self.player.Seek(pos)
 
     def Close(self):
+        self.CancelAutosave()
+        self.CancelSeek()
+        if self.broadcaster is not None:
+            self.broadcaster.Close()
+        self.StopAnalysis()
+        self.waveformAnalyzer.Cancel()
+        self.writer.Close()
+        if self.lyricsCache is not None:
+            self.lyricsCache.close()
         self.parent.destroy()
 
     def OnFontSize(self, up):
@@ -352,14 +824,38 @@ class KaraokePlayer(tk.Frame):
                            size=self.font_size)
         self.lyricsViewer.ChangeFont(font)
 
+    def OnSavePerf(self):
+        filepath = tkFileDialog.asksaveasfilename(
+            defaultextension='.json',
+            filetypes=[('JSON', '*.json'), ('CSV', '*.csv')])
+        if filepath:
+            try:
+                perf.dump(filepath)
+            except IOError as e:
+                tkMessageBox.showerror(
+                    'Save failed', u'Could not save {}:\n{}'.format(
+                        os.path.basename(filepath), e))
+
 
 def main():
     argparser = argparse.ArgumentParser()
     argparser.add_argument('filepath', nargs='?')
+    argparser.add_argument('--timing', action='store_true',
+                           help='print how long startup and loading '
+                           'each file take')
+    argparser.add_argument('--perf', action='store_true',
+                           help='measure performance and show the '
+                           'measurements over the lyrics')
+    argparser.add_argument('--broadcast', nargs='?', type=int,
+                           const=broadcast.DEFAULT_PORT, metavar='PORT',
+                           help='serve the lyrics to other screens on '
+                           'the network, on port {} unless '
+                           'given'.format(broadcast.DEFAULT_PORT))
     args = argparser.parse_args()
 
     root = tk.Tk()
-    app = KaraokePlayer(root, filepath=args.filepath)
+    app = KaraokePlayer(root, filepath=args.filepath, timing=args.timing,
+                        perfOverlay=args.perf, broadcastPort=args.broadcast)
     root.mainloop()
 
 
@@ -0,0 +1,221 @@
+#! /usr/bin/python2
+
+from __future__ import division
+
+import os
+import sys
+import time
+import argparse
+import itertools
+import collections
+import multiprocessing
+
+import kchan.formats as formats
+import kchan.formats.lyrics3v2 as lyrics3v2
+import kchan.formats.lrc as lrc
+from kchan.library import findMedia
+
+# Kinds of problem check() can report
+NO_ID3 = "no ID3v1 tag after Lyrics3 tag"
+BAD_SIZE = "Lyrics3 size field doesn't match tag"
+MALFORMED = "malformed Lyrics3 field"
+NO_LYR = "no LYR field"
+MISMATCH = "KCL and LYR lyrics disagree"
+READ_ERROR = "read error"
+EXPORT_ERROR = "export failed"
+FAILED = "couldn't be processed"
+PROBLEMS = (NO_ID3, BAD_SIZE, MALFORMED, NO_LYR, MISMATCH, READ_ERROR,
+            EXPORT_ERROR, FAILED)
+
+# Number of files handed to the worker pool at a time; Pool reads all of
+# the jobs it's given up front, so a whole library would otherwise be
+# listed in memory before the first report came back
+JOB_BATCH = 1024
+
+FileReport = collections.namedtuple(
+    'FileReport', ['filepath', 'tagged', 'kcl', 'source', 'phrases',
+                   'problems', 'exported'])
+
+
+def roundTimes(lyrics):
+    """Round a Lyrics instance's times to whole seconds, as LYR stores them
+
+    Rounding can bring two times together, so the result is re-sorted the
+    way getTimes() sorts a loaded LYR tag.
+    """
+    return sorted(((t // 100 + (1 if t % 100 >= 50 else 0)) * 100, idx)
+                  for (t, idx) in lyrics.getTimes())
+
+
+def check(filepath):
+    """Check the Lyrics3 v2.00 tag of a file for problems
+
+    Args:
+        filepath (str): pathname of an mp3 file
+
+    Returns:
+        (bool, Lyrics, bool, list). Whether the file has a Lyrics3 tag,
+        the lyrics in it (None if there are none or they can't be
+        parsed), whether there's a KCL field, and a list of (problem,
+        detail) pairs, where problem is one of PROBLEMS.
+    """
+    problems = []
+    try:
+        data = lyrics3v2.read(filepath)
+        with open(filepath, 'rb') as f:
+            f.seek(-lyrics3v2.ID3_LENGTH, 2)
+            if f.read(len(lyrics3v2.ID3_START)) != lyrics3v2.ID3_START:
+                problems.append((NO_ID3, ''))
+    except ValueError:
+        # No tag at all, which isn't a problem
+        return (False, None, False, problems)
+    except IOError as e:
+        return (False, None, False, [(READ_ERROR, str(e))])
+
+    if not data.startswith(lyrics3v2.START_TAG):
+        return (True, None, False, problems + [(BAD_SIZE, '')])
+    try:
+        fieldIds = [fieldId for (fieldId, span) in lyrics3v2.fields(data)]
+    except ValueError as e:
+        return (True, None, False, problems + [(MALFORMED, str(e))])
+
+    kcl = "KCL" in fieldIds
+    if "LYR" not in fieldIds:
+        problems.append((NO_LYR, ''))
+        lyrics = lyrics3v2.load(data) if kcl else None
+        return (True, lyrics, kcl, problems)
+
+    lyrics = lyrics3v2.load(data)
+    if kcl:
+        lyr = lyrics3v2.load(data, kcl=False)
+        if list(lyr.getPhrases()) != list(lyrics.getPhrases()):
+            problems.append((MISMATCH, 'phrases differ'))
+        elif list(lyr.getTimes()) != roundTimes(lyrics):
+            problems.append((MISMATCH, 'timestamps differ'))
+
+    return (True, lyrics, kcl, problems)
+
+
+def processFile(job):
+    """Check a file, and export its lyrics if asked to
+
+    This runs in a worker process. Any unexpected error is reported as
+    a FAILED problem with the file, so the rest of the run carries on.
+
+    Args:
+        job (tuple): (filepath, export, overwrite)
+
+    Returns:
+        FileReport.
+    """
+    try:
+        return examineFile(*job)
+    except Exception as e:
+        return FileReport(job[0], False, False, None, 0,
+                          [(FAILED, '{}: {}'.format(type(e).__name__, e))],
+                          False)
+
+
+def examineFile(filepath, export, overwrite):
+    tagged, lyrics, kcl, problems = check(filepath)
+    source = 'Lyrics3' if lyrics is not None else None
+    if lyrics is None:
+        # Lyrics stored some other way; an existing .lrc file is what
+        # we'd be exporting to, so it doesn't count when exporting
+        lyrics, source = formats.loadFile(
+            filepath, exclude=('Lyrics3', 'LRC') if export else ('Lyrics3',))
+
+    exported = False
+    if export and lyrics is not None:
+        path = lrc.sidecarPath(filepath)
+        if overwrite or not os.path.exists(path):
+            try:
+                with open(path, 'wb') as f:
+                    f.write(lrc.dump(lyrics))
+                exported = True
+            except IOError as e:
+                problems.append((EXPORT_ERROR, str(e)))
+    return FileReport(filepath, tagged, kcl, source,
+                      len(lyrics.getPhrases()) if lyrics is not None else 0,
+                      problems, exported)
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description='Check and export Lyrics3 lyrics in bulk')
+    argparser.add_argument('--export', action='store_true',
+                           help='write lyrics to .lrc files next to the '
+                           'media files')
+    argparser.add_argument('--overwrite', action='store_true',
+                           help='replace existing .lrc files')
+    argparser.add_argument('-q', '--quiet', action='store_true',
+                           help='only print the summary')
+    argparser.add_argument('-j', '--processes', type=int, default=None,
+                           help='number of worker processes')
+    argparser.add_argument('directories', nargs='+')
+    args = argparser.parse_args()
+
+    startTime = time.time()
+    counts = collections.Counter()
+    sources = collections.Counter()
+    jobs = ((filepath, args.export, args.overwrite)
+            for filepath in findMedia(args.directories))
+
+    def tally(reports):
+        for report in reports:
+            counts['files'] += 1
+            counts['tagged'] += report.tagged
+            counts['kcl'] += report.kcl
+            counts['phrases'] += report.phrases
+            counts['exported'] += report.exported
+            if report.source is not None:
+                sources[report.source] += 1
+            for (problem, detail) in report.problems:
+                counts[problem] += 1
+                if not args.quiet:
+                    print '{}: {}{}'.format(report.filepath, problem,
+                                            ' ({})'.format(detail)
+                                            if detail else '')
+
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        # Jobs go to the pool a batch at a time, and reports are handled
+        # as they arrive and then dropped, so memory use doesn't grow
+        # with the size of the library. The next batch is queued before
+        # the reports for the last one are read, so the workers don't
+        # sit idle in between.
+        pending = None
+        while True:
+            batch = list(itertools.islice(jobs, JOB_BATCH))
+            if not batch:
+                break
+            reports = pool.imap_unordered(processFile, batch, chunksize=16)
+            if pending is not None:
+                tally(pending)
+            pending = reports
+        if pending is not None:
+            tally(pending)
+    finally:
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - startTime
+    print '{} files, {} with Lyrics3 tags, {} with KCL, {} phrases'.format(
+        counts['files'], counts['tagged'], counts['kcl'], counts['phrases'])
+    for reader in formats.READERS:
+        if sources[reader.name]:
+            print 'lyrics from {}: {}'.format(reader.name,
+                                              sources[reader.name])
+    if args.export:
+        print '{} exported to .lrc'.format(counts['exported'])
+    for problem in PROBLEMS:
+        if counts[problem]:
+            print '{}: {}'.format(problem, counts[problem])
+    print '{:.1f} s, {:.1f} files/s'.format(
+        elapsed, counts['files'] / elapsed if elapsed > 0 else 0)
+
+    sys.exit(1 if any(counts[p] for p in PROBLEMS) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+#! /usr/bin/python2
+
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+
+import kchan.timedtext as timedtext
+import kchan.formats.lyrics3v2 as lyrics3v2
+from kchan.lyrics import Lyrics
+
+DEFAULT_BASELINE_PATH = os.path.join(os.path.expanduser('~'), '.karaokechan',
+                                     'bench-baseline.json')
+
+# Default number of phrases in the synthetic lyrics
+DEFAULT_SIZE = 2000
+# Default number of times each benchmark is run
+DEFAULT_REPEAT = 5
+# A benchmark whose best time is this much slower than the baseline's
+# counts as a regression
+DEFAULT_TOLERANCE = 0.25
+
+# Milliseconds between simulated frames when driving the lyrics viewer
+FRAME_INTERVAL = 10
+
+WORDS = ("ai kaze yume sora hoshi kokoro namida hikari yoru asa michi "
+         "tenshi shinwa mune doa anata watashi tada ima mada").split()
+
+
+def generateText(phrases, seed=0, words=False, lineLength=3):
+    """Generate synthetic timed lyrics text
+
+    Args:
+        phrases (int): number of phrases
+
+    Kwargs:
+        seed (int): seed for the random generator, so runs are repeatable
+        words (bool): whether to include word timestamps
+        lineLength (int): average number of phrases per line
+
+    Returns:
+        str. Lyrics in the format read by timedtext.load(), with a
+        [mm:ss.xx] timestamp before every phrase, in time order.
+    """
+    rand = random.Random(seed)
+    out = []
+    time = 0
+    for _ in xrange(phrases):
+        time += rand.randint(50, 400)
+        start = time
+        out.append(timedtext.formatTime(start))
+        for n in xrange(rand.randint(1, 4)):
+            if words:
+                out.append(timedtext.formatTime(start + n * 20, "<>"))
+            out.append(rand.choice(WORDS) + ' ')
+        if rand.randint(1, lineLength) == 1:
+            out.append('\n')
+    return ''.join(out)
+
+
+def generateLyrics(phrases, seed=0, words=False):
+    """Generate a synthetic Lyrics instance; see generateText()"""
+    return timedtext.load(generateText(phrases, seed, words))
+
+
+def measure(fn, repeat=DEFAULT_REPEAT, setup=None):
+    """Time a function
+
+    Args:
+        fn (callable): function to time, called with no arguments
+
+    Kwargs:
+        repeat (int): number of runs
+        setup (callable): called before each run, outside the timing
+
+    Returns:
+        dict. "best" and "median" run times in seconds, and "runs".
+    """
+    times = []
+    for _ in xrange(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    times.sort()
+    return {'best': times[0], 'median': times[len(times) // 2],
+            'runs': repeat}
+
+
+def benchTimedText(size, repeat, seed):
+    text = generateText(size, seed, words=True)
+    lyrics = timedtext.load(text)
+    return {
+        'timedtext.load': measure(lambda: timedtext.load(text), repeat),
+        'timedtext.dump': measure(
+            lambda: timedtext.dump(lyrics, frac=True, words=True), repeat),
+    }
+
+
+def benchLyrics3(size, repeat, seed):
+    lyrics = generateLyrics(size, seed, words=True)
+    # keep the fields within the Lyrics3 size limit
+    while len(timedtext.dump(lyrics, frac=True, words=True)) >= 10**5:
+        size //= 2
+        lyrics = generateLyrics(size, seed, words=True)
+    data = lyrics3v2.dump(lyrics)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filepath = os.path.join(tmpdir, 'bench.mp3')
+        with open(filepath, 'wb') as f:
+            f.write(os.urandom(1 << 20))
+        lyrics3v2.write(filepath, data)
+
+        def rewrite():
+            # write() leaves the file alone if nothing changed, so
+            # alternate between two different tags
+            lyrics3v2.write(filepath, data[:-1])
+            lyrics3v2.write(filepath, data)
+
+        return {
+            'lyrics3v2.dump': measure(lambda: lyrics3v2.dump(lyrics), repeat),
+            'lyrics3v2.load': measure(lambda: lyrics3v2.load(data), repeat),
+            'lyrics3v2.read': measure(lambda: lyrics3v2.read(filepath),
+                                      repeat),
+            'lyrics3v2.write': measure(rewrite, repeat),
+        }
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def benchTimeline(size, repeat, seed):
+    rand = random.Random(seed)
+    phrases = [(rand.choice(WORDS) + ' ', [rand.randint(0, size * 200)])
+               for _ in xrange(size)]
+    lyrics = Lyrics.fromPhrases(phrases)
+    end = lyrics.getTimes()[-1][0] + 100
+    sequential = range(0, end, 1)
+    shuffled = list(sequential)
+    rand.shuffle(shuffled)
+
+    def addPhrases():
+        l = Lyrics()
+        for (phrase, times) in phrases:
+            l.addPhrase(phrase, times)
+
+    def lookup(times):
+        getCurrent = lyrics.getCurrent
+        for t in times:
+            getCurrent(t)
+
+    return {
+        'Lyrics.addPhrase': measure(addPhrases, repeat),
+        'Lyrics.getCurrent.sequential': measure(lambda: lookup(sequential),
+                                                repeat),
+        'Lyrics.getCurrent.random': measure(lambda: lookup(shuffled), repeat),
+    }
+
+
+class FakePlayer(object):
+    """Stand-in for Player with a position that's set by hand"""
+
+    def __init__(self):
+        self.pos = 0
+
+    def Tell(self):
+        return self.pos
+
+    def playing(self):
+        return True
+
+
+def benchViewer(size, repeat, seed):
+    """Drive the lyrics viewer through a whole song with a fake clock
+
+    Needs a display (Xvfb will do); returns an empty dict without one.
+    """
+    import Tkinter as tk
+    import tkFont
+    import kchan.widgets as kcw
+
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        print >>sys.stderr, 'skipping viewer benchmarks: {}'.format(e)
+        return {}
+    try:
+        root.geometry('800x600')
+        font = tkFont.Font(family='Helvetica', size=24)
+        fakePlayer = FakePlayer()
+        ctrl = kcw.LyricsCtrl(root, fakePlayer, font)
+        ctrl.pack(fill=tk.BOTH, expand=True)
+        root.update()
+        results = {}
+        for words in (False, True):
+            lyrics = generateLyrics(size, seed, words)
+            end = (lyrics.getTimes()[-1][0] + 100) * 10
+
+            def setup():
+                ctrl.SetLyrics(lyrics)
+                root.update()
+
+            def play():
+                # only call Update when the viewer asks for it, as the
+                # scheduler would
+                now = 0
+                while now is not None and now < end:
+                    fakePlayer.pos = now
+                    nextTime = ctrl.Update(now)
+                    now = (max(nextTime, now + FRAME_INTERVAL)
+                           if nextTime is not None else None)
+                root.update_idletasks()
+
+            name = 'LyricsCtrl.Update' + ('.words' if words else '')
+            results[name] = measure(play, repeat, setup)
+            results['LyricsCtrl.SetLyrics' + ('.words' if words else '')] = (
+                measure(lambda: ctrl.SetLyrics(lyrics), repeat))
+        return results
+    finally:
+        root.destroy()
+
+
+BENCHMARKS = [benchTimedText, benchLyrics3, benchTimeline, benchViewer]
+
+
+def run(size=DEFAULT_SIZE, repeat=DEFAULT_REPEAT, seed=0, gui=True):
+    """Run the whole benchmark suite
+
+    Returns:
+        dict. "meta" describes the run, and "results" maps benchmark
+        names to the results of measure().
+    """
+    results = {}
+    for bench in BENCHMARKS:
+        if bench is benchViewer and not gui:
+            continue
+        results.update(bench(size, repeat, seed))
+    return {'meta': {'size': size, 'repeat': repeat, 'seed': seed,
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'time': time.time()},
+            'results': results}
+
+
+def compare(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Find benchmarks that got slower than a baseline
+
+    Returns:
+        list. Tuples (name, ratio) for each benchmark whose best time
+        is more than tolerance slower than the baseline's, where ratio is
+        the new time divided by the old one.
+    """
+    regressions = []
+    for (name, result) in sorted(report['results'].iteritems()):
+        old = baseline['results'].get(name)
+        if old is None or old['best'] <= 0:
+            continue
+        ratio = result['best'] / old['best']
+        if ratio > 1 + tolerance:
+            regressions.append((name, ratio))
+    return regressions
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description='Benchmark lyrics parsing, lookup and rendering')
+    argparser.add_argument('-n', '--size', type=int, default=DEFAULT_SIZE,
+                           help='number of phrases in the synthetic lyrics')
+    argparser.add_argument('-r', '--repeat', type=int, default=DEFAULT_REPEAT,
+                           help='number of runs of each benchmark')
+    argparser.add_argument('--seed', type=int, default=0)
+    argparser.add_argument('--no-gui', action='store_true',
+                           help="skip the benchmarks that need a display")
+    argparser.add_argument('-o', '--output',
+                           help='write the results to this JSON file')
+    argparser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH,
+                           help='baseline results to compare against')
+    argparser.add_argument('--save-baseline', action='store_true',
+                           help='store the results as the new baseline')
+    argparser.add_argument('--tolerance', type=float,
+                           default=DEFAULT_TOLERANCE,
+                           help='fraction by which a benchmark may be '
+                           'slower than the baseline')
+    args = argparser.parse_args()
+
+    report = run(args.size, args.repeat, args.seed, gui=not args.no_gui)
+    for (name, result) in sorted(report['results'].iteritems()):
+        print '{:32} best {:9.3f} ms  median {:9.3f} ms'.format(
+            name, result['best'] * 1000, result['median'] * 1000)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        dirpath = os.path.dirname(args.baseline)
+        if dirpath and not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print 'saved baseline to {}'.format(args.baseline)
+        return
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except IOError:
+        print 'no baseline at {}; run with --save-baseline to store one'.format(
+            args.baseline)
+        return
+    if baseline['meta'].get('size') != args.size:
+        print 'warning: baseline was run with {} phrases'.format(
+            baseline['meta'].get('size'))
+
+    regressions = compare(report, baseline, args.tolerance)
+    for (name, ratio) in regressions:
+        print 'REGRESSION {}: {:.2f}x slower than baseline'.format(name, ratio)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
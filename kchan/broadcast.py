@@ -0,0 +1,421 @@
+#! /usr/bin/python2
+
+from __future__ import division
+
+import json
+import time
+import Queue
+import socket
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from kchan.lyrics import Lyrics
+
+DEFAULT_PORT = 8765
+
+# Seconds between clock events when nothing else is sent; they also keep
+# idle connections from timing out
+CLOCK_INTERVAL = 5
+# Number of events a client can fall behind by before it's disconnected
+CLIENT_BACKLOG = 256
+# Connections waiting to be accepted; a whole room of phones may connect
+# at once
+LISTEN_BACKLOG = 128
+# Seconds Close() waits for clients to be disconnected
+CLOSE_TIMEOUT = 1
+
+# Event types
+LYRICS = "lyrics"
+PHRASE = "phrase"
+CLOCK = "clock"
+
+# Page that shows the lyrics in a browser
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>Karaoke-chan</title>
+<style>
+body { background: black; color: white; font-family: sans-serif;
+       text-align: center; white-space: pre-wrap; }
+#current { color: #6af; font-size: 8vw; }
+#next { color: #888; font-size: 5vw; }
+</style>
+</head>
+<body>
+<div id="current"></div>
+<div id="next"></div>
+<script>
+var phrases = [];
+var events = new EventSource("/events");
+function show(phrase) {
+  document.getElementById("current").textContent =
+    phrase === null ? "" : phrases[phrase];
+  var next = phrase === null ? 0 : phrase + 1;
+  document.getElementById("next").textContent =
+    next < phrases.length ? phrases[next] : "";
+}
+events.addEventListener("lyrics", function (e) {
+  phrases = JSON.parse(e.data).phrases;
+  show(null);
+});
+events.addEventListener("phrase", function (e) {
+  show(JSON.parse(e.data).phrase);
+});
+</script>
+</body>
+</html>
+"""
+
+
+def wallTime():
+    """Get the current time in milliseconds, as sent with every event"""
+    return round(time.time() * 1000, 3)
+
+
+def toUnicode(text):
+    """Decode UTF-8 text; unicode (as Tk gives for the editor's text)
+    and None are returned as they are"""
+    if isinstance(text, str):
+        return text.decode('utf-8', 'replace')
+    return text
+
+
+def formatEvent(kind, data):
+    """Encode an event in the text/event-stream format"""
+    return "event: {}\ndata: {}\n\n".format(
+        kind, json.dumps(data, separators=(',', ':')))
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = LISTEN_BACKLOG
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/events':
+            self.SendEvents()
+        elif self.path == '/':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(PAGE)))
+            self.end_headers()
+            self.wfile.write(PAGE)
+        else:
+            self.send_error(404)
+
+    def SendEvents(self):
+        broadcaster = self.server.broadcaster
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+
+        events = broadcaster.Connect()
+        try:
+            self.wfile.write(''.join(broadcaster.Snapshot()))
+            while True:
+                try:
+                    pending = [events.get(timeout=CLOCK_INTERVAL)]
+                except Queue.Empty:
+                    pending = [broadcaster.ClockEvent()]
+                # send everything that's queued up in one write
+                while True:
+                    try:
+                        pending.append(events.get_nowait())
+                    except Queue.Empty:
+                        break
+                if None in pending or not broadcaster.Connected(events):
+                    break
+                self.wfile.write(''.join(pending))
+        except socket.error:
+            # the client went away
+            pass
+        finally:
+            broadcaster.Disconnect(events)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Broadcaster(object):
+    """Sends the lyrics and playback position to other screens on the network
+
+    Clients read server-sent events from /events; / is a page that shows
+    the current phrase. The events are:
+
+    lyrics: {"song", "title", "phrases", "times"}, when a client
+        connects and whenever the song changes. times is a list of
+        [time, phrase] pairs as returned by Lyrics.getTimes().
+    phrase: {"song", "phrase", "start", "end"}, whenever the phrase
+        being sung changes, as returned by Lyrics.getCurrent().
+    clock: {"song", "position", "playing"}, when playback starts, stops
+        or jumps, and every CLOCK_INTERVAL seconds, so clients can keep
+        their own clock in step. position is in milliseconds.
+
+    Times in lyrics and phrase events are in hundredths of a second.
+    Every event also has "sent", the server's wallTime() when it was
+    sent.
+
+    Each client is served by its own thread from its own queue, so a
+    slow client doesn't hold up the others, and events are only encoded
+    once however many clients there are. Apart from Close(), the
+    methods only queue events, so they're quick enough to call from the
+    UI thread.
+    """
+
+    def __init__(self, host='', port=DEFAULT_PORT):
+        """
+        Raises:
+            socket.error: the port can't be listened on
+        """
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.song = 0
+        self.lyrics = None
+        # phrase last sent, and the last lyrics and phrase events, for
+        # clients that connect later
+        self.current = None
+        self.lyricsEvent = None
+        self.phraseEvent = None
+        # playback position, whether it's advancing, and the time.time()
+        # it was taken at
+        self.clock = (0, False, time.time())
+        self.server = Server((host, port), Handler)
+        self.server.broadcaster = self
+
+    def Address(self):
+        return self.server.server_address
+
+    def Start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def Close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        with self.lock:
+            clients = list(self.clients)
+        for events in clients:
+            try:
+                events.put_nowait(None)
+            except Queue.Full:
+                self.Disconnect(events)
+        # handlers disconnect themselves on the way out
+        deadline = time.time() + CLOSE_TIMEOUT
+        while self.ClientCount() and time.time() < deadline:
+            time.sleep(0.01)
+
+    def Connect(self):
+        events = Queue.Queue(CLIENT_BACKLOG)
+        with self.lock:
+            self.clients.add(events)
+        return events
+
+    def Connected(self, events):
+        with self.lock:
+            return events in self.clients
+
+    def Disconnect(self, events):
+        with self.lock:
+            self.clients.discard(events)
+
+    def ClientCount(self):
+        with self.lock:
+            return len(self.clients)
+
+    def Snapshot(self):
+        """Get the events that bring a newly connected client up to date"""
+        return [event for event in (self.lyricsEvent, self.phraseEvent)
+                if event is not None] + [self.ClockEvent()]
+
+    def Broadcast(self, kind, data):
+        """Queue an event for every client
+
+        Returns:
+            str. The encoded event.
+        """
+        data['sent'] = wallTime()
+        event = formatEvent(kind, data)
+        with self.lock:
+            clients = list(self.clients)
+        for events in clients:
+            try:
+                events.put_nowait(event)
+            except Queue.Full:
+                # too far behind to catch up
+                self.Disconnect(events)
+        return event
+
+    def SetLyrics(self, lyrics, title=None):
+        """Start a new song
+
+        Args:
+            lyrics (Lyrics): the song's lyrics, or None if it has none
+
+        Kwargs:
+            title (str): title to show
+        """
+        # build the event first, so nothing changes if it can't be
+        phrases = lyrics.getPhrases() if lyrics is not None else []
+        data = {
+            'title': toUnicode(title),
+            'phrases': [toUnicode(p) for p in phrases],
+            'times': list(lyrics.getTimes()) if lyrics is not None else [],
+        }
+        with self.lock:
+            self.song += 1
+            data['song'] = self.song
+        self.lyrics = lyrics
+        self.current = None
+        self.phraseEvent = None
+        self.lyricsEvent = self.Broadcast(LYRICS, data)
+
+    def Update(self, now):
+        """Send a phrase event if the phrase being sung has changed
+
+        Meant to be a Scheduler client.
+
+        Args:
+            now (int): playback position in ms
+
+        Returns:
+            int. The position in ms at which the phrase next changes, or
+            None.
+        """
+        lyrics = self.lyrics
+        if lyrics is None:
+            return None
+        phrase, startTime, endTime = lyrics.getCurrent(now / 10)
+        if phrase != self.current:
+            self.current = phrase
+            self.phraseEvent = self.Broadcast(PHRASE, {
+                'song': self.song, 'phrase': phrase,
+                'start': startTime, 'end': endTime})
+        return endTime * 10 if endTime is not None else None
+
+    def Sync(self, position, playing):
+        """Send a clock event after playback starts, stops or jumps"""
+        with self.lock:
+            self.clock = (position, playing, time.time())
+        self.Broadcast(CLOCK, self.ClockData())
+
+    def ClockData(self):
+        with self.lock:
+            position, playing, taken = self.clock
+            song = self.song
+        if playing:
+            position += (time.time() - taken) * 1000
+        return {'song': song, 'position': int(position), 'playing': playing}
+
+    def ClockEvent(self):
+        data = self.ClockData()
+        data['sent'] = wallTime()
+        return formatEvent(CLOCK, data)
+
+
+def listen(address, count, latencies, connected):
+    """Follow a broadcaster like a display would, timing phrase events
+
+    Args:
+        address (tuple): (host, port) of the broadcaster
+        count (int): number of phrase events to wait for
+        latencies (list): the delay of each phrase event, in
+            milliseconds, is appended to this
+        connected (threading.Semaphore): released once connected
+    """
+    sock = socket.create_connection(address)
+    try:
+        sock.sendall('GET /events HTTP/1.0\r\n\r\n')
+        f = sock.makefile('rb')
+        # headers
+        while f.readline().strip():
+            pass
+        connected.release()
+        kind = None
+        while count:
+            line = f.readline()
+            if not line:
+                break
+            if line.startswith('event: '):
+                kind = line[len('event: '):].strip()
+            elif line.startswith('data: ') and kind == PHRASE:
+                data = json.loads(line[len('data: '):])
+                latencies.append(wallTime() - data['sent'])
+                count -= 1
+    finally:
+        sock.close()
+
+
+def testFanout(clients, phrases, interval):
+    """Time how long phrase events take to reach many clients
+
+    A broadcaster is started on a free local port, the given number of
+    clients connect to it, and phrases are advanced one at a time.
+
+    Returns:
+        (list, int). The latency of each event at each client, in
+        milliseconds and in no particular order, and the number of
+        deliveries expected.
+    """
+    broadcaster = Broadcaster('127.0.0.1', 0)
+    broadcaster.Start()
+    broadcaster.SetLyrics(Lyrics.fromPhrases(
+        ('phrase {}\n'.format(i), [i * 100]) for i in xrange(phrases)))
+
+    latencies = []
+    connected = threading.Semaphore(0)
+    threads = []
+    for _ in xrange(clients):
+        thread = threading.Thread(target=listen, args=(
+            broadcaster.Address(), phrases, latencies, connected))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for _ in xrange(clients):
+        connected.acquire()
+    # each client only counts as connected once its handler is queued up
+    while broadcaster.ClientCount() < clients:
+        time.sleep(0.01)
+
+    for i in xrange(phrases):
+        broadcaster.Update(i * 1000)
+        time.sleep(interval)
+    for thread in threads:
+        thread.join(CLOCK_INTERVAL)
+    broadcaster.Close()
+    return (latencies, clients * phrases)
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description='Measure how quickly lyrics reach many displays')
+    argparser.add_argument('-c', '--clients', type=int, default=200,
+                           help='number of clients to connect')
+    argparser.add_argument('-n', '--phrases', type=int, default=20,
+                           help='number of phrase changes to send')
+    argparser.add_argument('-i', '--interval', type=float, default=0.05,
+                           help='seconds between phrase changes')
+    args = argparser.parse_args()
+
+    latencies, expected = testFanout(args.clients, args.phrases,
+                                     args.interval)
+    print '{} of {} events delivered'.format(len(latencies), expected)
+    if latencies:
+        latencies.sort()
+        for (label, fraction) in (('median', 0.5), ('95%', 0.95),
+                                  ('99%', 0.99)):
+            print '{:6} {:8.2f} ms'.format(
+                label, latencies[int(fraction * (len(latencies) - 1))])
+        print '{:6} {:8.2f} ms'.format('max', latencies[-1])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+#! /usr/bin/python2
+
+from __future__ import division
+
+import os
+import sys
+import time
+import random
+import argparse
+
+
+def _monotonicClock():
+    """Find the best monotonic clock available, returning seconds"""
+    if sys.platform == 'win32':
+        return time.clock
+    try:
+        import ctypes
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        # The process itself is normally linked against a libc with
+        # clock_gettime; find_library runs external programs, so it's
+        # only used when that fails
+        try:
+            clock_gettime = ctypes.CDLL(None, use_errno=True).clock_gettime
+        except AttributeError:
+            import ctypes.util
+            lib = ctypes.CDLL(ctypes.util.find_library('c') or
+                              ctypes.util.find_library('rt'), use_errno=True)
+            clock_gettime = lib.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        # CLOCK_MONOTONIC is 1 on Linux and 6 on macOS
+        clockId = 6 if sys.platform == 'darwin' else 1
+        ts = timespec()
+
+        def clock():
+            if clock_gettime(clockId, ctypes.pointer(ts)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+
+        clock()
+        return clock
+    except (AttributeError, OSError, TypeError):
+        return time.time
+
+monotonic = _monotonicClock()
+
+# Differences from the mixer beyond this many milliseconds are corrected
+# immediately rather than gradually
+RESYNC_THRESHOLD = 100
+# Fraction of the difference from the mixer that's corrected per sample
+CORRECTION_GAIN = 0.05
+
+
+class PlaybackClock(object):
+    """High-resolution clock tracking the playback position of a song
+
+    The position is extrapolated from a monotonic clock anchored
+    whenever playback starts, stops or seeks, so that it advances
+    smoothly and precisely between mixer updates. Positions reported by
+    the mixer can be fed to Correct() to stop the two from drifting
+    apart without introducing the mixer's jitter.
+
+    All positions are in milliseconds.
+    """
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.running = False
+        self.anchorTime = 0
+        self.anchorPos = 0
+        # largest correction applied since the last Reset, in ms
+        self.maxError = 0
+
+    def Start(self, pos):
+        """Anchor the clock at pos and start it running"""
+        self.anchorTime = self.clock()
+        self.anchorPos = pos
+        self.running = True
+
+    def Stop(self, pos=None):
+        """Stop the clock, at pos if given or at its current position"""
+        self.anchorPos = self.Tell() if pos is None else pos
+        self.running = False
+
+    def Set(self, pos):
+        """Move the clock to pos without changing whether it's running"""
+        self.anchorTime = self.clock()
+        self.anchorPos = pos
+
+    def Shift(self, offset):
+        """Move the clock by offset milliseconds"""
+        self.anchorPos += offset
+
+    def Tell(self):
+        if not self.running:
+            return self.anchorPos
+        return self.anchorPos + (self.clock() - self.anchorTime) * 1000
+
+    def Correct(self, mixerPos):
+        """Nudge the clock towards a position reported by the mixer
+
+        Returns:
+            float. How far the clock was from mixerPos, in ms.
+        """
+        if not self.running:
+            return 0
+        error = mixerPos - self.Tell()
+        if abs(error) > RESYNC_THRESHOLD:
+            self.Set(mixerPos)
+        else:
+            self.anchorPos += error * CORRECTION_GAIN
+        self.maxError = max(self.maxError, abs(error))
+        return error
+
+    def Reset(self):
+        self.maxError = 0
+
+
+class SimulatedMixer(object):
+    """Stand-in for the pygame mixer and its music player
+
+    Reports positions that are quantized, jittery, and run slightly
+    fast or slow, the way a real sound card's clock does; like the real
+    counter, they never go backwards while a file plays.
+
+    Until a file is loaded, it plays a single endless one starting from
+    when it was created. Files named in lengths can be loaded, played
+    and queued like pygame.mixer.music; as in pygame, the position
+    starts counting from zero again when a queued file takes over.
+    """
+
+    def __init__(self, skew=0.0005, jitter=5, quantum=10, lengths=None):
+        """
+        Kwargs:
+            lengths (dict): length in ms of each file that can be loaded
+        """
+        self.skew = skew
+        self.jitter = jitter
+        self.quantum = quantum
+        self.lengths = lengths or {}
+        self.current = None
+        self.queued = None
+        # ms left to play of the current file, from start
+        self.remaining = float('inf')
+        self.playing = True
+        self.start = monotonic()
+        self.last = 0
+
+    def init(self, **kwargs):
+        pass
+
+    def quit(self):
+        pass
+
+    def load(self, filename):
+        self.current = filename
+        self.queued = None
+        self.playing = False
+
+    def play(self, loops=0, start=0.0):
+        self.remaining = self.lengths[self.current] - start * 1000
+        self.queued = None
+        self.playing = True
+        self.start = monotonic()
+        self.last = 0
+
+    def stop(self):
+        self.playing = False
+
+    def queue(self, filename):
+        self.queued = filename
+
+    def get_busy(self):
+        self.Advance()
+        return self.playing
+
+    def get_volume(self):
+        return 1.0
+
+    def Elapsed(self):
+        """Get how far the current file has really played, in ms"""
+        return (monotonic() - self.start) * 1000 * (1 + self.skew)
+
+    def Advance(self):
+        """Move on to the queued file if the current one has finished"""
+        while self.playing and self.Elapsed() >= self.remaining:
+            if self.queued is None:
+                self.playing = False
+                break
+            self.start += self.remaining / 1000 / (1 + self.skew)
+            self.current = self.queued
+            self.queued = None
+            self.remaining = self.lengths[self.current]
+            self.last = 0
+
+    def get_pos(self):
+        self.Advance()
+        if not self.playing:
+            return -1
+        pos = self.Elapsed() + random.uniform(-self.jitter, self.jitter)
+        self.last = max(self.last, int(pos // self.quantum * self.quantum))
+        return self.last
+
+
+def measureDrift(clock, mixerPos, duration, interval=50):
+    """Compare a playback clock with the mixer over a whole song
+
+    Args:
+        clock (PlaybackClock): running clock to measure
+        mixerPos (callable): returns the mixer's position in ms
+        duration (int): how long to measure for, in ms
+        interval (int): ms between samples
+
+    Returns:
+        dict. Statistics about the difference between clock and mixer
+        positions, in ms: "samples", "mean", "max", and "final" (the
+        average difference over the last second).
+    """
+    errors = []
+    start = monotonic()
+    while (monotonic() - start) * 1000 < duration:
+        time.sleep(interval / 1000)
+        pos = mixerPos()
+        errors.append(pos - clock.Tell())
+        clock.Correct(pos)
+    tail = errors[-max(1, 1000 // interval):]
+    return {'samples': len(errors),
+            'mean': sum(abs(e) for e in errors) / len(errors),
+            'max': max(abs(e) for e in errors),
+            'final': sum(tail) / len(tail)}
+
+
+def checkHandover(lengths=(3000, 3000), interval=50):
+    """Play one simulated file into another through a Player
+
+    Returns:
+        float. How far the player's position in the second file was from
+        where it had really got to once the player noticed the handover,
+        in ms; None if the player never switched to the second file.
+    """
+    import kchan.player as player
+    from kchan.probe import AudioInfo
+
+    music = SimulatedMixer(lengths={'first': lengths[0],
+                                    'second': lengths[1]})
+    saved = (player.mixer, player.music, player.mixerError)
+    player.mixer, player.music, player.mixerError = (music, music,
+                                                     Exception)
+    try:
+        p = player.Player(lambda: None)
+        p.Probe = lambda filename: (
+            AudioInfo(music.lengths[filename], 44100, 2), False)
+        p.Load('first')
+        p.Play()
+        p.Enqueue('second', p.Probe('second')[0])
+        while not p.CheckQueue():
+            if p.Ended():
+                return None
+            time.sleep(interval / 1000)
+        return p.Tell() - music.Elapsed()
+    finally:
+        player.mixer, player.music, player.mixerError = saved
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description='Measure playback clock drift against the mixer')
+    argparser.add_argument('filepath', nargs='?',
+                           help='song to play; if not given, a simulated '
+                           'mixer is used')
+    argparser.add_argument('--duration', type=float, default=None,
+                           help='seconds to measure for (default: the '
+                           'whole song, or 60 s when simulating)')
+    argparser.add_argument('--interval', type=int, default=50,
+                           help='ms between samples')
+    argparser.add_argument('--handover', action='store_true',
+                           help='check that the position follows a '
+                           'simulated mixer from one file into the next '
+                           'queued one, instead of measuring drift')
+    args = argparser.parse_args()
+
+    if args.handover:
+        error = checkHandover(interval=args.interval)
+        if error is None:
+            print 'The queued file was never switched to'
+            sys.exit(1)
+        print 'Position error after switching files: {:.1f} ms'.format(error)
+        return
+
+    if args.filepath is None:
+        mixer = SimulatedMixer()
+        clock = PlaybackClock()
+        clock.Start(0)
+        mixerPos = mixer.get_pos
+        duration = (args.duration or 60) * 1000
+    else:
+        import kchan.player as player
+        p = player.Player(lambda: None)
+        p.Load(args.filepath)
+        p.Play()
+        clock = p.clock
+        mixerPos = p.MixerPos
+        duration = (args.duration * 1000 if args.duration
+                    else p.Length())
+
+    stats = measureDrift(clock, mixerPos, duration, args.interval)
+    print ('{samples} samples: mean error {mean:.1f} ms, max error '
+           '{max:.1f} ms, error over last second {final:.1f} ms'.format(
+               **stats))
+
+
+if __name__ == '__main__':
+    main()
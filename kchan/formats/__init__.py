@@ -0,0 +1,61 @@
+"""Readers for the places lyrics can be stored
+
+Each reader has a loadFile(filepath) function returning a Lyrics
+instance, and raising ValueError if it doesn't find any lyrics or
+IOError if it can't read them.
+"""
+
+import os.path
+import collections
+
+from kchan.formats import lyrics3v2, id3v2, lrc
+
+Reader = collections.namedtuple('Reader', ['name', 'extensions', 'loadFile'])
+
+# Readers in the order they're tried. Lyrics3 comes first since it's
+# what the editor saves to, and it only takes one read at the end of the
+# file; the ID3v2 reader only reads the tag at the start of the file;
+# the sidecar comes last since it's usually an export of one of the others.
+READERS = [
+    Reader('Lyrics3', ('.mp3',), lyrics3v2.loadFile),
+    Reader('ID3v2', ('.mp3',), id3v2.loadFile),
+    Reader('LRC', None, lrc.loadFile),
+]
+
+
+def register(name, extensions, loadFile):
+    """Add a reader, to be tried after all the existing ones
+
+    Args:
+        name (str): name of the format
+        extensions (tuple): lowercase extensions, including the dot, of
+            the media files the reader applies to; None for all files
+        loadFile (callable): called with the pathname of a media file,
+            returns a Lyrics instance
+    """
+    READERS.append(Reader(name, extensions, loadFile))
+
+
+def loadFile(filepath, exclude=()):
+    """Get the lyrics for a media file from wherever they're stored
+
+    Args:
+        filepath (str): pathname of the media file
+
+    Kwargs:
+        exclude (collection): names of formats not to try
+
+    Returns:
+        (Lyrics, str). The lyrics and the name of the format they were
+        found in, or (None, None) if no reader found any.
+    """
+    ext = os.path.splitext(filepath)[1].lower()
+    for reader in READERS:
+        if reader.name in exclude or (reader.extensions is not None
+                                      and ext not in reader.extensions):
+            continue
+        try:
+            return (reader.loadFile(filepath), reader.name)
+        except (IOError, ValueError):
+            pass
+    return (None, None)
@@ -0,0 +1,242 @@
+#! /usr/bin/python2
+
+import zlib
+import struct
+
+import kchan.timedtext as timedtext
+import kchan.perf as perf
+from kchan.lyrics import Lyrics
+
+HEADER_LENGTH = 10
+ID3_START = "ID3"
+
+# Tag header flags
+UNSYNC_FLAG = 0x80
+EXTENDED_HEADER_FLAG = 0x40
+
+# Synchronized and unsynchronized lyrics frames, by major version
+SYLT_IDS = {2: "SLT", 3: "SYLT", 4: "SYLT"}
+USLT_IDS = {2: "ULT", 3: "USLT", 4: "USLT"}
+
+# SYLT timestamp format for milliseconds (the other is MPEG frames)
+MILLISECONDS = 2
+
+# Text encodings, with the terminator of a string in each one
+ENCODINGS = {0: ('latin-1', '\0'), 1: ('utf-16', '\0\0'),
+             2: ('utf-16-be', '\0\0'), 3: ('utf-8', '\0')}
+
+
+def syncsafe(data):
+    """Decode a syncsafe integer, which has 7 bits in each byte"""
+    value = 0
+    for c in data:
+        value = (value << 7) | (ord(c) & 0x7f)
+    return value
+
+
+def unsync(data):
+    """Undo the unsynchronisation scheme"""
+    return data.replace('\xff\x00', '\xff')
+
+
+def frames(f, wanted):
+    """Find frames in an ID3v2 tag, reading only the ones that are wanted
+
+    Frames that aren't wanted are skipped over without being read, so
+    large frames such as pictures cost nothing.
+
+    Args:
+        f (file): file positioned at the start of an ID3v2 tag
+        wanted (function): called with the major version of the tag,
+            returns a collection of the frame ids to read
+
+    Returns:
+        list. A list of pairs (frameId, data) for the wanted frames, in
+        the order they appear; data is decompressed and has had any
+        unsynchronisation removed.
+
+    Raises:
+        ValueError: there's no ID3v2 tag
+    """
+    header = f.read(HEADER_LENGTH)
+    if len(header) < HEADER_LENGTH or not header.startswith(ID3_START):
+        raise ValueError, "No ID3v2 tag found"
+    version = ord(header[3])
+    flags = ord(header[5])
+    size = syncsafe(header[6:10])
+    if version not in SYLT_IDS:
+        raise ValueError, "Unsupported ID3v2 version 2.{}".format(version)
+    frameIds = wanted(version)
+
+    if flags & UNSYNC_FLAG and version < 4:
+        # The whole tag has to be decoded before frames can be found
+        # (ID3v2.4 unsynchronises frames individually instead)
+        import StringIO
+        f = StringIO.StringIO(unsync(f.read(size)))
+    start = f.tell()
+    end = start + size
+
+    if flags & EXTENDED_HEADER_FLAG and version >= 3:
+        extended = f.read(4)
+        if version == 3:
+            f.seek(struct.unpack('>I', extended)[0], 1)
+        else:
+            f.seek(syncsafe(extended) - 4, 1)
+
+    idLength, headerLength = (3, 6) if version == 2 else (4, 10)
+    result = []
+    while f.tell() + headerLength <= end:
+        frameHeader = f.read(headerLength)
+        frameId = frameHeader[:idLength]
+        if len(frameHeader) < headerLength or not frameId.strip('\0'):
+            # padding
+            break
+        if version == 2:
+            frameSize = struct.unpack('>I', '\0' + frameHeader[3:6])[0]
+            frameFlags = 0
+        elif version == 3:
+            frameSize = struct.unpack('>I', frameHeader[4:8])[0]
+            frameFlags = struct.unpack('>H', frameHeader[8:10])[0]
+        else:
+            frameSize = syncsafe(frameHeader[4:8])
+            frameFlags = struct.unpack('>H', frameHeader[8:10])[0]
+        if f.tell() + frameSize > end:
+            break
+        if frameId not in frameIds:
+            f.seek(frameSize, 1)
+            continue
+
+        data = f.read(frameSize)
+        try:
+            result.append((frameId, frameData(version, frameFlags, data)))
+        except (ValueError, zlib.error):
+            # encrypted or corrupt; try the other frames
+            pass
+    return result
+
+
+def frameData(version, flags, data):
+    """Undo the compression and unsynchronisation of a frame's data"""
+    if version == 3:
+        compressed, encrypted, grouped = 0x80, 0x40, 0x20
+        unsynced = lengthIndicator = 0
+        if flags & compressed:
+            # decompressed size comes before the data
+            data = data[4:]
+    elif version == 4:
+        compressed, encrypted, grouped = 0x08, 0x04, 0x40
+        unsynced, lengthIndicator = 0x02, 0x01
+    else:
+        return data
+
+    if flags & encrypted:
+        raise ValueError, "Encrypted frame"
+    if flags & grouped:
+        data = data[1:]
+    if flags & lengthIndicator:
+        data = data[4:]
+    if flags & unsynced:
+        data = unsync(data)
+    if flags & compressed:
+        data = zlib.decompress(data)
+    return data
+
+
+def splitString(data, encoding):
+    """Split a terminated string off the start of some frame data
+
+    Returns:
+        (str, str). The string, converted to UTF-8, and the rest of the data.
+    """
+    codec, terminator = ENCODINGS[encoding]
+    pos = data.find(terminator)
+    while pos != -1 and pos % len(terminator):
+        # UTF-16 terminators must be aligned with the characters
+        pos = data.find(terminator, pos + 1)
+    if pos == -1:
+        return (decode(data, codec), '')
+    return (decode(data[:pos], codec), data[pos+len(terminator):])
+
+
+def decode(data, codec):
+    return data.decode(codec, 'replace').encode('utf-8')
+
+
+def loadSylt(data):
+    """Parse the data of a SYLT frame into a Lyrics instance
+
+    Raises:
+        ValueError: the timestamps aren't in milliseconds, or there are
+            no lyrics
+    """
+    if len(data) < 6 or ord(data[0]) not in ENCODINGS:
+        raise ValueError, "Malformed SYLT frame"
+    encoding = ord(data[0])
+    if ord(data[4]) != MILLISECONDS:
+        raise ValueError, "SYLT timestamps aren't in milliseconds"
+    descriptor, data = splitString(data[6:], encoding)
+
+    phrases = []
+    while len(data) > 4:
+        text, data = splitString(data, encoding)
+        if len(data) < 4:
+            break
+        time = struct.unpack('>I', data[:4])[0]
+        data = data[4:]
+        # phrases conventionally start with the newline before them
+        # rather than ending with the one after them
+        if text.startswith('\n') and phrases:
+            phrases[-1][0] += '\n'
+            text = text[1:]
+        phrases.append([text, [time // 10]])
+    if not phrases:
+        raise ValueError, "Empty SYLT frame"
+    return Lyrics.fromPhrases(phrases)
+
+
+def loadUslt(data):
+    """Parse the data of a USLT frame into a Lyrics instance
+
+    Text with LRC-style timestamps is timed; anything else becomes a
+    single phrase starting at 00:00.
+    """
+    if len(data) < 4 or ord(data[0]) not in ENCODINGS:
+        raise ValueError, "Malformed USLT frame"
+    encoding = ord(data[0])
+    descriptor, data = splitString(data[4:], encoding)
+    text, data = splitString(data, encoding)
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    if not text.strip():
+        raise ValueError, "Empty USLT frame"
+    return timedtext.load(text)
+
+
+@perf.timed('id3v2.loadFile')
+def loadFile(filepath):
+    """Get the lyrics from the ID3v2 tag at the start of a file
+
+    Only the tag is read, and of its frames only the lyrics. Synchronized
+    (SYLT) lyrics are used if there are any, otherwise unsynchronized
+    (USLT) ones.
+
+    Args:
+        filepath (str): pathname of the file
+
+    Returns:
+        Lyrics instance.
+
+    Raises:
+        ValueError: the file has no ID3v2 tag, or no lyrics in it
+        IOError: the file can't be read
+    """
+    with open(filepath, 'rb') as f:
+        found = frames(f, lambda version: (SYLT_IDS[version],
+                                           USLT_IDS[version]))
+    for (loadFrame, ids) in ((loadSylt, SYLT_IDS), (loadUslt, USLT_IDS)):
+        for (frameId, data) in found:
+            if frameId in ids.values():
+                try:
+                    return loadFrame(data)
+                except ValueError:
+                    pass
+    raise ValueError, "No lyrics in ID3v2 tag"
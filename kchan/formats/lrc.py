@@ -0,0 +1,103 @@
+#! /usr/bin/python2
+
+import os
+import re
+
+import kchan.timedtext as timedtext
+import kchan.perf as perf
+from kchan.lyrics import Lyrics
+
+EXTENSION = '.lrc'
+
+# LRC ID tags that map onto Lyrics metadata
+METADATA_TAGS = [("title", "ti"), ("artist", "ar"), ("album", "al")]
+
+# A line consisting of just an ID tag, e.g. [ar:Artist]
+ID_TAG_RE = re.compile(r"^\[([a-z#]+):(.*)\][ \t\r]*\n?", re.MULTILINE)
+# Timestamps as LRC files write them, with any number of digits of
+# minutes and an optional fraction of one to three digits after a dot or
+# colon; timedtext only accepts [mm:ss] and [mm:ss.xx]
+TIMESTAMP_RE = re.compile(r"\[(\d+):(\d\d)(?:[.:](\d{1,3}))?\]")
+
+UTF8_BOM = '\xef\xbb\xbf'
+
+
+def sidecarPath(filepath):
+    """Get the pathname of the .lrc file that goes with a media file"""
+    return os.path.splitext(filepath)[0] + EXTENSION
+
+
+def normalizeTimestamp(m):
+    minutes, seconds, fraction = m.groups()
+    if int(minutes) >= 100:
+        raise ValueError, "LRC timestamp {} too late".format(m.group(0))
+    # the fraction is of a second, so [00:01.5] is 50 hundredths
+    hundredths = (fraction or '').ljust(2, '0')[:2]
+    return "[{:02}:{}.{}]".format(int(minutes), seconds, hundredths)
+
+
+def load(data):
+    """Parse the contents of an LRC file
+
+    ID tags are used for metadata, and an [offset:...] tag is applied to
+    the timestamps; fractions of a second beyond hundredths are dropped.
+
+    Args:
+        data (str): contents of the file
+
+    Returns:
+        Lyrics instance.
+
+    Raises:
+        ValueError: there are no lyrics, or a timestamp is 100 minutes
+            or more, which timedtext can't represent
+    """
+    if data.startswith(UTF8_BOM):
+        data = data[len(UTF8_BOM):]
+    tags = dict((m.group(1), m.group(2).strip())
+                for m in ID_TAG_RE.finditer(data))
+    text = TIMESTAMP_RE.sub(normalizeTimestamp, ID_TAG_RE.sub('', data))
+    if not text.strip():
+        raise ValueError, "No lyrics in LRC file"
+
+    lyrics = timedtext.load(text)
+    try:
+        # a positive offset makes the lyrics appear sooner
+        offset = int(tags.get("offset", 0)) // 10
+    except ValueError:
+        offset = 0
+    if offset:
+        timedPhrases = [[phrase, [], lyrics.getWords(idx)]
+                        for (idx, phrase) in enumerate(lyrics.getPhrases())]
+        for (time, idx) in lyrics.getTimes():
+            timedPhrases[idx][1].append(max(time - offset, 0))
+        lyrics = Lyrics.fromPhrases(timedPhrases)
+    lyrics.setMetadata(**dict((key, tags[tag])
+                              for (key, tag) in METADATA_TAGS if tag in tags))
+    return lyrics
+
+
+def dump(lyrics):
+    """Dump a Lyrics instance in LRC format, including metadata tags"""
+    metadata = lyrics.getMetadata()
+    header = ''.join('[{}:{}]\n'.format(tag, metadata[key])
+                     for (key, tag) in METADATA_TAGS if key in metadata)
+    return header + timedtext.dump(lyrics, frac=True, words=True)
+
+
+@perf.timed('lrc.loadFile')
+def loadFile(filepath):
+    """Get the lyrics from the .lrc file next to a media file
+
+    Raises:
+        ValueError: there's no .lrc file, or it has no lyrics
+        IOError: the .lrc file can't be read
+    """
+    try:
+        with open(sidecarPath(filepath), 'rb') as f:
+            data = f.read()
+    except IOError:
+        if not os.path.exists(sidecarPath(filepath)):
+            raise ValueError, "No LRC file"
+        raise
+    return load(data)
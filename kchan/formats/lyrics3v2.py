@@ -1,6 +1,14 @@
 #! /usr/bin/python2
 
+from __future__ import division
+
+import os
+import time
+import collections
+from multiprocessing.pool import ThreadPool
+
 import kchan.timedtext as timedtext
+import kchan.perf as perf
 
 ID3_START = "TAG"
 ID3_LENGTH = 128
@@ -11,12 +19,33 @@ END_TAG = "LYRICS200"
 
 SIZE_OFFSET = -(SIZE_LENGTH + len(END_TAG) + ID3_LENGTH)
 
+# Suffix of the journal file that write() keeps next to the file it's
+# modifying
+JOURNAL_SUFFIX = ".l3journal"
+
+# Number of bytes read from the end of a file in one go; tags that fit
+# in this need no further reads
+TAIL_READ_LENGTH = 1 << 16
+
+# Default number of files readMany reads concurrently
+READ_THREADS = 16
+
 FIELD_ID_LENGTH = 3
 FIELD_SIZE_LENGTH = 5
 
+# Lyrics3 v2.00 fields holding song metadata, and the corresponding
+# Lyrics metadata keys
+METADATA_FIELD_IDS = {"EAL": "album", "EAR": "artist", "ETT": "title"}
+
+ReadResult = collections.namedtuple('ReadResult', ['filepath', 'lyrics', 'error'])
+
+@perf.timed('lyrics3v2.read')
 def read(filepath):
     """Read Lyrics3 v2.00 data from an mp3 file
 
+    The end of the file is fetched with a single bounded read, which
+    will contain the whole tag unless it's unusually large.
+
     Args:
         filepath (str): pathname of mp3 file containing Lyrics3 v2.00 data
 
@@ -29,33 +58,93 @@ def read(filepath):
     """
 
     with open(filepath, 'rb') as f:
-        f.seek(SIZE_OFFSET, 2)
+        f.seek(0, 2)
+        tailLength = min(f.tell(), TAIL_READ_LENGTH)
+        f.seek(-tailLength, 2)
+        tail = f.read(tailLength)
+
+        if tailLength < -SIZE_OFFSET:
+            raise ValueError, "Lyrics3 v2.00 size field not found in file {}".format(filepath)
         size = 0
         try:
-            size = int(f.read(SIZE_LENGTH))
+            size = int(tail[SIZE_OFFSET:SIZE_OFFSET + SIZE_LENGTH])
         except ValueError:
             raise ValueError, "Lyrics3 v2.00 size field not found in file {}".format(filepath)
-        if f.read(len(END_TAG)) != END_TAG:
+        if tail[SIZE_OFFSET + SIZE_LENGTH:-ID3_LENGTH] != END_TAG:
             raise ValueError, "Lyrics3 v2.00 tag not found in file {}".format(filepath)
 
+        if size <= tailLength + SIZE_OFFSET:
+            return tail[SIZE_OFFSET - size:SIZE_OFFSET]
+
+        # Tag is bigger than what we read, go back for the rest of it
         f.seek(SIZE_OFFSET - size, 2)
         return f.read(size)
 
+def readMany(filepaths, kcl=True, threads=READ_THREADS):
+    """Read and parse Lyrics3 v2.00 lyrics from many mp3 files at once
+
+    Files are read concurrently, so this is much faster than calling
+    read() in a loop when the files are on slow or networked storage.
+
+    Args:
+        filepaths (iterable): pathnames of mp3 files
+
+    Kwargs:
+        kcl (bool): passed on to load()
+        threads (int): number of files to read at a time
+
+    Returns:
+        (list, float). A list of ReadResult tuples, one per file in the
+        same order as filepaths, and the overall throughput in files per
+        second::
+            filepath (str): pathname of the file
+            lyrics (Lyrics): parsed lyrics, or None if there was an error
+            error (Exception): error raised while reading or parsing the
+                file (IOError or ValueError), or None if successful
+    """
+    def readOne(filepath):
+        try:
+            return ReadResult(filepath, load(read(filepath), kcl=kcl), None)
+        except (IOError, ValueError) as e:
+            return ReadResult(filepath, None, e)
+
+    filepaths = list(filepaths)
+    startTime = time.time()
+    pool = ThreadPool(max(1, min(threads, len(filepaths))))
+    try:
+        results = pool.map(readOne, filepaths)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - startTime
+
+    return (results, len(results) / elapsed if elapsed > 0 else 0.0)
+
 def write(filepath, lyricsData):
     """Write Lyrics3 v2.00 data to an mp3 file
 
+    The original end of the file is saved to a journal before the file
+    is truncated, so that recover() can undo a write that was
+    interrupted partway through.
+
     Args:
         filepath (str): pathname of mp3 file to write data to
         lyricsData (str): Lyrics3 v2.00 data, including "LYRICSBEGIN"
             but not including size descriptor and "LYRICS200" string.
+
+    Returns:
+        bool. False if the file already ended with exactly this data and
+        was left untouched, True otherwise.
     """
     if len(lyricsData) >= 10**SIZE_LENGTH:
         raise ValueError, "Lyrics data too long"
 
     lyricsData = lyricsData + "{{:0{}}}".format(SIZE_LENGTH).format(len(lyricsData)) + END_TAG
 
-    with open(filepath, 'r+ab') as f:
-        # first, remove existing Lyrics3 and ID3 data, saving ID3
+    recover(filepath)
+
+    with open(filepath, 'r+b') as f:
+        # first, find existing Lyrics3 and ID3 data, saving ID3
         # data if it's there
         f.seek(-ID3_LENGTH, 2)
         id3 = f.read(ID3_LENGTH)
@@ -74,17 +163,121 @@ def write(filepath, lyricsData):
             else:
                 # Just ID3, truncate at start of ID3
                 f.seek(-ID3_LENGTH, 2)
-            f.truncate()
         else:
             id3 = ID3_START + ('\0' * (ID3_LENGTH - len(ID3_START)))
+            f.seek(0, 2)
+
+        offset = f.tell()
+        oldTail = f.read()
+        newTail = lyricsData + id3
+        if oldTail == newTail:
+            return False
+
+        # Keep a copy of what we're about to overwrite until the new
+        # data is safely on disk
+        writeJournal(filepath, offset, oldTail)
+
+        # Truncate the file so that it contains no Lyrics3 or ID3
+        # data; then add in our Lyrics3 data and an ID3 tag.
+        f.seek(offset)
+        f.truncate()
+        f.write(newTail)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.remove(filepath + JOURNAL_SUFFIX)
+    return True
+
+def writeJournal(filepath, offset, tail):
+    """Atomically save the tail of a file before it gets overwritten
+
+    Args:
+        filepath (str): pathname of the file about to be modified
+        offset (int): position in the file where tail starts
+        tail (str): original contents of the file from offset onwards
+    """
+    journalPath = filepath + JOURNAL_SUFFIX
+    tmpPath = journalPath + '.tmp'
+    with open(tmpPath, 'wb') as j:
+        j.write('{}\n'.format(offset))
+        j.write(tail)
+        j.flush()
+        os.fsync(j.fileno())
+    os.rename(tmpPath, journalPath)
+
+def recover(filepath):
+    """Undo an interrupted write() using its journal, if there is one
+
+    Args:
+        filepath (str): pathname of mp3 file
 
-        # Our file has now been truncated so that it contains no
-        # Lyrics3 or ID3 data; now we add in our Lyrics3 data and an
-        # ID3 tag.
-        f.write(lyricsData + id3)
+    Returns:
+        bool. True if the file was restored from a journal.
+    """
+    journalPath = filepath + JOURNAL_SUFFIX
+    if not os.path.exists(journalPath):
+        return False
+
+    with open(journalPath, 'rb') as j:
+        offset = int(j.readline())
+        tail = j.read()
+
+    with open(filepath, 'r+b') as f:
+        f.seek(offset)
+        f.truncate()
+        f.write(tail)
         f.flush()
-        f.close()
+        os.fsync(f.fileno())
+
+    os.remove(journalPath)
+    return True
+
+def fields(lyricsData):
+    """Locate the fields in Lyrics3 v2.00 data without copying them
+
+    All field headers are checked before anything is returned, so
+    malformed data is rejected before any field gets decoded.
+
+    Args:
+        lyricsData (str): Lyrics3 v2.00 data, including "LYRICSBEGIN"
+            but not including size descriptor and "LYRICS200" string.
+
+    Returns:
+        list. A list of pairs (fieldId, (start, end)), in the order the
+        fields appear in the data::
+            fieldId (str): three-character field identifier
+            start, end (int): offsets of the field contents in lyricsData
+
+    Raises:
+        ValueError: data isn't valid Lyrics3 v2.00 data
+    """
+    if not lyricsData.startswith(START_TAG):
+        raise ValueError, "Not valid Lyrics3 v2.00 data"
 
+    headerLength = FIELD_ID_LENGTH + FIELD_SIZE_LENGTH
+    dataLength = len(lyricsData)
+    pos = len(START_TAG)
+    spans = []
+
+    while pos < dataLength:
+        if pos + headerLength > dataLength:
+            raise ValueError, "Truncated Lyrics3 v2.00 field header"
+        fieldId = lyricsData[pos:pos + FIELD_ID_LENGTH]
+        sizeField = lyricsData[pos + FIELD_ID_LENGTH:pos + headerLength]
+        if not sizeField.isdigit():
+            raise ValueError, "Invalid size for Lyrics3 v2.00 field {}".format(
+                repr(fieldId))
+        start = pos + headerLength
+        end = start + int(sizeField)
+        if end > dataLength:
+            raise ValueError, "Lyrics3 v2.00 field {} overruns tag".format(
+                repr(fieldId))
+        spans.append((fieldId, (start, end)))
+        pos = end
+
+    return spans
+
+@perf.timed('lyrics3v2.load')
 def load(lyricsData, kcl=True):
     """Parse Lyrics3 v2.00 data
 
@@ -105,45 +298,38 @@ def load(lyricsData, kcl=True):
         ValueError: data isn't valid Lyrics3 v2.00 data or doesn't contain any
             LYR field
     """
-    if not lyricsData.startswith(START_TAG):
-        raise ValueError, "Not valid Lyrics3 v2.00 data"
-
-    lyricsData = lyricsData[len(START_TAG):]
-
-    lyrLyrics = None
-    kclLyrics = None
+    lyrSpan = None
+    kclSpan = None
     metadata = {}
 
-    while lyricsData:
-        fieldId = lyricsData[:FIELD_ID_LENGTH]
-        lyricsData = lyricsData[FIELD_ID_LENGTH:]
-
-        fieldSize = int(lyricsData[:FIELD_SIZE_LENGTH])
-        lyricsData = lyricsData[FIELD_SIZE_LENGTH:]
-
-        fieldData = lyricsData[:fieldSize]
-        lyricsData = lyricsData[fieldSize:]
-
+    for (fieldId, (start, end)) in fields(lyricsData):
         if fieldId == "LYR":
-            lyrLyrics = timedtext.load(fieldData)
+            lyrSpan = (start, end)
         elif fieldId == "KCL":
-            kclLyrics = timedtext.load(fieldData)
-        elif fieldId == "EAL":
-            metadata["album"] = fieldData
-        elif fieldId == "EAR":
-            metadata["artist"] = fieldData
-        elif fieldId == "ETT":
-            metadata["title"] = fieldData
+            kclSpan = (start, end)
+        elif fieldId in METADATA_FIELD_IDS:
+            metadata[METADATA_FIELD_IDS[fieldId]] = lyricsData[start:end]
         else:
             pass
 
-    lyrics = (kclLyrics if kcl else None) or lyrLyrics
-    if lyrics is None:
+    # Only the lyrics field we're actually going to use gets parsed
+    span = (kclSpan if kcl else None) or lyrSpan
+    if span is None:
         raise ValueError, "Lyrics not found"
 
+    lyrics = timedtext.load(lyricsData[span[0]:span[1]])
     lyrics.setMetadata(**metadata)
     return lyrics
 
+def loadFile(filepath):
+    """Get the lyrics from the Lyrics3 v2.00 tag of an mp3 file
+
+    Raises:
+        ValueError: the file has no Lyrics3 v2.00 tag, or no lyrics in it
+        IOError: the file can't be read
+    """
+    return load(read(filepath))
+
 def dump(lyrics, kcl=True):
     """Dump data from Lyrics instance to Lyrics3 v2.00 format
 
@@ -152,8 +338,8 @@ def dump(lyrics, kcl=True):
 
     Kwargs:
         kcl (bool): Include KCL lyrics in addition to LYR lyrics;
-        this allows us to include higher-precision timestamps in a
-        backwards-compatible way.
+        this allows us to include higher-precision timestamps and
+        word timing in a backwards-compatible way.
 
     Returns:
         str. String containing Lyrics3 v2.00 data, including "LYRICSBEGIN"
@@ -169,7 +355,7 @@ def dump(lyrics, kcl=True):
               + lyrData)
 
     if kcl:
-        kclData = timedtext.dump(lyrics, frac=True)
+        kclData = timedtext.dump(lyrics, frac=True, words=True)
         if len(kclData) >= 10**FIELD_SIZE_LENGTH:
             raise ValueError, "Lyrics too long"
         lyrics3Data += ("KCL{{:0{}}}".format(FIELD_SIZE_LENGTH).format(len(kclData))
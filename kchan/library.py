@@ -0,0 +1,347 @@
+#! /usr/bin/python2
+
+import os
+import sqlite3
+import argparse
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import kchan.formats as formats
+import kchan.search as search
+from kchan.probe import probe
+
+# File extensions that are indexed when scanning for songs
+MEDIA_EXTENSIONS = ('.mp3',)
+
+DEFAULT_DB_PATH = os.path.join(os.path.expanduser('~'), '.karaokechan',
+                               'library.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS songs (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    duration INTEGER,
+    title TEXT,
+    artist TEXT,
+    album TEXT,
+    lyrics INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS roots (
+    path TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS lines (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    time INTEGER,
+    line TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS lines_path ON lines (path);
+CREATE VIRTUAL TABLE IF NOT EXISTS lines_fts USING fts4 (words, compact);
+"""
+
+SONG_COLUMNS = ['path', 'size', 'mtime', 'duration', 'title', 'artist',
+                'album', 'lyrics', 'error']
+
+# Maximum number of results returned by Library.search
+SEARCH_LIMIT = 100
+
+SearchResult = collections.namedtuple('SearchResult',
+                                      ['path', 'title', 'time', 'line'])
+
+
+def findMedia(roots):
+    """Walk directory trees looking for media files
+
+    Args:
+        roots (list): pathnames of directories to search
+
+    Returns:
+        generator. Yields the pathname of every media file found.
+    """
+    for root in roots:
+        for (dirpath, dirnames, filenames) in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if os.path.splitext(filename)[1].lower() in MEDIA_EXTENSIONS:
+                    yield os.path.join(dirpath, filename)
+
+
+def scanFile(filepath):
+    """Extract the library metadata for a single file
+
+    This runs in a worker process, so it only returns plain data.
+
+    Args:
+        filepath (str): pathname of a media file
+
+    Returns:
+        dict. Values for the columns in SONG_COLUMNS, plus "lines", the
+        list returned by kchan.search.lines() for the file's lyrics.
+    """
+    st = os.stat(filepath)
+    song = {'path': filepath, 'size': st.st_size, 'mtime': st.st_mtime,
+            'duration': None, 'title': None, 'artist': None, 'album': None,
+            'lyrics': 0, 'error': None, 'lines': []}
+
+    try:
+        # probe() imports audioread itself, so the library can be used
+        # on machines without an audio backend
+        song['duration'] = probe(filepath).duration
+    except Exception as e:
+        song['error'] = 'probe failed: {}'.format(e)
+
+    lyrics, source = formats.loadFile(filepath)
+    if lyrics is not None:
+        metadata = lyrics.getMetadata()
+        song['lyrics'] = 1
+        song['lines'] = search.lines(lyrics)
+        for key in ('title', 'artist', 'album'):
+            song[key] = metadata.get(key)
+
+    return song
+
+
+def scanFileSafe(filepath):
+    try:
+        return scanFile(filepath)
+    except (IOError, OSError):
+        return None
+
+
+class Library(object):
+    """Index of songs and their metadata, stored in an SQLite database"""
+
+    def __init__(self, dbpath=DEFAULT_DB_PATH):
+        dbdir = os.path.dirname(dbpath)
+        if dbdir and not os.path.isdir(dbdir):
+            os.makedirs(dbdir)
+        self.db = sqlite3.connect(dbpath)
+        # Paths and Lyrics3 fields are byte strings
+        self.db.text_factory = str
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def roots(self):
+        """Get the directories the library is built from"""
+        return [row[0] for row in
+                self.db.execute('SELECT path FROM roots ORDER BY path')]
+
+    def addRoot(self, dirpath):
+        """Add a directory to the ones scanned by default"""
+        self.db.execute('INSERT OR IGNORE INTO roots VALUES (?)',
+                        (os.path.abspath(dirpath),))
+        self.db.commit()
+
+    def songs(self):
+        """Get every song in the library
+
+        Returns:
+            list. A list of sqlite3.Row objects with the columns in
+            SONG_COLUMNS, sorted by path.
+        """
+        return self.db.execute('SELECT * FROM songs ORDER BY path').fetchall()
+
+    def song(self, filepath):
+        """Get the library entry for a file, or None if it isn't indexed"""
+        return self.db.execute('SELECT * FROM songs WHERE path = ?',
+                               (filepath,)).fetchone()
+
+    def update(self, song):
+        """Add or replace the entry for a song
+
+        Args:
+            song (dict): values for the columns in SONG_COLUMNS, as
+                returned by scanFile()
+        """
+        self.db.execute(
+            'INSERT OR REPLACE INTO songs ({}) VALUES ({})'.format(
+                ', '.join(SONG_COLUMNS), ', '.join('?' * len(SONG_COLUMNS))),
+            [song[c] for c in SONG_COLUMNS])
+        self.removeLines(song['path'])
+        for (time, line) in song['lines']:
+            tokens = search.normalize(line)
+            if not tokens:
+                continue
+            rowid = self.db.execute(
+                'INSERT INTO lines (path, time, line) VALUES (?, ?, ?)',
+                (song['path'], time, line)).lastrowid
+            self.db.execute(
+                'INSERT INTO lines_fts (docid, words, compact) '
+                'VALUES (?, ?, ?)',
+                (rowid, u' '.join(tokens), u''.join(tokens)))
+
+    def removeLines(self, filepath):
+        self.db.execute('DELETE FROM lines_fts WHERE docid IN '
+                        '(SELECT id FROM lines WHERE path = ?)', (filepath,))
+        self.db.execute('DELETE FROM lines WHERE path = ?', (filepath,))
+
+    def remove(self, filepath):
+        self.removeLines(filepath)
+        self.db.execute('DELETE FROM songs WHERE path = ?', (filepath,))
+
+    def refresh(self, filepath):
+        """Re-examine a single file, if it's in the library
+
+        Returns:
+            bool. True if the file was in the library.
+        """
+        if self.song(filepath) is None:
+            return False
+        try:
+            self.update(scanFile(filepath))
+        except (IOError, OSError):
+            self.remove(filepath)
+        self.db.commit()
+        return True
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Find lyric lines matching a query
+
+        Matching ignores case, punctuation, and the difference between
+        kana and romaji; the last word of the query may be incomplete.
+
+        Args:
+            query (str or unicode): words to search for
+
+        Kwargs:
+            limit (int): maximum number of results
+
+        Returns:
+            list. A list of SearchResult tuples::
+                path (str): pathname of the song
+                title (str): title of the song, or None
+                time (int): time the line is sung in hundredths of a
+                    second, or None if unknown
+                line (str): the matching line
+        """
+        results = []
+        seen = set()
+        for match in search.matchQueries(query):
+            rows = self.db.execute(
+                'SELECT lines.id, lines.path, songs.title, lines.time, '
+                'lines.line FROM lines_fts '
+                'JOIN lines ON lines.id = lines_fts.docid '
+                'JOIN songs ON songs.path = lines.path '
+                'WHERE lines_fts MATCH ? ORDER BY lines.path, lines.time '
+                'LIMIT ?', (match, limit))
+            for row in rows:
+                if row[0] not in seen and len(results) < limit:
+                    seen.add(row[0])
+                    results.append(SearchResult(*tuple(row)[1:]))
+        return results
+
+    def stale(self, filepaths):
+        """Find the files whose library entries are missing or out of date
+
+        Args:
+            filepaths (iterable): pathnames of media files
+
+        Returns:
+            generator. Yields the pathnames whose size or modification time
+            don't match the library.
+        """
+        known = {row[0]: (row[1], row[2]) for row in self.db.execute(
+            'SELECT path, size, mtime FROM songs')}
+        for filepath in filepaths:
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                continue
+            if known.get(filepath) != (st.st_size, st.st_mtime):
+                yield filepath
+
+    def scan(self, roots=None, processes=None, threads=None, progress=None):
+        """Bring the library up to date with the contents of some directories
+
+        Only files that are new or have changed since the last scan are
+        examined; entries for files that no longer exist under roots are
+        removed.
+
+        Kwargs:
+            roots (list): pathnames of directories to scan; defaults to
+                the ones returned by self.roots()
+            processes (int): number of worker processes; defaults to the
+                number of CPUs
+            threads (int): if given, scan with this many threads in this
+                process instead of worker processes. A program with other
+                threads running, such as a GUI, must do this: forking it
+                can deadlock on locks those threads held, and the workers
+                would share its display connection.
+            progress (callable): called with the pathname of each file
+                after it's been indexed
+
+        Returns:
+            (int, int). Number of entries updated and number removed.
+        """
+        if roots is None:
+            roots = self.roots()
+        roots = [os.path.abspath(root) for root in roots]
+        found = list(findMedia(roots))
+
+        removed = 0
+        present = set(found)
+        for (filepath,) in self.db.execute('SELECT path FROM songs').fetchall():
+            if (filepath not in present
+                and any(filepath.startswith(os.path.join(root, ''))
+                        for root in roots)):
+                self.remove(filepath)
+                removed += 1
+
+        changed = list(self.stale(found))
+        updated = 0
+        if changed:
+            if threads is not None:
+                pool = ThreadPool(threads)
+            else:
+                pool = multiprocessing.Pool(processes)
+            try:
+                for song in pool.imap_unordered(scanFileSafe, changed):
+                    if song is None:
+                        continue
+                    self.update(song)
+                    updated += 1
+                    if progress is not None:
+                        progress(song['path'])
+            finally:
+                pool.close()
+                pool.join()
+
+        self.db.commit()
+        return (updated, removed)
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description='Index songs in the Karaoke-chan library')
+    argparser.add_argument('--db', default=DEFAULT_DB_PATH,
+                           help='library database file')
+    argparser.add_argument('-j', '--processes', type=int, default=None,
+                           help='number of worker processes')
+    argparser.add_argument('--add', action='store_true',
+                           help='remember the directories for later scans')
+    argparser.add_argument('directories', nargs='*',
+                           help='directories to scan (default: all '
+                           'remembered directories)')
+    args = argparser.parse_args()
+
+    library = Library(args.db)
+    try:
+        if args.add:
+            for dirpath in args.directories:
+                library.addRoot(dirpath)
+        updated, removed = library.scan(args.directories or None,
+                                        args.processes)
+    finally:
+        library.close()
+    print "{} updated, {} removed".format(updated, removed)
+
+
+if __name__ == '__main__':
+    main()
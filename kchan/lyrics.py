@@ -2,17 +2,148 @@
 
 import copy
 import bisect
+import array
+import itertools
+import collections
 
 METADATA_FIELDS = ["artist", "album", "title", "length"]
 
-class Lyrics:
+# array typecode used for timestamps and phrase indices
+TIMELINE_TYPECODE = 'l'
+
+# Longest time, in hundredths of a second, that the last word of a
+# phrase is wiped over when nothing marks where it ends
+MAX_WORD_LENGTH = 100
+
+
+class PhrasesView(collections.Sequence):
+    """Read-only view of the phrases of a Lyrics instance"""
+
+    __slots__ = ('_phrases',)
+
+    def __init__(self, phrases):
+        self._phrases = phrases
+
+    def __len__(self):
+        return len(self._phrases)
+
+    def __getitem__(self, idx):
+        return self._phrases[idx]
+
+    def __iter__(self):
+        return iter(self._phrases)
+
+
+class TimesView(collections.Sequence):
+    """Read-only view of the timeline of a Lyrics instance
+
+    Items are (time, phrase) pairs, as returned by Lyrics.getTimes().
+    """
+
+    __slots__ = ('_times', '_indices')
+
+    def __init__(self, times, indices):
+        self._times = times
+        self._indices = indices
+
+    def __len__(self):
+        return len(self._times)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return zip(self._times[idx], self._indices[idx])
+        return (self._times[idx], self._indices[idx])
+
+    def __iter__(self):
+        return iter(zip(self._times, self._indices))
+
+
+class Lyrics(object):
     """Data type for representing karaoke lyrics"""
 
+    __slots__ = ('phrases', 'times', 'indices', 'words', 'metadata',
+                 '_cursor')
+
     def __init__(self):
         """Create a new, empty Lyrics instance """
         self.phrases = []
-        self.times = []
+        # Parallel arrays holding the timeline, sorted by (time, phrase)
+        self.times = array.array(TIMELINE_TYPECODE)
+        self.indices = array.array(TIMELINE_TYPECODE)
+        # Word timing for the phrases that have it, keyed by phrase index
+        self.words = {}
         self.metadata = {}
+        # Position in the timeline of the last getCurrent lookup
+        self._cursor = -1
+
+    @classmethod
+    def fromPhrases(cls, timedPhrases):
+        """Build a Lyrics instance from a sequence of phrases in one pass
+
+        Args:
+            timedPhrases (iterable): (phrase, times) or (phrase, times,
+                words) tuples, in the order the phrases appear in the
+                song; phrase, times and words are as for addPhrase().
+
+        Returns:
+            New Lyrics instance, with no metadata. The timeline is sorted
+            once at the end rather than on every insertion.
+        """
+        lyrics = cls()
+        timeline = []
+        for item in timedPhrases:
+            idx = len(lyrics.phrases)
+            lyrics.phrases.append(item[0].replace('\r\n', '\n'))
+            timeline.extend((time, idx) for time in item[1])
+            if len(item) > 2 and item[2]:
+                lyrics.words[idx] = list(item[2])
+        timeline.sort()
+        lyrics.times.extend(t for (t, _) in timeline)
+        lyrics.indices.extend(i for (_, i) in timeline)
+        return lyrics
+
+    def splice(self, start, stop, timedPhrases):
+        """Get a copy of these lyrics with some of the phrases replaced
+
+        Only the replaced phrases are parsed and sorted into the
+        timeline, so this is much quicker than building the lyrics again
+        when a few phrases of a long song change.
+
+        Args:
+            start (int): index of the first phrase to replace
+            stop (int): index after the last phrase to replace
+            timedPhrases (iterable): phrases to put in their place, as for
+                fromPhrases()
+
+        Returns:
+            New Lyrics instance, with the same metadata.
+        """
+        added = Lyrics.fromPhrases(timedPhrases)
+        shift = len(added.phrases) - (stop - start)
+
+        lyrics = Lyrics()
+        lyrics.phrases = (self.phrases[:start] + added.phrases
+                          + self.phrases[stop:])
+        for (idx, words) in self.words.iteritems():
+            if idx < start:
+                lyrics.words[idx] = words
+            elif idx >= stop:
+                lyrics.words[idx + shift] = words
+        for (idx, words) in added.words.iteritems():
+            lyrics.words[idx + start] = words
+        lyrics.metadata = copy.copy(self.metadata)
+
+        # renumbering the phrases after the replaced ones doesn't change
+        # the order of the rest of the timeline
+        timeline = [(time, idx if idx < start else idx + shift)
+                    for (time, idx) in itertools.izip(self.times,
+                                                      self.indices)
+                    if not start <= idx < stop]
+        for (time, idx) in itertools.izip(added.times, added.indices):
+            bisect.insort(timeline, (time, idx + start))
+        lyrics.times.extend(t for (t, _) in timeline)
+        lyrics.indices.extend(i for (_, i) in timeline)
+        return lyrics
 
     def getMetadata(self):
         """Get a dictionary of song metadata
@@ -34,10 +165,11 @@ class Lyrics:
             of the lyrics delimited by timestamps or start/end of
             file. The phrases contain no timestamps or escape
             sequences, but may contain newlines or trailing
-            spaces. All newlines will be '\n' characters.
+            spaces. All newlines will be '\n' characters. The list is a
+            read-only view, and reflects later changes to the lyrics.
 
         """
-        return copy.copy(self.phrases)
+        return PhrasesView(self.phrases)
 
     def getTimes(self):
         """Get all timing data
@@ -47,8 +179,10 @@ class Lyrics:
                 time (int): start time of a lyric in hundredths of a second
                 phrase (int): index of a phrase in the list returned by
                     self.getPhrases()
+            The list is a read-only view, and reflects later changes to the
+            lyrics.
         """
-        return copy.copy(self.times)
+        return TimesView(self.times, self.indices)
 
     def getCurrent(self, time):
         """Get the index, start, and end of the current phrase of the song
@@ -66,14 +200,96 @@ class Lyrics:
             None.
 
         """
-        # Search for last entry in self.times that has a time <= time
-        idx = bisect.bisect(self.times, (time, len(self.phrases))) - 1
+        times = self.times
+        count = len(times)
+        idx = self._cursor
 
-        phrase = self.times[idx][1] if idx >= 0 else None
-        start = self.times[idx][0] if idx >= 0 else None
-        end = self.times[idx+1][0] if idx+1 < len(self.times) else None
+        # During playback, the answer is almost always the same entry
+        # as last time or the one after it, so check those before
+        # falling back to a binary search.
+        if not (0 <= idx < count and times[idx] <= time
+                and (idx+1 == count or time < times[idx+1])):
+            idx += 1
+            if not (0 <= idx < count and times[idx] <= time
+                    and (idx+1 == count or time < times[idx+1])):
+                # Search for last entry in self.times that has a time <= time
+                idx = bisect.bisect_right(times, time) - 1
+        self._cursor = idx
+
+        phrase = self.indices[idx] if idx >= 0 else None
+        start = times[idx] if idx >= 0 else None
+        end = times[idx+1] if idx+1 < count else None
         return (phrase, start, end)
 
+    def getWords(self, phrase):
+        """Get the word timing of a phrase
+
+        Args:
+            phrase (int): index of a phrase in self.getPhrases()
+
+        Returns:
+            list. A list of pairs (offset, delay), ordered by offset::
+                offset (int): index in the phrase of the first character
+                    of a word
+                delay (int): time in hundredths of a second from the start
+                    of the phrase until the word is sung
+            The list is empty if the phrase has no word timing.
+        """
+        return list(self.words.get(phrase, ()))
+
+    def getWipe(self, phrase, start, end, time):
+        """Get how much of a phrase has been sung, for a progressive wipe
+
+        Each word is wiped at an even rate from the time it's sung until
+        the next word is; the last word runs until the end of the phrase,
+        or for at most MAX_WORD_LENGTH.
+
+        Args:
+            phrase (int): index of the phrase being sung
+            start (int): time the phrase started, in hundredths of a second
+            end (int): time the phrase ends, or None if it's the last one
+            time (int): current time
+
+        Returns:
+            (int, int). Number of characters at the start of the phrase
+            that have been sung, and the time the next character will
+            be, or None if the whole phrase has been. If the phrase has
+            no word timing, returns (None, None).
+        """
+        words = self.words.get(phrase)
+        if not words:
+            return (None, None)
+        length = len(self.phrases[phrase])
+        if words[0][0] > 0:
+            # text before the first word is sung from the start of the phrase
+            words = [(0, 0)] + words
+
+        elapsed = time - start
+        i = bisect.bisect_right([delay for (_, delay) in words], elapsed) - 1
+        if i < 0:
+            return (0, start + words[0][1])
+
+        offset, delay = words[i]
+        if i + 1 < len(words):
+            nextOffset, nextDelay = words[i+1]
+        else:
+            nextOffset = length
+            nextDelay = delay + MAX_WORD_LENGTH
+            if end is not None:
+                nextDelay = min(nextDelay, end - start)
+        chars = nextOffset - offset
+        duration = nextDelay - delay
+        if chars <= 0 or duration <= 0:
+            return (nextOffset, start + nextDelay
+                    if nextOffset < length else None)
+
+        sung = min(chars, int((elapsed - delay) * chars // duration) + 1)
+        if offset + sung >= length:
+            return (length, None)
+        # time at which (elapsed - delay) * chars // duration reaches sung
+        nextTime = start + delay + -(-sung * duration // chars)
+        return (offset + sung, nextTime)
+
     def setMetadata(self, **metadata):
         """Set the metadata for this song
 
@@ -88,7 +304,7 @@ class Lyrics:
                     if k in METADATA_FIELDS}
         self.metadata.update(metadata)
 
-    def addPhrase(self, phrase, times):
+    def addPhrase(self, phrase, times, words=None):
         """Add a phrase to this song
 
         Args:
@@ -97,8 +313,21 @@ class Lyrics:
             times (list): List of integer timestamps, in hundredths of a
                 second, when the phrase is to be sung. The list must not be
                 empty.
+
+        Kwargs:
+            words (list): Word timing for the phrase, as returned by
+                getWords(); offsets are into phrase after its newlines
+                have been converted to '\n'.
         """
         phrase = phrase.replace('\r\n', '\n')
         self.phrases.append(phrase)
+        idx = len(self.phrases) - 1
+        if words:
+            self.words[idx] = list(words)
         for time in times:
-            bisect.insort(self.times, (time, len(self.phrases)-1))
+            # The new phrase has the highest index so far, so it goes
+            # after any existing entries with the same time.
+            pos = bisect.bisect_right(self.times, time)
+            self.times.insert(pos, time)
+            self.indices.insert(pos, idx)
+        self._cursor = -1
@@ -0,0 +1,249 @@
+#! /usr/bin/python2
+
+import os
+import sys
+import time
+import zlib
+import array
+import marshal
+import struct
+import sqlite3
+import threading
+
+import kchan.formats as formats
+import kchan.formats.lrc as lrc
+import kchan.formats.lyrics3v2 as lyrics3v2
+from kchan.lyrics import Lyrics
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.karaokechan',
+                                  'lyrics.db')
+
+# Total size of the cached lyrics data above which the least recently
+# used entries are evicted, in bytes
+MAX_CACHE_SIZE = 16 << 20
+
+# Seconds between writes of the times cache hits were used at; the
+# eviction order only needs to be roughly right
+USED_FLUSH_INTERVAL = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS lyrics (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    checksum INTEGER NOT NULL,
+    data BLOB,
+    used REAL NOT NULL
+)
+"""
+
+MAGIC = "KCLC"
+FORMAT_VERSION = 1
+# magic, format version, and the number of phrases, timeline entries,
+# and timed words
+HEADER = struct.Struct('<4sBIII')
+# array typecode for the 32-bit integers in packed lyrics
+INT_TYPECODE = 'i'
+
+
+def intArray(values=()):
+    return array.array(INT_TYPECODE, values)
+
+
+def packInts(values):
+    a = intArray(values)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a.tostring()
+
+
+def unpackInts(data, start, count):
+    a = intArray()
+    end = start + count * a.itemsize
+    a.fromstring(data[start:end])
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return (a, end)
+
+
+def pack(lyrics):
+    """Serialize a Lyrics instance in a compact binary form
+
+    The layout is HEADER, then the length of each phrase, the phrases,
+    the timeline's times and phrase indices, the words as (phrase,
+    offset, delay) triples, and finally the metadata dict in marshal
+    format. All other integers are 32-bit little-endian.
+    """
+    words = []
+    for idx in sorted(lyrics.words):
+        for (offset, delay) in lyrics.words[idx]:
+            words.extend((idx, offset, delay))
+    return ''.join([
+        HEADER.pack(MAGIC, FORMAT_VERSION, len(lyrics.phrases),
+                    len(lyrics.times), len(words) // 3),
+        packInts(len(p) for p in lyrics.phrases),
+        ''.join(lyrics.phrases),
+        packInts(lyrics.times),
+        packInts(lyrics.indices),
+        packInts(words),
+        marshal.dumps(lyrics.metadata),
+    ])
+
+
+def unpack(data):
+    """Rebuild a Lyrics instance from the result of pack()
+
+    Raises:
+        ValueError: data isn't in the current format
+    """
+    if len(data) < HEADER.size:
+        raise ValueError, "Packed lyrics too short"
+    magic, version, phraseCount, timeCount, wordCount = HEADER.unpack_from(
+        data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError, "Unknown packed lyrics format"
+
+    lengths, pos = unpackInts(data, HEADER.size, phraseCount)
+    lyrics = Lyrics()
+    for length in lengths:
+        lyrics.phrases.append(data[pos:pos+length])
+        pos += length
+    times, pos = unpackInts(data, pos, timeCount)
+    indices, pos = unpackInts(data, pos, timeCount)
+    words, pos = unpackInts(data, pos, wordCount * 3)
+    lyrics.times.fromlist(times.tolist())
+    lyrics.indices.fromlist(indices.tolist())
+    for i in xrange(0, len(words), 3):
+        lyrics.words.setdefault(words[i], []).append((words[i+1],
+                                                      words[i+2]))
+    try:
+        lyrics.metadata = marshal.loads(data[pos:])
+    except (EOFError, TypeError):
+        raise ValueError, "Malformed packed lyrics metadata"
+    return lyrics
+
+
+def checksum(filepath, size):
+    """Checksum the parts of a file lyrics tags can change without notice
+
+    The end of the file that lyrics3v2.read() fetches is covered, along
+    with the size and modification time of its .lrc file, if it has
+    one. Anything else that changes the lyrics, such as retagging the
+    ID3v2 tag at the start, also changes the file's modification time.
+    """
+    crc = 0
+    with open(filepath, 'rb') as f:
+        f.seek(max(size - lyrics3v2.TAIL_READ_LENGTH, 0))
+        crc = zlib.crc32(f.read(lyrics3v2.TAIL_READ_LENGTH), crc)
+    try:
+        st = os.stat(lrc.sidecarPath(filepath))
+        crc = zlib.crc32('{}:{}'.format(st.st_size, st.st_mtime), crc)
+    except OSError:
+        pass
+    return crc
+
+
+class LyricsCache(object):
+    """Persistent cache of the lyrics found for media files
+
+    Entries are keyed by pathname and are only used while the file's
+    size, modification time and checksum() are unchanged; files with no
+    lyrics are remembered too. Once the cached data grows beyond
+    MAX_CACHE_SIZE, the least recently used entries are dropped; when
+    entries were last used is only written out every
+    USED_FLUSH_INTERVAL, along with other changes, or on close(). A
+    cache may be shared between threads.
+    """
+
+    def __init__(self, dbpath=DEFAULT_CACHE_PATH, maxSize=MAX_CACHE_SIZE):
+        dbdir = os.path.dirname(dbpath)
+        if dbdir and not os.path.isdir(dbdir):
+            os.makedirs(dbdir)
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(dbpath, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute(SCHEMA)
+        self.db.commit()
+        # time each entry was used at since they were last written
+        self.used = {}
+        self.flushed = time.time()
+
+    def loadFile(self, filepath):
+        """Like kchan.formats.loadFile(), but using the cache if possible
+
+        Returns:
+            (Lyrics, bool). The lyrics (None if there are none), and
+            whether they came from the cache.
+        """
+        filepath = os.path.abspath(filepath)
+        st = os.stat(filepath)
+        crc = checksum(filepath, st.st_size)
+        key = (st.st_size, st.st_mtime, crc)
+        with self.lock:
+            row = self.db.execute(
+                'SELECT size, mtime, checksum, data FROM lyrics '
+                'WHERE path = ?', (filepath,)).fetchone()
+        if row is not None and tuple(row[:3]) == key:
+            try:
+                lyrics = unpack(str(row[3])) if row[3] is not None else None
+                now = time.time()
+                with self.lock:
+                    self.used[filepath] = now
+                    if now - self.flushed >= USED_FLUSH_INTERVAL:
+                        self.flushUsed()
+                        self.db.commit()
+                return (lyrics, True)
+            except (ValueError, IndexError):
+                # written by a different version, or damaged; replace it
+                pass
+
+        lyrics = formats.loadFile(filepath)[0]
+        data = pack(lyrics) if lyrics is not None else None
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO lyrics VALUES (?, ?, ?, ?, ?, ?)',
+                (filepath,) + key + (sqlite3.Binary(data)
+                                     if data is not None else None,
+                                     time.time()))
+            self.used.pop(filepath, None)
+            self.flushUsed()
+            self.evict()
+            self.db.commit()
+        return (lyrics, False)
+
+    def flushUsed(self):
+        """Write out when entries were used; the lock must be held"""
+        if self.used:
+            self.db.executemany('UPDATE lyrics SET used = ? WHERE path = ?',
+                                [(used, path) for (path, used)
+                                 in self.used.iteritems()])
+            self.used = {}
+        self.flushed = time.time()
+
+    def evict(self):
+        """Drop the least recently used entries until the cache fits"""
+        total = 0
+        stale = []
+        for (path, length) in self.db.execute(
+                'SELECT path, IFNULL(LENGTH(data), 0) FROM lyrics '
+                'ORDER BY used DESC').fetchall():
+            total += length
+            if total > self.maxSize:
+                stale.append((path,))
+        self.db.executemany('DELETE FROM lyrics WHERE path = ?', stale)
+
+    def invalidate(self, filepath):
+        """Forget the cached lyrics for a file, e.g. after writing to it"""
+        filepath = os.path.abspath(filepath)
+        with self.lock:
+            self.used.pop(filepath, None)
+            self.db.execute('DELETE FROM lyrics WHERE path = ?',
+                            (filepath,))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.flushUsed()
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,272 @@
+#! /usr/bin/python2
+
+from __future__ import division
+
+import os
+import mmap
+import array
+import struct
+import sqlite3
+import threading
+
+from kchan.formats.id3v2 import syncsafe, HEADER_LENGTH, ID3_START
+import kchan.perf as perf
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.karaokechan',
+                                  'seekindex.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS seekindex (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    samplerate INTEGER NOT NULL,
+    framesamples INTEGER NOT NULL,
+    offsets BLOB NOT NULL
+)
+"""
+
+# array typecode for frame offsets; the cache never leaves the machine,
+# so they're stored in native byte order
+OFFSET_TYPECODE = 'L'
+
+# ID3v2 header flag for a footer after the tag
+FOOTER_FLAG = 0x10
+
+# MPEG version bits of a frame header
+MPEG1, MPEG2, MPEG25 = 3, 2, 0
+LAYER3 = 1
+# Layer III bitrates in kbit/s, by bitrate index
+BITRATES = {
+    MPEG1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    MPEG2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+BITRATES[MPEG25] = BITRATES[MPEG2]
+SAMPLERATES = {MPEG1: [44100, 48000, 32000], MPEG2: [22050, 24000, 16000],
+               MPEG25: [11025, 12000, 8000]}
+MONO = 3
+
+# Encoders put a Xing (or Info, for CBR) or VBRI header in a first frame
+# holding no audio, after the side information
+XING_IDS = ("Xing", "Info")
+VBRI_ID = "VBRI"
+VBRI_OFFSET = 36
+
+
+def parseHeader(header):
+    """Decode an MPEG audio Layer III frame header
+
+    Args:
+        header (int): the first four bytes of the frame, big-endian
+
+    Returns:
+        (int, int, int). The frame's length in bytes, its sample rate,
+        and the number of samples it holds; None if header isn't a
+        Layer III frame header.
+    """
+    if header & 0xffe00000 != 0xffe00000:
+        return None
+    version = (header >> 19) & 3
+    layer = (header >> 17) & 3
+    bitrateIndex = (header >> 12) & 15
+    samplerateIndex = (header >> 10) & 3
+    if (version not in BITRATES or layer != LAYER3 or bitrateIndex in (0, 15)
+        or samplerateIndex == 3):
+        return None
+    bitrate = BITRATES[version][bitrateIndex] * 1000
+    samplerate = SAMPLERATES[version][samplerateIndex]
+    padding = (header >> 9) & 1
+    if version == MPEG1:
+        return (144 * bitrate // samplerate + padding, samplerate, 1152)
+    return (72 * bitrate // samplerate + padding, samplerate, 576)
+
+
+def audioStart(data):
+    """Find where the audio starts, after any ID3v2 tag"""
+    if data[:3] != ID3_START or len(data) < HEADER_LENGTH:
+        return 0
+    start = HEADER_LENGTH + syncsafe(data[6:10])
+    if ord(data[5]) & FOOTER_FLAG:
+        start += HEADER_LENGTH
+    return start
+
+
+def isInfoFrame(data, pos, header):
+    """Check whether a frame is a Xing, Info or VBRI header"""
+    version = (header >> 19) & 3
+    mono = (header >> 6) & 3 == MONO
+    if version == MPEG1:
+        sideInfo = 17 if mono else 32
+    else:
+        sideInfo = 9 if mono else 17
+    return (data[pos+4+sideInfo:pos+8+sideInfo] in XING_IDS
+            or data[pos+VBRI_OFFSET:pos+VBRI_OFFSET+4] == VBRI_ID)
+
+
+class SeekIndex(object):
+    """Byte offset of every audio frame of an MP3 file
+
+    All frames of an MP3 file hold the same number of samples, so the
+    frame playing at any time can be found exactly, even in VBR files.
+    """
+
+    def __init__(self, samplerate, frameSamples, offsets):
+        self.samplerate = samplerate
+        self.frameSamples = frameSamples
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def frameLength(self):
+        """Get the time each frame lasts, in milliseconds"""
+        return self.frameSamples * 1000 / self.samplerate
+
+    def duration(self):
+        """Get the length of the indexed audio, in milliseconds"""
+        return len(self.offsets) * self.frameLength()
+
+    def locate(self, pos):
+        """Find the frame playing at a given time
+
+        Args:
+            pos (int): time in milliseconds
+
+        Returns:
+            (int, int). The byte offset of the frame, and the time it
+            starts in milliseconds (up to one frameLength() before pos).
+        """
+        frame = min(max(int(pos / self.frameLength()), 0),
+                    len(self.offsets) - 1)
+        return (self.offsets[frame], int(round(frame * self.frameLength())))
+
+
+def resync(data, pos, samplerate):
+    """Find the next frame header at or after pos
+
+    Like a decoder, this skips over anything that isn't a frame. Sync
+    words turn up by chance in other data, so a header only counts if
+    another header follows where the frame ends, or the file does.
+
+    Returns:
+        int. Byte offset of the frame, or None if there are no more.
+    """
+    size = len(data)
+    unpack = struct.Struct('>I').unpack_from
+    while True:
+        pos = data.find('\xff', pos, size - 3)
+        if pos < 0:
+            return None
+        frame = parseHeader(unpack(data, pos)[0])
+        if frame is not None and frame[1] == samplerate:
+            end = pos + frame[0]
+            if end == size:
+                return pos
+            if end + 4 <= size:
+                following = parseHeader(unpack(data, end)[0])
+                if following is not None and following[1] == samplerate:
+                    return pos
+        pos += 1
+
+
+@perf.timed('mp3index.build')
+def build(filepath):
+    """Index the frames of an MP3 file by scanning their headers
+
+    The scan starts at the first frame after any ID3v2 tag, and skips
+    the Xing/Info/VBRI frame if there is one (decoders don't play it).
+    Anything between frames, such as damaged data or ID3v1, Lyrics3 and
+    APE tags, is skipped with resync().
+
+    Returns:
+        SeekIndex instance.
+
+    Raises:
+        ValueError: the file doesn't start with a Layer III frame
+        IOError: the file can't be read
+    """
+    with open(filepath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            raise ValueError, "Empty file"
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        pos = audioStart(data[:HEADER_LENGTH])
+        if pos + 4 > size:
+            raise ValueError, "No MPEG audio frames"
+        header = struct.unpack_from('>I', data, pos)[0]
+        frame = parseHeader(header)
+        if frame is None:
+            raise ValueError, "No MPEG audio frames"
+        samplerate, frameSamples = frame[1:]
+        if isInfoFrame(data, pos, header):
+            pos += frame[0]
+
+        offsets = array.array(OFFSET_TYPECODE)
+        unpack = struct.Struct('>I').unpack_from
+        while pos + 4 <= size:
+            frame = parseHeader(unpack(data, pos)[0])
+            if frame is None or frame[1] != samplerate:
+                pos = resync(data, pos + 1, samplerate)
+                if pos is None:
+                    break
+                continue
+            offsets.append(pos)
+            pos += frame[0]
+    finally:
+        data.close()
+
+    if not offsets:
+        raise ValueError, "No MPEG audio frames"
+    return SeekIndex(samplerate, frameSamples, offsets)
+
+
+class SeekIndexCache(object):
+    """Persistent cache of build() results
+
+    Entries are keyed by pathname and are only used while the file's
+    size and modification time are unchanged. A cache may be shared
+    between threads.
+    """
+
+    def __init__(self, dbpath=DEFAULT_CACHE_PATH):
+        dbdir = os.path.dirname(dbpath)
+        if dbdir and not os.path.isdir(dbdir):
+            os.makedirs(dbdir)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(dbpath, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+    def index(self, filepath):
+        """Like build(), but using the cache if possible
+
+        Returns:
+            (SeekIndex, bool). The index, and whether it came from the
+            cache.
+        """
+        filepath = os.path.abspath(filepath)
+        st = os.stat(filepath)
+        with self.lock:
+            row = self.db.execute(
+                'SELECT size, mtime, samplerate, framesamples, offsets '
+                'FROM seekindex WHERE path = ?', (filepath,)).fetchone()
+        if row is not None and tuple(row[:2]) == (st.st_size, st.st_mtime):
+            offsets = array.array(OFFSET_TYPECODE)
+            offsets.fromstring(str(row[4]))
+            return (SeekIndex(row[2], row[3], offsets), True)
+
+        index = build(filepath)
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO seekindex VALUES (?, ?, ?, ?, ?, ?)',
+                (filepath, st.st_size, st.st_mtime, index.samplerate,
+                 index.frameSamples,
+                 sqlite3.Binary(index.offsets.tostring())))
+            self.db.commit()
+        return (index, False)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
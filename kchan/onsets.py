@@ -0,0 +1,241 @@
+#! /usr/bin/python2
+
+from __future__ import division
+
+import threading
+import Queue
+
+import kchan.perf as perf
+
+# Time between values of the onset curve, in milliseconds
+HOP_LENGTH = 10
+# Length of each analysis frame, in hops
+FRAME_HOPS = 4
+# Bytes of decoded audio read at a time; only this much audio is held in
+# memory at once, plus one value of the onset curve per hop
+BLOCK_SIZE = 1 << 16
+# Frequencies where sung vowels carry most of their energy, in Hz;
+# drums and bass mostly fall outside it
+VOCAL_BAND = (200, 3000)
+# Milliseconds on either side of each point averaged for the threshold
+# a peak of the onset curve has to pass
+THRESHOLD_WINDOW = 500
+# How far above the local average a peak must be to count as an onset
+THRESHOLD_RATIO = 1.5
+# Minimum threshold, as a fraction of the average over the whole song,
+# so quiet noise between phrases isn't picked up
+THRESHOLD_FLOOR = 0.5
+# Minimum time between onsets, in milliseconds; the weaker of two onsets
+# closer than this is dropped
+MIN_GAP = 150
+
+
+class Cancelled(Exception):
+    pass
+
+
+def monoBlocks(f, cancelled=None):
+    """Decode audio a block at a time, mixing it down to mono
+
+    Args:
+        f (audioread file): the open audio file
+
+    Kwargs:
+        cancelled (threading.Event): stop as soon as this is set
+
+    Yields:
+        numpy.ndarray. The next float32 samples, from at most BLOCK_SIZE
+        bytes of decoded audio.
+
+    Raises:
+        Cancelled: cancelled was set
+    """
+    import numpy
+
+    # bytes of a sample split between blocks
+    leftover = ''
+    sampleBytes = 2 * f.channels
+    for block in f.read_data(BLOCK_SIZE):
+        if cancelled is not None and cancelled.is_set():
+            raise Cancelled
+        data = leftover + block
+        usable = len(data) - len(data) % sampleBytes
+        leftover = data[usable:]
+        samples = numpy.frombuffer(data[:usable], '<i2')
+        yield samples.reshape(-1, f.channels).mean(axis=1,
+                                                   dtype=numpy.float32)
+
+
+def onsetCurve(filepath, cancelled=None):
+    """Compute the spectral flux of an audio file within VOCAL_BAND
+
+    The audio is decoded and analysed a block at a time, so memory use
+    doesn't depend on the length of the song.
+
+    Args:
+        filepath (str): pathname of an audio file
+
+    Kwargs:
+        cancelled (threading.Event): stop as soon as this is set
+
+    Returns:
+        numpy.ndarray. The amount the log magnitude spectrum rises by
+        between each pair of consecutive frames; the value at index i is
+        centered at i * HOP_LENGTH + FRAME_HOPS * HOP_LENGTH / 2 ms.
+
+    Raises:
+        Cancelled: cancelled was set
+        audioread.DecodeError: file can't be decoded
+        IOError: file can't be read
+    """
+    # neither is needed unless the editor asks for onsets
+    import numpy
+    import audioread
+
+    with audioread.audio_open(filepath) as f:
+        hop = f.samplerate * HOP_LENGTH // 1000
+        frameLength = hop * FRAME_HOPS
+        fftLength = 1 << (frameLength - 1).bit_length()
+        window = numpy.hanning(frameLength).astype(numpy.float32)
+        freqs = numpy.fft.rfftfreq(fftLength, 1 / f.samplerate)
+        band = (freqs >= VOCAL_BAND[0]) & (freqs < VOCAL_BAND[1])
+
+        flux = []
+        # samples not yet covered by a whole frame
+        pending = numpy.zeros(0, numpy.float32)
+        previous = None
+        for mono in monoBlocks(f, cancelled):
+            pending = numpy.concatenate((pending, mono))
+
+            count = (len(pending) - frameLength) // hop + 1
+            if count <= 0:
+                continue
+            # overlapping frames as views of pending, without copying
+            frames = numpy.lib.stride_tricks.as_strided(
+                pending, shape=(count, frameLength),
+                strides=(hop * pending.strides[0], pending.strides[0]))
+            spectra = numpy.log1p(numpy.abs(
+                numpy.fft.rfft(frames * window, fftLength, axis=1)[:, band]))
+            if previous is None:
+                previous = spectra[0]
+            rise = numpy.diff(numpy.vstack((previous, spectra)), axis=0)
+            flux.append(numpy.maximum(rise, 0).sum(axis=1))
+            previous = spectra[-1]
+            pending = pending[count * hop:].copy()
+
+    if not flux:
+        return numpy.zeros(0, numpy.float32)
+    return numpy.concatenate(flux)
+
+
+def pickOnsets(flux):
+    """Find the onsets in the result of onsetCurve()
+
+    Onsets are peaks of the curve that stand out from the curve around
+    them; of any onsets within MIN_GAP of each other, only the strongest
+    is kept.
+
+    Returns:
+        list. The times of the onsets, in hundredths of a second, in order.
+    """
+    import numpy
+
+    if len(flux) < 3:
+        return []
+    # an odd width no longer than the curve, so the average lines up
+    halfWidth = min(THRESHOLD_WINDOW // HOP_LENGTH, (len(flux) - 1) // 2)
+    width = 2 * halfWidth + 1
+    local = numpy.convolve(flux, numpy.ones(width) / width, mode='same')
+    threshold = numpy.maximum(local * THRESHOLD_RATIO,
+                              flux.mean() * THRESHOLD_FLOOR)
+    middle = flux[1:-1]
+    peaks = numpy.nonzero((middle > flux[:-2]) & (middle >= flux[2:])
+                          & (middle > threshold[1:-1]))[0] + 1
+
+    gap = MIN_GAP // HOP_LENGTH
+    kept = []
+    for i in peaks:
+        if kept and i - kept[-1] < gap:
+            if flux[i] > flux[kept[-1]]:
+                kept[-1] = i
+        else:
+            kept.append(i)
+    center = FRAME_HOPS * HOP_LENGTH // 2
+    return [(int(i) * HOP_LENGTH + center) // 10 for i in kept]
+
+
+@perf.timed('onsets.detect')
+def detect(filepath, cancelled=None):
+    """Find the times in an audio file where singing is likely to start
+
+    Args and exceptions are as for onsetCurve().
+
+    Returns:
+        list. The times of the onsets, as for pickOnsets().
+    """
+    return pickOnsets(onsetCurve(filepath, cancelled))
+
+
+class Analyzer(object):
+    """Runs detect(), or another analysis of a song, on a background thread
+
+    Only one song is analysed at a time; starting another analysis
+    cancels the one in progress. Results are collected by calling
+    Result() from the UI thread, since Tk must only be used from the
+    thread running its mainloop.
+    """
+
+    def __init__(self, analyze=detect):
+        """
+        Kwargs:
+            analyze (callable): called with a pathname and a cancellation
+                threading.Event like detect(), returns the result
+        """
+        self.analyze = analyze
+        self.cancelled = None
+        self.results = Queue.Queue()
+
+    def Start(self, filepath):
+        self.Cancel()
+        self.cancelled = threading.Event()
+        thread = threading.Thread(target=self.Run,
+                                  args=(filepath, self.cancelled))
+        thread.daemon = True
+        thread.start()
+
+    def Cancel(self):
+        if self.cancelled is not None:
+            self.cancelled.set()
+            self.cancelled = None
+
+    def Busy(self):
+        return self.cancelled is not None
+
+    def Run(self, filepath, cancelled):
+        try:
+            result = self.analyze(filepath, cancelled)
+        except Cancelled:
+            return
+        except Exception as e:
+            result = e
+        self.results.put((filepath, result, cancelled))
+
+    def Result(self):
+        """Get the result of the current analysis, if it's finished
+
+        Returns:
+            (str, object). The pathname of the song, and either the
+            result (for detect(), the list of onsets) or the exception
+            that stopped the analysis; None if the analysis isn't
+            finished, or there isn't one.
+        """
+        while True:
+            try:
+                filepath, result, cancelled = self.results.get_nowait()
+            except Queue.Empty:
+                return None
+            # results of cancelled analyses can still arrive if they
+            # finished just before being cancelled
+            if cancelled is self.cancelled:
+                self.cancelled = None
+                return (filepath, result)
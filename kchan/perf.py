@@ -0,0 +1,148 @@
+#! /usr/bin/python2
+
+from __future__ import division
+
+import csv
+import json
+import bisect
+import functools
+
+from kchan.clock import monotonic
+
+# Upper bounds of the histogram buckets, in ms; the last bucket holds
+# everything larger
+BUCKET_BOUNDS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50,
+                 100, 200, 500, 1000]
+
+CSV_COLUMNS = ['name', 'count', 'mean', 'min', 'p50', 'p95', 'max']
+
+# Nothing is recorded unless this is True
+enabled = False
+
+histograms = {}
+
+
+class Histogram(object):
+    """Distribution of measurements of one thing, in milliseconds"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def Add(self, value):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def Percentile(self, p):
+        """Estimate a percentile from the bucket counts
+
+        Returns:
+            float. Upper bound of the bucket holding the pth percentile,
+            or the largest value seen if that's smaller.
+        """
+        if not self.count:
+            return None
+        rank = self.count * p / 100
+        seen = 0
+        for (i, n) in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                if i < len(BUCKET_BOUNDS):
+                    return min(BUCKET_BOUNDS[i], self.max)
+                break
+        return self.max
+
+    def Summary(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'min': self.min, 'p50': self.Percentile(50),
+                'p95': self.Percentile(95), 'max': self.max}
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def reset():
+    histograms.clear()
+
+
+def record(name, value):
+    """Record a measurement, in ms, if instrumentation is enabled"""
+    if enabled:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.Add(value)
+
+
+def timed(name):
+    """Decorator recording how long each call of a function takes
+
+    While instrumentation is disabled, the only cost is one extra call
+    and a check of the enabled flag.
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            start = monotonic()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(name, (monotonic() - start) * 1000)
+        return wrapper
+    return decorate
+
+
+def summary():
+    """Summarize everything recorded so far
+
+    Returns:
+        list. A dict for each thing measured, sorted by name, with the
+        keys in CSV_COLUMNS; times are in ms.
+    """
+    result = []
+    for name in sorted(histograms):
+        s = histograms[name].Summary()
+        s['name'] = name
+        result.append(s)
+    return result
+
+
+def report():
+    """Format summary() as a text table"""
+    lines = ['{:24} {:>6} {:>8} {:>8} {:>8}'.format('', 'count', 'p50',
+                                                    'p95', 'max')]
+    for s in summary():
+        lines.append('{:24} {:6} {:8.2f} {:8.2f} {:8.2f}'.format(
+            s['name'][:24], s['count'], s['p50'], s['p95'], s['max']))
+    return '\n'.join(lines)
+
+
+def dump(path):
+    """Save everything recorded so far to a file
+
+    Files whose names end in ".csv" get one row per thing measured, with
+    the columns in CSV_COLUMNS; anything else gets JSON including the
+    full histograms.
+    """
+    if path.lower().endswith('.csv'):
+        with open(path, 'wb') as f:
+            writer = csv.DictWriter(f, CSV_COLUMNS)
+            writer.writeheader()
+            writer.writerows(summary())
+    else:
+        data = {'buckets': BUCKET_BOUNDS,
+                'measurements': [dict(s, counts=histograms[s['name']].counts)
+                                 for s in summary()]}
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
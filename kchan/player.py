@@ -1,33 +1,224 @@
-import audioread
-from pygame import mixer
-music = mixer.music
+import os.path
+import time
+import sqlite3
+import collections
+
+from kchan.probe import probe
+import kchan.mp3index as mp3index
+from kchan.clock import PlaybackClock
+import kchan.perf as perf
+
+# pygame's mixer, which is slow to import; it's loaded by importMixer()
+# when the first file is
+mixer = None
+music = None
+mixerError = None
+
+# Milliseconds a seek index's length can differ from the probed duration
+# before it's not trusted to find positions
+INDEX_TOLERANCE = 1000
+
+# Seconds spent in each part of the last Player.Load, and whether the
+# probe was answered from the cache and the mixer was reused
+LoadTiming = collections.namedtuple('LoadTiming',
+                                    ['probe', 'mixer', 'load', 'total',
+                                     'cached', 'reused'])
+
+
+def importMixer():
+    global mixer, music, mixerError
+    if mixer is None:
+        from pygame import mixer as pygameMixer, error
+        mixer = pygameMixer
+        music = pygameMixer.music
+        mixerError = error
 
 
 class Player(object):
-    def __init__(self, state_callback):
+    def __init__(self, state_callback, probe_cache=None, seek_cache=None):
         self.state_callback = state_callback
+        self.probe_cache = probe_cache
+        self.seek_cache = seek_cache
+        self.filename = None
         self.duration = 0
-        mixer.init()
+        # mp3index.SeekIndex of the current file; None if it hasn't been
+        # needed yet, False if the file can't be indexed
+        self.seek_index = None
+        # file handed to the mixer to start playback partway through the
+        # current file, if that's what's loaded; it has to stay open
+        # until the mixer has moved on to something else
+        self.stream = None
+        self.streaming = False
+        # (sample rate, channels) the mixer was initialized with; the
+        # mixer isn't started until the first file is loaded
+        self.mixer_format = None
         self.has_music = False
+        self.load_timing = None
+        # (filename, AudioInfo) of the file queued to play next
+        self.queued = None
+        # whether playback was started and hasn't been paused or stopped
+        self.started = False
+        self.pos = 0
+        # last position the mixer reported; it starts counting from zero
+        # again when a queued file starts playing
+        self.mixer_pos = 0
+        self.clock = PlaybackClock()
+
+    def Probe(self, filename):
+        if self.probe_cache is not None:
+            try:
+                return self.probe_cache.probe(filename)
+            except sqlite3.Error:
+                pass
+        return (probe(filename), False)
+
+    def BuildIndex(self, filename):
+        if self.seek_cache is not None:
+            try:
+                return self.seek_cache.index(filename)[0]
+            except sqlite3.Error:
+                pass
+        return mp3index.build(filename)
+
+    def SeekIndex(self):
+        """Get the frame index of the current file, or None if it has none
+
+        An index that doesn't cover the whole file, as the decoder sees
+        it, isn't used, since positions past its end would be wrong.
+        """
+        if self.seek_index is None:
+            self.seek_index = False
+            if os.path.splitext(self.filename)[1].lower() == '.mp3':
+                try:
+                    index = self.BuildIndex(self.filename)
+                except (IOError, OSError, ValueError):
+                    pass
+                else:
+                    if (abs(index.duration() - self.duration)
+                            <= INDEX_TOLERANCE):
+                        self.seek_index = index
+        return self.seek_index or None
 
+    @perf.timed('Player.Load')
     def Load(self, filename):
-        with audioread.audio_open(filename) as f:
-            self.duration = int(f.duration * 1000)
-            self.samplerate = f.samplerate
-            self.channels = f.channels
-        mixer.quit()
-        mixer.init(frequency=self.samplerate, channels=self.channels)
-        music.load(filename)
+        start = time.time()
+        info, cached = self.Probe(filename)
+        self.duration, self.samplerate, self.channels = info
+        probed = time.time()
+
+        # Restarting the mixer is slow, so only do it if the new file
+        # needs a different output format
+        importMixer()
+        fmt = (self.samplerate, self.channels)
+        reused = fmt == self.mixer_format
+        if reused:
+            music.stop()
+        else:
+            if self.mixer_format is not None:
+                mixer.quit()
+            mixer.init(frequency=self.samplerate, channels=self.channels)
+            self.mixer_format = fmt
+        mixed = time.time()
+
+        self.LoadMusic(filename)
+        self.filename = filename
+        self.seek_index = None
         self.pos = 0
+        self.clock.Stop(0)
         self.has_music = True
+        self.queued = None
+        self.started = False
+        loaded = time.time()
+
+        self.load_timing = LoadTiming(probed - start, mixed - probed,
+                                      loaded - mixed, loaded - start,
+                                      cached, reused)
+
+    def Enqueue(self, filename, info):
+        """Queue a file to start as soon as the current one finishes
+
+        Only possible if the file has the same format as the current
+        one, since the mixer can't be restarted without a gap.
+
+        Args:
+            filename (str): pathname of the file
+            info (AudioInfo): result of probing the file
+
+        Returns:
+            bool. Whether the file was queued.
+        """
+        if not self.has_music or (info.samplerate,
+                                  info.channels) != self.mixer_format:
+            return False
+        self.queued = (filename, info)
+        music.queue(filename)
+        return True
+
+    def Dequeue(self):
+        """Cancel playing the queued file after the current one
+
+        The mixer has no way to empty its queue other than starting
+        playback again, so if the current file is playing it's restarted
+        from where it was.
+        """
+        if self.queued is None:
+            return
+        self.queued = None
+        if music.get_busy():
+            pos = self.Tell()
+            music.stop()
+            self.pos = self.StartAt(pos)
+            self.clock.Start(self.pos)
+
+    def CheckQueue(self):
+        """Switch over to the queued file, if it's started playing
+
+        Returns:
+            bool. True if the queued file is now the current file.
+        """
+        if self.queued is None or not music.get_busy():
+            return False
+        # MixerPos() moves pos past the end of the file if the mixer
+        # restarted its count at the handover
+        if self.Tell() < self.duration:
+            return False
+        self.pos -= self.duration
+        self.clock.Shift(-self.duration)
+        self.duration, self.samplerate, self.channels = self.queued[1]
+        self.filename = self.queued[0]
+        self.seek_index = None
+        self.streaming = False
+        self.queued = None
+        return True
+
+    def Ended(self):
+        """Whether the current file has played through to the end"""
+        return self.has_music and self.started and not music.get_busy()
 
     def Length(self):
         return self.duration
 
+    def MixerPos(self):
+        """Get the playback position according to the mixer
+
+        This is only accurate to within a few tens of milliseconds; use
+        Tell() instead.
+        """
+        mixer_pos = music.get_pos()
+        if mixer_pos < self.mixer_pos and self.queued is not None:
+            # the queued file has started, and the mixer is counting
+            # from its start; positions stay relative to the current
+            # file until CheckQueue() switches over
+            self.pos = self.duration
+        self.mixer_pos = mixer_pos
+        return self.pos + mixer_pos
+
+    @perf.timed('Player.Tell')
     def Tell(self):
         if self.has_music:
             if music.get_busy():
-                return self.pos + music.get_pos()
+                self.clock.Correct(self.MixerPos())
+                return self.clock.Tell()
             else:
                 return self.pos
         return 0
@@ -42,24 +233,34 @@ class Player(object):
         if self.has_music and music.get_busy():
             self.pos = self.Tell()
             music.stop()
+            self.clock.Stop(self.pos)
+            self.started = False
             self.state_change()
 
     def Stop(self):
         if self.has_music:
             self.pos = 0
             music.stop()
+            self.clock.Stop(0)
+            self.started = False
             self.state_change()
 
     def Play(self):
         if self.has_music and not music.get_busy():
-            music.play(0, self.pos / 1000.0)
+            self.pos = self.StartAt(self.pos)
+            self.clock.Start(self.pos)
+            self.Requeue()
+            self.started = True
             self.state_change()
 
     def GetVolume(self):
+        if self.mixer_format is None:
+            return 1.0
         return music.get_volume()
 
     def SetVolume(self, vol):
-        music.set_volume(vol)
+        if self.mixer_format is not None:
+            music.set_volume(vol)
 
     def GetPlaybackRate(self):
         return self.samplerate
@@ -67,8 +268,79 @@ class Player(object):
     def Seek(self, pos):
         if not self.has_music:
             return
-        self.pos = pos
         if music.get_busy():
             music.stop()
-            music.play(0, pos / 1000.0)
+            pos = self.StartAt(pos)
+            self.clock.Start(pos)
+            self.Requeue()
+        else:
+            self.clock.Stop(pos)
+        self.pos = pos
         self.state_change()
+
+    def StartAt(self, pos):
+        """Start playing the current file from a position in ms
+
+        Where the file has a seek index, playback starts from the frame
+        holding pos, by handing the mixer a file positioned at that
+        frame; the mixer's own seeking has to estimate where to go in
+        VBR files, and decodes its way there.
+
+        Returns:
+            int. The position playback actually started from.
+        """
+        self.mixer_pos = 0
+        index = self.SeekIndex() if pos > 0 else None
+        if index is not None:
+            offset, start = index.locate(pos)
+            if self.LoadStream(offset):
+                music.play(0)
+                return start
+        if self.streaming:
+            self.LoadMusic(self.filename)
+        music.play(0, pos / 1000.0)
+        return pos
+
+    def LoadMusic(self, filename):
+        music.load(filename)
+        self.CloseStream()
+
+    def LoadStream(self, offset):
+        """Load the current file from a byte offset into the mixer
+
+        Returns:
+            bool. False if the file can't be opened or the mixer can't
+            play from a file object, in which case the seek index isn't
+            tried again.
+        """
+        try:
+            stream = open(self.filename, 'rb')
+            stream.seek(offset)
+        except IOError:
+            self.seek_index = False
+            return False
+        try:
+            try:
+                # pygame 2 needs to be told the format of a file object
+                music.load(stream, 'mp3')
+            except TypeError:
+                music.load(stream)
+        except mixerError:
+            stream.close()
+            self.seek_index = False
+            return False
+        self.CloseStream()
+        self.stream = stream
+        self.streaming = True
+        return True
+
+    def CloseStream(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        self.streaming = False
+
+    def Requeue(self):
+        # starting playback clears the mixer's queue
+        if self.queued is not None:
+            music.queue(self.queued[0])
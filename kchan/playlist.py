@@ -0,0 +1,111 @@
+#! /usr/bin/python2
+
+import sqlite3
+import threading
+import collections
+
+import kchan.formats as formats
+
+# A song that's ready to play: its lyrics (None if it has none) and
+# its probe.AudioInfo (None if probing failed)
+Entry = collections.namedtuple('Entry', ['filepath', 'lyrics', 'info'])
+
+
+def loadLyrics(filepath, cache=None):
+    """Get the lyrics for a media file, in whichever format they're in
+
+    Kwargs:
+        cache (LyricsCache): cache of previously loaded lyrics to use
+
+    Returns:
+        Lyrics instance, or None if the file has no lyrics we can read.
+    """
+    if cache is not None:
+        try:
+            return cache.loadFile(filepath)[0]
+        except (IOError, OSError, sqlite3.Error):
+            pass
+    return formats.loadFile(filepath)[0]
+
+
+class Playlist(object):
+    """Queue of upcoming songs
+
+    The song at the head of the queue can be prefetched on a background
+    thread, so that it's ready to play by the time the current song ends.
+    """
+
+    def __init__(self, probe, lyricsCache=None):
+        """
+        Args:
+            probe (callable): called with a pathname in the background
+                thread, returning a pair (AudioInfo, cached) like
+                Player.Probe
+
+        Kwargs:
+            lyricsCache (LyricsCache): cache to load lyrics through
+        """
+        self.probe = probe
+        self.lyricsCache = lyricsCache
+        self.paths = collections.deque()
+        self.prefetched = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def Add(self, filepath):
+        self.paths.append(filepath)
+
+    def Clear(self):
+        self.paths.clear()
+        with self.lock:
+            self.prefetched = None
+
+    def Peek(self):
+        """Get the pathname of the next song, or None if the queue is empty"""
+        return self.paths[0] if self.paths else None
+
+    def Ready(self):
+        """Get the Entry for the next song if it's been prefetched, else None"""
+        with self.lock:
+            entry = self.prefetched
+        if entry is not None and entry.filepath == self.Peek():
+            return entry
+        return None
+
+    def Prefetch(self):
+        """Start loading the next song in the background, if necessary"""
+        filepath = self.Peek()
+        if (filepath is None or self.Ready() is not None
+            or (self.thread is not None and self.thread.is_alive())):
+            return
+        self.thread = threading.Thread(target=self.Fetch, args=(filepath,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Fetch(self, filepath):
+        try:
+            info = self.probe(filepath)[0]
+        except Exception:
+            info = None
+        entry = Entry(filepath, loadLyrics(filepath, self.lyricsCache), info)
+        with self.lock:
+            self.prefetched = entry
+
+    def Pop(self):
+        """Remove the next song from the queue
+
+        Returns:
+            Entry. The prefetched entry if there is one; otherwise the
+            song's lyrics are loaded now, and info is None.
+        """
+        entry = self.Ready()
+        filepath = self.paths.popleft()
+        if entry is None:
+            entry = Entry(filepath, loadLyrics(filepath, self.lyricsCache),
+                          None)
+        with self.lock:
+            self.prefetched = None
+        return entry
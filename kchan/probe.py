@@ -0,0 +1,90 @@
+#! /usr/bin/python2
+
+import os
+import sqlite3
+import threading
+import collections
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.karaokechan',
+                                  'probe.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS probes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    duration INTEGER NOT NULL,
+    samplerate INTEGER NOT NULL,
+    channels INTEGER NOT NULL
+)
+"""
+
+AudioInfo = collections.namedtuple('AudioInfo',
+                                   ['duration', 'samplerate', 'channels'])
+
+def probe(filepath):
+    """Find out the format of an audio file
+
+    Args:
+        filepath (str): pathname of an audio file
+
+    Returns:
+        AudioInfo. Tuple holding the duration of the audio in
+        milliseconds, its sample rate in Hz, and its number of channels.
+
+    Raises:
+        audioread.DecodeError: file can't be decoded
+        IOError: file can't be read
+    """
+    # audioread looks for a decoding backend when it's imported, which
+    # is slow, so put that off until something actually needs probing
+    import audioread
+    with audioread.audio_open(filepath) as f:
+        return AudioInfo(int(f.duration * 1000), f.samplerate, f.channels)
+
+
+class ProbeCache(object):
+    """Persistent cache of probe() results
+
+    Entries are keyed by pathname and are only used while the file's
+    size and modification time are unchanged. A cache may be shared
+    between threads.
+    """
+
+    def __init__(self, dbpath=DEFAULT_CACHE_PATH):
+        dbdir = os.path.dirname(dbpath)
+        if dbdir and not os.path.isdir(dbdir):
+            os.makedirs(dbdir)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(dbpath, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+    def probe(self, filepath):
+        """Like probe(), but using the cache if possible
+
+        Returns:
+            (AudioInfo, bool). The result, and whether it came from the
+            cache.
+        """
+        filepath = os.path.abspath(filepath)
+        st = os.stat(filepath)
+        with self.lock:
+            row = self.db.execute(
+                'SELECT size, mtime, duration, samplerate, channels '
+                'FROM probes WHERE path = ?', (filepath,)).fetchone()
+        if row is not None and tuple(row[:2]) == (st.st_size, st.st_mtime):
+            return (AudioInfo(*row[2:]), True)
+
+        info = probe(filepath)
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?)',
+                (filepath, st.st_size, st.st_mtime) + tuple(info))
+            self.db.commit()
+        return (info, False)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
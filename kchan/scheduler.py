@@ -0,0 +1,89 @@
+#! /usr/bin/python2
+
+from __future__ import division
+
+import kchan.perf as perf
+
+# Weight given to the latest measurement when averaging timer lateness
+LATENESS_WEIGHT = 0.1
+# Never aim more than this many ms early to make up for lateness
+MAX_LATENESS_CORRECTION = 20
+
+
+class Scheduler(object):
+    """Drives everything that follows the playback position from one timer
+
+    Each tick reads the player's clock once and passes the position to
+    every client. Clients return the position (in ms) at which they'll
+    next need updating, and the scheduler sleeps until the earliest of
+    these, waking up slightly early to make up for the typical lateness
+    of Tk timers.
+    """
+
+    def __init__(self, widget, player, before=None):
+        """
+        Args:
+            widget (tk.Widget): widget whose after() is used for timers
+            player (Player): player whose position is followed
+
+        Kwargs:
+            before (callable): called at the start of every tick, before
+                the clock is read; if it returns True, the tick is
+                abandoned (because it started another one).
+        """
+        self.widget = widget
+        self.player = player
+        self.before = before
+        self.clients = []
+        self.timer = None
+        # position the current timer is aiming for
+        self.target = None
+        # running average of how late timers fire, in ms
+        self.lateness = 0
+
+    def Add(self, client):
+        """Add a client
+
+        Args:
+            client (callable): called with the playback position in ms,
+                returns the position of the client's next update, or None
+                if it doesn't need any.
+        """
+        self.clients.append(client)
+
+    def Cancel(self):
+        if self.timer is not None:
+            self.widget.after_cancel(self.timer)
+            self.timer = None
+        self.target = None
+
+    def Wake(self):
+        """Update all clients now, e.g. after a change in player state"""
+        self.Cancel()
+        self.Tick()
+
+    @perf.timed('Scheduler.Tick')
+    def Tick(self):
+        self.timer = None
+        if self.before is not None and self.before():
+            return
+
+        now = self.player.Tell()
+        if self.target is not None and self.player.playing():
+            # the histograms only hold nonnegative times, so timers that
+            # fire early are counted separately
+            if now >= self.target:
+                perf.record('Scheduler.lateness', now - self.target)
+            else:
+                perf.record('Scheduler.earliness', self.target - now)
+            late = min(max(now - self.target, -MAX_LATENESS_CORRECTION),
+                       MAX_LATENESS_CORRECTION)
+            self.lateness += (late - self.lateness) * LATENESS_WEIGHT
+        self.target = None
+
+        targets = [t for t in (client(now) for client in self.clients)
+                   if t is not None and t > now]
+        if targets and self.player.playing():
+            self.target = min(targets)
+            delay = self.target - now - max(self.lateness, 0)
+            self.timer = self.widget.after(max(0, int(delay)), self.Tick)
@@ -0,0 +1,146 @@
+#! /usr/bin/python2
+# -*- coding: utf-8 -*-
+
+import re
+import unicodedata
+
+# Romanization of single hiragana characters (Hepburn, more or less)
+KANA = dict(zip(
+    u"あいうえおかきくけこがぎぐげごさしすせそざじずぜぞたちつてと"
+    u"だぢづでどなにぬねのはひふへほばびぶべぼぱぴぷぺぽまみむめも"
+    u"やゆよらりるれろわをんぁぃぅぇぉゃゅょゎゔ",
+    u"a i u e o ka ki ku ke ko ga gi gu ge go sa shi su se so za ji zu "
+    u"ze zo ta chi tsu te to da ji zu de do na ni nu ne no ha hi fu he ho "
+    u"ba bi bu be bo pa pi pu pe po ma mi mu me mo ya yu yo ra ri ru re "
+    u"ro wa o n a i u e o ya yu yo wa vu".split()))
+
+SMALL_Y = u"ゃゅょ"
+SMALL_TSU = u"っ"
+LONG_VOWEL = u"ー"
+
+KATAKANA_START = 0x30a1
+KATAKANA_END = 0x30f6
+KATAKANA_OFFSET = 0x60
+
+# Spelling differences between romanizations that are folded together
+ROMAJI_FOLDS = [(re.compile(r"([ou])u"), r"\1"),
+                (re.compile(r"oo"), "o"),
+                (re.compile(r"\bwo\b"), "o")]
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def romanize(text):
+    """Convert hiragana and katakana in a unicode string to romaji"""
+    out = []
+    double = False
+    for c in text:
+        code = ord(c)
+        if KATAKANA_START <= code <= KATAKANA_END:
+            c = unichr(code - KATAKANA_OFFSET)
+        if c == SMALL_TSU:
+            double = True
+            continue
+        if c == LONG_VOWEL:
+            continue
+        if c in SMALL_Y and out and out[-1].endswith('i') and len(out[-1]) > 1:
+            base = out[-1][:-1]
+            vowel = KANA[c][-1]
+            out[-1] = base + vowel if base[-1] in 'hj' else base + 'y' + vowel
+            continue
+        r = KANA.get(c)
+        if r is None:
+            out.append(c)
+        else:
+            out.append(r[0] + r if double and r[0] not in 'aiueon' else r)
+        double = False
+    return u''.join(out)
+
+
+def normalize(text):
+    """Split text into normalized search tokens
+
+    Full-width and half-width characters are folded to their usual
+    forms, kana are romanized, accents (including macrons) are
+    dropped, and common romanization differences such as "ou"/"o" are
+    folded, so that the same line written in kana or in different
+    romaji styles gives the same tokens.
+
+    Args:
+        text (str or unicode): text to normalize; str is taken to be UTF-8
+
+    Returns:
+        list. A list of unicode tokens.
+    """
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    text = romanize(unicodedata.normalize('NFKC', text))
+    text = u''.join(c for c in unicodedata.normalize('NFKD', text)
+                    if not unicodedata.combining(c)).lower()
+    for (pattern, repl) in ROMAJI_FOLDS:
+        text = pattern.sub(repl, text)
+    return TOKEN_RE.findall(text)
+
+
+def lines(lyrics):
+    """Split lyrics into lines, with the time each line starts
+
+    Args:
+        lyrics (Lyrics): lyrics to split
+
+    Returns:
+        list. A list of pairs (time, line), in the order the lines appear
+        in the lyrics; time is the first time, in hundredths of a second,
+        at which the phrase containing the start of the line is sung.
+        Blank lines are skipped.
+    """
+    phrases = lyrics.getPhrases()
+    starts = {}
+    for (time, idx) in lyrics.getTimes():
+        starts.setdefault(idx, time)
+
+    result = []
+    current = []
+    currentTime = None
+    for (idx, phrase) in enumerate(phrases):
+        parts = phrase.split('\n')
+        for (n, part) in enumerate(parts):
+            if n > 0:
+                line = ''.join(current).strip()
+                if line:
+                    result.append((currentTime, line))
+                current = []
+                currentTime = None
+            if currentTime is None and part.strip():
+                currentTime = starts.get(idx)
+            current.append(part)
+    line = ''.join(current).strip()
+    if line:
+        result.append((currentTime, line))
+    return result
+
+
+def matchQueries(query, prefix=True):
+    """Build FTS MATCH expressions for a search query
+
+    Args:
+        query (str or unicode): text the user is searching for
+
+    Kwargs:
+        prefix (bool): whether the last word of the query may be the
+            beginning of a longer word
+
+    Returns:
+        list. MATCH expressions for the lyrics index; a line matches the
+        query if it matches any of them. Empty if the query has no words.
+    """
+    tokens = normalize(query)
+    if not tokens:
+        return []
+    star = u'*' if prefix else u''
+    # Words in the line, in order (FTS4 can't restrict a phrase to one
+    # column, but the compact column is a single word so this only
+    # ever adds matches at the start of a line); and, for text written
+    # without spaces (e.g. kana), the start of the whole line
+    return [u'"{}{}"'.format(u' '.join(tokens), star),
+            u'compact:{}{}'.format(u''.join(tokens), star)]
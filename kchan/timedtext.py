@@ -1,8 +1,14 @@
 #! /usr/bin/python2
 
 import re
+import bisect
 from kchan.lyrics import Lyrics
+import kchan.perf as perf
 
+# Enhanced LRC word timestamp, <mm:ss> or <mm:ss.xx>
+WORD_RE = re.compile(r"<(\d\d):(\d\d)(?:\.(\d\d))?>")
+
+@perf.timed('timedtext.load')
 def load(lyricsData):
     """Parse text with timestamps into a Lyrics instance
 
@@ -14,40 +20,259 @@ def load(lyricsData):
         applying to the nonempty phrase that follows, so that the phrase is
         repeated at several different times in the song. If there's no initial
         timestamp, then the initial phrase is treated as having timestamp
-        [00:00.00].
+        [00:00.00]. Phrases may contain word timestamps of the form <mm:ss>
+        or <mm:ss.xx>, giving the time each word in the phrase is sung.
 
     Returns:
         Lyrics instance storing the phrases and timing from the provided lyrics,
         with no metadata
     """
-    lyrics = Lyrics()
+    return fromTerms(split(lyricsData))
 
-    terms = re.split(r"(\[\d\d:\d\d\]|\[\d\d:\d\d\.\d\d\])", lyricsData)
+def split(lyricsData):
+    """Split text with timestamps into alternating phrases and timestamps
 
-    if terms[0] != "":
-        lyrics.addPhrase(terms[0], [0])
+    Timestamps never span lines, so text can be split a piece at a time
+    and the results joined with joinTerms().
+
+    Args:
+        lyricsData (str): String containing text and timestamps, as for load()
+
+    Returns:
+        list. A list of strings, starting and ending with a (possibly
+        empty) phrase, with timestamps at the odd indices.
+    """
+    return re.split(r"(\[\d\d:\d\d\]|\[\d\d:\d\d\.\d\d\])", lyricsData)
+
+def joinTerms(terms, moreTerms):
+    """Append the terms for a following piece of text to a list of terms
+
+    Args:
+        terms (list): result of split() for some text; modified in place
+        moreTerms (list): result of split() for the text that follows it
+    """
+    terms[-1] += moreTerms[0]
+    terms.extend(moreTerms[1:])
 
-    timedphrases = zip(terms[1::2], terms[2::2]) # pairs of timestamp and phrase
+def splitWords(phrase, start):
+    """Remove word timestamps from a phrase
+
+    Args:
+        phrase (str): text of the phrase, possibly with word timestamps
+        start (int): time the phrase starts, in hundredths of a second
+
+    Returns:
+        (str, list). The phrase without its word timestamps, and its word
+        timing as returned by Lyrics.getWords(); word times are relative
+        to start.
+    """
+    phrase = phrase.replace('\r\n', '\n')
+    parts = WORD_RE.split(phrase)
+    if len(parts) == 1:
+        return (phrase, [])
+    text = [parts[0]]
+    offset = len(parts[0])
+    words = []
+    for i in range(1, len(parts), 4):
+        minutes, seconds, hundredths, p = parts[i:i+4]
+        time = int(minutes) * 6000 + int(seconds) * 100 + int(hundredths or 0)
+        words.append((offset, max(time - start, 0)))
+        text.append(p)
+        offset += len(p)
+    return (''.join(text), words)
+
+def timedPhrases(terms):
+    """Group the result of split() into phrases
+
+    A phrase is made up of the timestamps before it and its text; if
+    several timestamps appear consecutively, they all belong to the
+    phrase that follows.
+
+    Yields:
+        (int, str, list, list). The index in terms of the phrase's first
+        timestamp (0 for an initial phrase with none), and the phrase
+        text, times and word timing, as for Lyrics.fromPhrases().
+    """
+    if terms[0] != "":
+        phrase, words = splitWords(terms[0], 0)
+        yield (0, phrase, [0], words)
 
     times = []
-    for (t, p) in timedphrases:
-        m = re.match(r"\[(\d\d):(\d\d)\.?(\d\d)?\]", t)
+    for i in xrange(1, len(terms) - 1, 2):
+        if not times:
+            start = i
+        m = re.match(r"\[(\d\d):(\d\d)\.?(\d\d)?\]", terms[i])
         timeParts = m.groups('00')
         time = (int(timeParts[0]) * 6000
                 + int(timeParts[1]) * 100
                 + int(timeParts[2]))
         times.append(time)
 
+        p = terms[i + 1]
         if p != "":
-            lyrics.addPhrase(p, times)
+            phrase, words = splitWords(p, min(times))
+            yield (start, phrase, times, words)
             times = []
 
     if times != []:
-        lyrics.addPhrase("", times)
+        yield (start, "", times, [])
+
+@perf.timed('timedtext.fromTerms')
+def fromTerms(terms):
+    """Build a Lyrics instance from the result of split()"""
+    return Lyrics.fromPhrases((p, times, words)
+                              for (_, p, times, words) in timedPhrases(terms))
 
-    return lyrics
+class LineParser(object):
+    """Keeps the Lyrics for a text up to date as lines of it change
 
-def dump(lyrics, frac=False, crlf=False):
+    The text is split a line at a time, and the results kept joined
+    together. When lines change, only the terms from the last timestamp
+    before them to the first one after them are joined again, and only
+    the phrases those terms fall in are parsed and spliced into the
+    previous Lyrics (see Lyrics.splice()).
+
+    Lines are counted from 1.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget everything, so the next lyrics() parses the whole text"""
+        # result of split() for the whole text, the index in it of each
+        # phrase's first term, and the Lyrics
+        self.terms = None
+        self.phraseTerms = []
+        self.current = None
+        # number of terms each line adds to terms, which is two for each
+        # timestamp in it
+        self.counts = []
+        # (first, last) lines changed since the last lyrics() call
+        self.changed = None
+
+    def replaceLines(self, first, last, count):
+        """Record that lines first to last were replaced by count lines"""
+        if self.terms is None:
+            return
+        self.counts[first-1:last] = [0] * count
+        newLast = first + count - 1
+        if self.changed is None:
+            self.changed = (first, newLast)
+            return
+        changedFirst, changedLast = self.changed
+        if changedLast > last:
+            changedLast += count - (last - first + 1)
+        elif changedLast >= first:
+            changedLast = newLast
+        self.changed = (min(changedFirst, first), max(changedLast, newLast))
+
+    @perf.timed('LineParser.lyrics')
+    def lyrics(self, lineTerms, lineCount):
+        """Get the lyrics for the text as it is now
+
+        Args:
+            lineTerms (callable): given a line number, returns the result
+                of split() for that line, including its newline
+            lineCount (int): number of lines in the text
+
+        Returns:
+            Lyrics instance. It's only replaced, never modified, when
+            lines change.
+        """
+        if self.terms is None or len(self.counts) != lineCount:
+            self.parseAll(lineTerms, lineCount)
+        elif self.changed is not None:
+            self.parseChanged(lineTerms, lineCount)
+        return self.current
+
+    def parseAll(self, lineTerms, lineCount):
+        terms = None
+        self.counts = []
+        for n in xrange(1, lineCount + 1):
+            moreTerms = lineTerms(n)
+            self.counts.append(len(moreTerms) - 1)
+            if terms is None:
+                terms = list(moreTerms)
+            else:
+                joinTerms(terms, moreTerms)
+        phrases = list(timedPhrases(terms))
+        self.terms = terms
+        self.phraseTerms = [start for (start, _, _, _) in phrases]
+        self.current = Lyrics.fromPhrases((p, times, words)
+                                          for (_, p, times, words) in phrases)
+        self.changed = None
+
+    def parseChanged(self, lineTerms, lineCount):
+        first, last = self.changed
+        counts = self.counts
+        terms = self.terms
+
+        # the nearest lines on either side with timestamps in them; the
+        # terms before the last timestamp of the one before and after
+        # the first timestamp of the one after are unchanged
+        before = first - 1
+        while before > 0 and counts[before-1] == 0:
+            before -= 1
+        after = last + 1
+        while after <= lineCount and counts[after-1] == 0:
+            after += 1
+
+        newTerms = None
+        for n in xrange(max(before, 1), min(after, lineCount) + 1):
+            moreTerms = lineTerms(n)
+            if first <= n <= last:
+                counts[n-1] = len(moreTerms) - 1
+            if newTerms is None:
+                newTerms = list(moreTerms)
+            else:
+                joinTerms(newTerms, moreTerms)
+        if before > 0:
+            oldStart = sum(counts[:before]) - 1
+            newStart = counts[before-1] - 1
+        else:
+            oldStart = newStart = 0
+        if after <= lineCount:
+            oldEnd = len(terms) - sum(counts[after-1:])
+            newEnd = len(newTerms) - counts[after-1]
+        else:
+            oldEnd = len(terms)
+            newEnd = len(newTerms)
+
+        # widen that to whole phrases
+        phraseTerms = self.phraseTerms
+        startPhrase = max(bisect.bisect_right(phraseTerms, oldStart) - 1, 0)
+        endPhrase = bisect.bisect_right(phraseTerms, oldEnd)
+        start = phraseTerms[startPhrase] if startPhrase > 0 else 0
+        end = (phraseTerms[endPhrase] if endPhrase < len(phraseTerms)
+               else len(terms))
+        segment = (terms[start:oldStart] + newTerms[newStart:newEnd]
+                   + terms[oldEnd:end])
+
+        if start > 0:
+            # the segment starts with a timestamp
+            phrases = [(start + i - 1, p, times, words) for
+                       (i, p, times, words) in timedPhrases([""] + segment)]
+        else:
+            phrases = list(timedPhrases(segment))
+        shift = len(segment) - (end - start)
+        terms[start:end] = segment
+        following = phraseTerms[endPhrase:]
+        if shift:
+            following = [i + shift for i in following]
+        phraseTerms[startPhrase:] = [i for (i, _, _, _) in phrases] + following
+        self.current = self.current.splice(
+            startPhrase, endPhrase,
+            ((p, times, words) for (_, p, times, words) in phrases))
+        self.changed = None
+
+def formatTime(time, brackets="[]"):
+    """Format a time in hundredths of a second as a [mm:ss.xx] timestamp"""
+    return "{}{:02}:{:02}.{:02}{}".format(brackets[0], time / 6000,
+                                          (time / 100) % 60, time % 100,
+                                          brackets[1])
+
+def dump(lyrics, frac=False, crlf=False, words=False):
     """Dump timing data from a Lyrics instance into a string format
 
     Args:
@@ -59,14 +284,39 @@ def dump(lyrics, frac=False, crlf=False):
             they will just be [mm:ss] (rounded to the nearest second).
             Defaults to False.
         cr (bool): whether to use CRLF newlines. Defaults to False.
+        words (bool): whether to include word timestamps, of the form
+            <mm:ss.xx>. Defaults to False.
 
     Returns:
         str. A string containing phrases and timestamps.
     """
-    phrases = [[phrase.replace('\n', '\r\n') if crlf else phrase]
-               for phrase in lyrics.getPhrases()]
+    phrases = [[phrase] for phrase in lyrics.getPhrases()]
     times = lyrics.getTimes()
 
+    if words:
+        starts = {}
+        for (time, idx) in times:
+            starts.setdefault(idx, time)
+        for (idx, p) in enumerate(phrases):
+            wordTimes = lyrics.getWords(idx)
+            if not wordTimes:
+                continue
+            # the first occurrence of a repeated phrase carries its timing
+            phrase = p[0]
+            start = starts.get(idx, 0)
+            parts = []
+            last = 0
+            for (offset, delay) in wordTimes:
+                parts.append(phrase[last:offset])
+                parts.append(formatTime(start + delay, "<>"))
+                last = offset
+            parts.append(phrase[last:])
+            p[0] = ''.join(parts)
+
+    if crlf:
+        for p in phrases:
+            p[0] = p[0].replace('\n', '\r\n')
+
     for (time, idx) in times:
         minutes = time / 6000
         seconds = (time / 100) % 60
@@ -0,0 +1,249 @@
+#! /usr/bin/python2
+
+from __future__ import division
+
+import os
+import zlib
+import sqlite3
+import threading
+
+import kchan.onsets as onsets
+import kchan.perf as perf
+import kchan.formats.lyrics3v2 as lyrics3v2
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.karaokechan',
+                                  'waveforms.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS peaks (
+    path TEXT PRIMARY KEY,
+    length INTEGER NOT NULL,
+    checksum INTEGER NOT NULL,
+    data BLOB NOT NULL
+)
+"""
+
+# Bytes at each end of a file's audio that audioKey() checksums
+CHECKSUM_LENGTH = 1 << 16
+
+# Audio covered by each block of the finest level, in milliseconds
+BLOCK_LENGTH = 10
+# Number of blocks of each level combined into one block of the next
+LEVEL_FACTOR = 4
+# Levels are added until one has no more than this many blocks
+MIN_LEVEL_BLOCKS = 256
+
+
+def blockPeaks(filepath, cancelled=None):
+    """Find the lowest and highest sample in each block of an audio file
+
+    The audio is decoded a block at a time, so memory use only grows by
+    the peaks themselves.
+
+    Args:
+        filepath (str): pathname of an audio file
+
+    Kwargs:
+        cancelled (threading.Event): stop as soon as this is set
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray). The minimum and maximum sample of
+        each BLOCK_LENGTH ms of mono audio, as 16-bit integers.
+
+    Raises:
+        onsets.Cancelled: cancelled was set
+        audioread.DecodeError: file can't be decoded
+        IOError: file can't be read
+    """
+    # neither is needed until a song's waveform is first shown
+    import numpy
+    import audioread
+
+    mins = []
+    maxs = []
+    with audioread.audio_open(filepath) as f:
+        blockLength = f.samplerate * BLOCK_LENGTH // 1000
+        pending = numpy.zeros(0, numpy.float32)
+        for mono in onsets.monoBlocks(f, cancelled):
+            pending = numpy.concatenate((pending, mono))
+            count = len(pending) // blockLength
+            if count == 0:
+                continue
+            blocks = pending[:count * blockLength].reshape(count, blockLength)
+            mins.append(blocks.min(axis=1))
+            maxs.append(blocks.max(axis=1))
+            pending = pending[count * blockLength:]
+        if len(pending):
+            mins.append(pending.min(keepdims=True))
+            maxs.append(pending.max(keepdims=True))
+
+    if not mins:
+        return (numpy.zeros(0, numpy.int16), numpy.zeros(0, numpy.int16))
+    return (numpy.concatenate(mins).astype(numpy.int16),
+            numpy.concatenate(maxs).astype(numpy.int16))
+
+
+def audioKey(filepath):
+    """Identify the audio in a file, leaving out the tags at its end
+
+    Saving lyrics rewrites the Lyrics3 v2.00 and ID3v1 tags at the end
+    of an mp3 file, which changes its size and modification time but not
+    its audio.
+
+    Returns:
+        (int, int). The length of the file up to its end tags, and a
+        checksum of the first and last CHECKSUM_LENGTH bytes before them.
+
+    Raises:
+        IOError: file can't be read
+    """
+    trailer = lyrics3v2.SIZE_LENGTH + len(lyrics3v2.END_TAG)
+    with open(filepath, 'rb') as f:
+        f.seek(0, 2)
+        length = f.tell()
+        if length >= lyrics3v2.ID3_LENGTH:
+            f.seek(-lyrics3v2.ID3_LENGTH, 2)
+            if f.read(len(lyrics3v2.ID3_START)) == lyrics3v2.ID3_START:
+                length -= lyrics3v2.ID3_LENGTH
+        if length >= trailer:
+            f.seek(length - trailer)
+            size = f.read(lyrics3v2.SIZE_LENGTH)
+            if (f.read(len(lyrics3v2.END_TAG)) == lyrics3v2.END_TAG
+                    and size.isdigit()):
+                length = max(length - trailer - int(size), 0)
+
+        f.seek(0)
+        crc = zlib.crc32(f.read(min(length, CHECKSUM_LENGTH)))
+        f.seek(max(length - CHECKSUM_LENGTH, 0))
+        crc = zlib.crc32(f.read(min(length, CHECKSUM_LENGTH)), crc)
+    return (length, crc)
+
+
+def buildPyramid(mins, maxs):
+    """Build coarser levels of peaks on top of the result of blockPeaks()
+
+    Returns:
+        list. Pairs (mins, maxs) of arrays for each level, starting with
+        the ones given; each level has LEVEL_FACTOR times fewer blocks
+        than the one before, down to MIN_LEVEL_BLOCKS.
+    """
+    import numpy
+
+    levels = [(mins, maxs)]
+    while len(mins) > MIN_LEVEL_BLOCKS:
+        # pad the last block of the new level with copies of the last peak
+        padding = -len(mins) % LEVEL_FACTOR
+        mins = numpy.append(mins, mins[-1:].repeat(padding))
+        maxs = numpy.append(maxs, maxs[-1:].repeat(padding))
+        mins = mins.reshape(-1, LEVEL_FACTOR).min(axis=1)
+        maxs = maxs.reshape(-1, LEVEL_FACTOR).max(axis=1)
+        levels.append((mins, maxs))
+    return levels
+
+
+def duration(pyramid):
+    """Get the length of the audio a pyramid covers, in milliseconds"""
+    return len(pyramid[0][0]) * BLOCK_LENGTH
+
+
+def columns(pyramid, width):
+    """Get the peaks to draw in each column of a waveform display
+
+    Only the coarsest level with at least one block per column is read.
+
+    Args:
+        pyramid (list): result of buildPyramid()
+        width (int): number of columns
+
+    Returns:
+        (list, list). The lowest and highest point in each column, scaled
+        so the loudest peak of the song is at -1 or 1.
+    """
+    import numpy
+
+    level = 0
+    while (level + 1 < len(pyramid)
+           and len(pyramid[level + 1][0]) >= width):
+        level += 1
+    mins, maxs = pyramid[level]
+    if not len(mins) or width <= 0:
+        return ([], [])
+
+    # coarsest level's peaks are the song's peaks too
+    loudest = max(-int(pyramid[-1][0].min()), int(pyramid[-1][1].max()), 1)
+    edges = numpy.arange(width) * len(mins) // width
+    return ((numpy.minimum.reduceat(mins, edges) / loudest).tolist(),
+            (numpy.maximum.reduceat(maxs, edges) / loudest).tolist())
+
+
+def loadPyramid(filepath, cancelled=None, cache=None):
+    """Get the peak pyramid of an audio file
+
+    Args and exceptions are as for blockPeaks().
+
+    Kwargs:
+        cache (WaveformCache): cache of previously built pyramids to use
+
+    Returns:
+        list. The pyramid, as returned by buildPyramid().
+    """
+    if cache is not None:
+        try:
+            return cache.pyramid(filepath, cancelled)[0]
+        except sqlite3.Error:
+            pass
+    return buildPyramid(*blockPeaks(filepath, cancelled))
+
+
+class WaveformCache(object):
+    """Persistent cache of the peak pyramids of audio files
+
+    Entries are keyed by pathname and are only used while the file's
+    audioKey() is unchanged, so saving lyrics to a file doesn't mean
+    decoding it all over again. Only the finest level of each pyramid is
+    stored, since the others take next to no time to rebuild from it. A
+    cache may be shared between threads.
+    """
+
+    def __init__(self, dbpath=DEFAULT_CACHE_PATH):
+        dbdir = os.path.dirname(dbpath)
+        if dbdir and not os.path.isdir(dbdir):
+            os.makedirs(dbdir)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(dbpath, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+    @perf.timed('WaveformCache.pyramid')
+    def pyramid(self, filepath, cancelled=None):
+        """Like buildPyramid(*blockPeaks()), but using the cache if possible
+
+        Returns:
+            (list, bool). The pyramid, and whether it came from the cache.
+        """
+        import numpy
+
+        filepath = os.path.abspath(filepath)
+        key = audioKey(filepath)
+        with self.lock:
+            row = self.db.execute(
+                'SELECT length, checksum, data FROM peaks WHERE path = ?',
+                (filepath,)).fetchone()
+        if row is not None and tuple(row[:2]) == key:
+            peaks = numpy.frombuffer(str(row[2]), '<i2').astype(numpy.int16)
+            half = len(peaks) // 2
+            return (buildPyramid(peaks[:half], peaks[half:]), True)
+
+        mins, maxs = blockPeaks(filepath, cancelled)
+        data = numpy.concatenate((mins, maxs)).astype('<i2').tostring()
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO peaks VALUES (?, ?, ?, ?)',
+                (filepath,) + key + (sqlite3.Binary(data),))
+            self.db.commit()
+        return (buildPyramid(mins, maxs), False)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
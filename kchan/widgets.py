@@ -4,10 +4,26 @@
 from __future__ import division
 
 import re
+import os.path
+import bisect
+import threading
+import Queue
 
 import Tkinter as tk
+import ttk
+import tkFileDialog
 
 import kchan.timedtext as timedtext
+import kchan.library as library
+import kchan.waveform as waveform
+import kchan.perf as perf
+
+
+# Lyrics with more phrases than this are rendered a window at a time
+VIRTUAL_THRESHOLD = 2000
+# Number of phrases rendered on either side of the current one when
+# only a window of the lyrics is shown
+VIRTUAL_MARGIN = 200
 
 
 class LyricsCtrl(tk.Text):
@@ -16,19 +32,114 @@ class LyricsCtrl(tk.Text):
                          font=font)
         self.player = player
         self.lyrics = None
-        # parent is responsible for calling OnPlayer on player state change
-        self.phraseTimer = None
+        # parent is responsible for calling Update as playback advances
         self.font = font
         self.tag_config('all', justify='center', font=font)
+        # A single highlight tag is configured once and moved around
+        self.tag_config('highlight', foreground='blue')
+        self.highlighted = None
+        # Phrases with word timing are wiped progressively: the first
+        # `wiped` characters of the highlighted phrase are tagged as sung
+        self.tag_config('sung', foreground='red')
+        self.wiped = 0
+        # Very long lyrics only have the phrases from windowStart up to
+        # windowEnd in the widget; phraseLines and phraseCols, the
+        # position of each phrase boundary, cover just those phrases
+        self.virtual = False
+        self.windowStart = 0
+        self.windowEnd = 0
+        self.phraseLines = []
+        self.phraseCols = []
+        self.lastLine = 1
+        self.lineHeight = font.metrics('linespace')
+        self.lineCount = 0
+        self.bind('<Configure>', self.OnResize)
 
     def SetLyrics(self, lyrics):
         self.lyrics = lyrics
         self.phrases = lyrics.getPhrases()
         self.times = lyrics.getTimes()
+        self.virtual = len(self.phrases) > VIRTUAL_THRESHOLD
+        self.Render(0)
+
+    def Render(self, phrase):
+        """Fill the widget with the lyrics, or the window around phrase"""
+        if self.virtual:
+            self.windowStart = max(phrase - VIRTUAL_MARGIN, 0)
+            self.windowEnd = min(phrase + VIRTUAL_MARGIN + 1,
+                                 len(self.phrases))
+        else:
+            self.windowStart = 0
+            self.windowEnd = len(self.phrases)
         self.config(state=tk.NORMAL)
         self.delete('0.0', tk.END)
-        self.insert('0.0', ''.join(self.phrases), 'all')
+        self.insert('0.0',
+                    ''.join(self.phrases[self.windowStart:self.windowEnd]),
+                    'all')
+        self.config(state=tk.DISABLED)
+        self.highlighted = None
+        self.wiped = 0
+        self.IndexPhrases()
+
+    def InWindow(self, phrase):
+        """Check whether phrase can be centered without re-rendering"""
+        if not self.virtual:
+            return True
+        edge = VIRTUAL_MARGIN // 2
+        return ((self.windowStart == 0 or phrase - self.windowStart >= edge)
+                and (self.windowEnd == len(self.phrases)
+                     or self.windowEnd - phrase > edge))
+
+    def UpdateLyrics(self, lyrics):
+        """Show new lyrics, only redrawing the phrases that changed"""
+        if self.lyrics is None:
+            self.SetLyrics(lyrics)
+            return
+
+        old = self.phrases
+        new = lyrics.getPhrases()
+        if self.virtual or len(new) > VIRTUAL_THRESHOLD:
+            # Only a window is shown, so re-render it around the
+            # highlighted phrase if anything in it changed
+            current = self.highlighted or 0
+            self.lyrics = lyrics
+            self.phrases = new
+            self.times = lyrics.getTimes()
+            wasVirtual = self.virtual
+            self.virtual = len(new) > VIRTUAL_THRESHOLD
+            if (not wasVirtual or len(old) != len(new)
+                or list(old[self.windowStart:self.windowEnd])
+                    != list(new[self.windowStart:self.windowEnd])):
+                self.Render(min(current, max(len(new) - 1, 0)))
+            return
+
+        count = min(len(old), len(new))
+        prefix = 0
+        while prefix < count and old[prefix] == new[prefix]:
+            prefix += 1
+        suffix = 0
+        while (suffix < count - prefix
+               and old[len(old) - 1 - suffix] == new[len(new) - 1 - suffix]):
+            suffix += 1
+
+        self.lyrics = lyrics
+        self.phrases = new
+        self.times = lyrics.getTimes()
+        if prefix == len(old) == len(new):
+            # only the timing changed
+            return
+
+        start = self.PhraseIndex(prefix)
+        self.tag_remove('highlight', '0.0', tk.END)
+        self.tag_remove('sung', '0.0', tk.END)
+        self.highlighted = None
+        self.wiped = 0
+        self.config(state=tk.NORMAL)
+        self.delete(start, self.PhraseIndex(len(old) - suffix))
+        self.insert(start, ''.join(new[prefix:len(new) - suffix]), 'all')
         self.config(state=tk.DISABLED)
+        self.windowEnd = len(new)
+        self.ReindexPhrases(prefix, len(old) - suffix, len(new) - suffix)
 
     def ClearLyrics(self):
         self.lyrics = None
@@ -37,14 +148,97 @@ class LyricsCtrl(tk.Text):
         self.config(state=tk.NORMAL)
         self.delete('0.0', tk.END)
         self.config(state=tk.DISABLED)
-
-    def CenterPosition(self, pos):
-        boxHeight = self.winfo_height()
-        lineHeight = self.font.metrics('linespace')
-        lineCount = boxHeight // lineHeight
-
-        currentLine = int(self.index(pos).split('.')[0])
-        lastLine = int(self.index(tk.END + '-1c').split('.')[0])
+        self.highlighted = None
+        self.wiped = 0
+        self.virtual = False
+        self.windowStart = 0
+        self.windowEnd = 0
+        self.phraseLines = []
+        self.phraseCols = []
+        self.lastLine = 1
+
+    def PhraseIndex(self, i):
+        """Get the Tk index of boundary i of the phrases in the widget"""
+        return '{}.{}'.format(self.phraseLines[i], self.phraseCols[i])
+
+    def PhrasePositions(self, phrases, line, col):
+        """Find the line and column of each boundary of a run of phrases
+
+        Args:
+            phrases (sequence): the phrases
+            line (int): line the first phrase starts on
+            col (int): column the first phrase starts at
+
+        Returns:
+            (list, list). The lines and columns of the start of each
+            phrase and of the end of the last one.
+        """
+        lines = []
+        cols = []
+        for p in phrases:
+            lines.append(line)
+            cols.append(col)
+            newlines = p.count('\n')
+            if newlines:
+                line += newlines
+                col = len(p) - p.rfind('\n') - 1
+            else:
+                col += len(p)
+        lines.append(line)
+        cols.append(col)
+        return (lines, cols)
+
+    def IndexPhrases(self):
+        """Precompute the position of each phrase boundary
+
+        Only the phrases currently in the widget are indexed.
+        """
+        self.phraseLines, self.phraseCols = self.PhrasePositions(
+            self.phrases[self.windowStart:self.windowEnd], 1, 0)
+        self.lastLine = int(self.index(tk.END + '-1c').split('.')[0])
+
+    def ReindexPhrases(self, first, oldEnd, newEnd):
+        """Update the phrase boundaries after some phrases were replaced
+
+        Only the new phrases are indexed; the ones after them just move
+        by as many lines as were added, and those on the line the
+        replaced phrases ended on by as many columns too.
+
+        Args:
+            first (int): index of the first phrase replaced
+            oldEnd (int): index after the last phrase replaced
+            newEnd (int): index after the last phrase that replaced them
+        """
+        lines, cols = self.PhrasePositions(self.phrases[first:newEnd],
+                                           self.phraseLines[first],
+                                           self.phraseCols[first])
+        endLine = self.phraseLines[oldEnd]
+        lineShift = lines[-1] - endLine
+        colShift = cols[-1] - self.phraseCols[oldEnd]
+        tailLines = self.phraseLines[oldEnd + 1:]
+        tailCols = self.phraseCols[oldEnd + 1:]
+        if colShift:
+            i = 0
+            while i < len(tailLines) and tailLines[i] == endLine:
+                tailCols[i] += colShift
+                i += 1
+        if lineShift:
+            tailLines = [line + lineShift for line in tailLines]
+        self.phraseLines[first:] = lines + tailLines
+        self.phraseCols[first:] = cols + tailCols
+        self.lastLine += lineShift
+
+    def OnResize(self, evt=None):
+        if self.lineHeight:
+            self.lineCount = self.winfo_height() // self.lineHeight
+
+    @perf.timed('LyricsCtrl.CenterPosition')
+    def CenterPosition(self, pos, currentLine=None):
+        lineCount = self.lineCount
+
+        if currentLine is None:
+            currentLine = int(self.index(pos).split('.')[0])
+        lastLine = self.lastLine
 
         # As long as lineCount is nonzero, (lineCount - 1) / 2 and
         # lineCount / 2 must be two nonnegative numbers with sum
@@ -57,62 +251,204 @@ class LyricsCtrl(tk.Text):
         self.see('{}.0'.format(bottomLine))
         self.see(pos) # even if something weird happens, pos will be visible
 
-    def OnPhraseTimer(self):
+    @perf.timed('LyricsCtrl.Update')
+    def Update(self, now):
+        """Highlight the phrase being sung at time now (in ms)
+
+        Returns the time in ms at which the next phrase starts or the
+        wipe of the current one next advances, or None.
+        """
         if self.lyrics is None:
-            return
+            return None
+
+        phrase, startTime, endTime = self.lyrics.getCurrent(now / 10)
 
-        playTime = self.player.Tell() / 10
-        phrase, startTime, endTime = self.lyrics.getCurrent(playTime)
+        if phrase is not None and phrase != self.highlighted:
+            self.Highlight(phrase)
 
+        nextTime = endTime
         if phrase is not None:
-            phraseStart = sum(len(p) for p in self.phrases[:phrase])
-            phraseEnd = phraseStart + len(self.phrases[phrase])
-
-            # self.tag_add('reset', 0, tk.END, wx.TextAttr(wx.BLACK))
-            self.config(state=tk.NORMAL)
-            self.tag_delete('highlight')
-            self.tag_add('highlight',
-                         '0.0 + {} chars'.format(phraseStart),
-                         '0.0 + {} chars'.format(phraseEnd))
-            self.tag_config('highlight', foreground='blue')
-            self.config(state=tk.DISABLED)
-            self.CenterPosition('0.0 + {} chars'.format(phraseStart))
-
-        if endTime is not None:
-            if self.phraseTimer is not None:
-                self.after_cancel(self.phraseTimer)
-            self.phraseTimer = self.after(int((endTime - playTime) * 10),
-                                          self.OnPhraseTimer)
-
-    def OnPlayer(self):
-        if self.player.playing():
-            self.OnPhraseTimer()
+            chars, wipeTime = self.lyrics.getWipe(phrase, startTime, endTime,
+                                                  now / 10)
+            if chars is not None:
+                self.Wipe(chars)
+                if wipeTime is not None and (nextTime is None
+                                             or wipeTime < nextTime):
+                    nextTime = wipeTime
+
+        return nextTime * 10 if nextTime is not None else None
+
+    def Highlight(self, phrase):
+        if not self.InWindow(phrase):
+            self.Render(phrase)
+
+        offset = self.windowStart
+        if self.highlighted is not None:
+            i = self.highlighted - offset
+            self.tag_remove('highlight', self.PhraseIndex(i),
+                            self.PhraseIndex(i + 1))
+            if self.wiped:
+                self.tag_remove('sung', self.PhraseIndex(i),
+                                self.PhraseIndex(i + 1))
+        self.wiped = 0
+
+        i = phrase - offset
+        phraseStart = self.PhraseIndex(i)
+        phraseEnd = self.PhraseIndex(i + 1)
+
+        self.tag_add('highlight', phraseStart, phraseEnd)
+        self.highlighted = phrase
+        self.CenterPosition(phraseStart, self.phraseLines[i])
+
+    def Wipe(self, chars):
+        """Show the first chars characters of the current phrase as sung
+
+        Only the characters between the old and new extent of the wipe
+        are retagged.
+        """
+        if chars == self.wiped:
+            return
+        start = self.PhraseIndex(self.highlighted - self.windowStart)
+        lo, hi = sorted((self.wiped, chars))
+        if chars > self.wiped:
+            self.tag_add('sung', '{}+{}c'.format(start, lo),
+                         '{}+{}c'.format(start, hi))
         else:
-            if self.phraseTimer is not None:
-                self.after_cancel(self.phraseTimer)
+            # playback moved backwards within the phrase
+            self.tag_remove('sung', '{}+{}c'.format(start, lo),
+                            '{}+{}c'.format(start, hi))
+        self.wiped = chars
 
     def ChangeFont(self, font):
         self.font = font
         self.tag_config('all', font=font)
+        self.lineHeight = font.metrics('linespace')
+        self.OnResize()
+
+
+# Timestamps and timestamp placeholders in the lyrics editor
+SLOT_RE = re.compile(r'\[(\d\d:\d\d(.\d\d)?)?\]')
+
+# How far before and after the current time a timestamp can be snapped
+# to an onset, in milliseconds; timestamps are usually set a little late
+SNAP_BEFORE = 300
+SNAP_AFTER = 100
 
 
 class LyricsEditor(tk.Text):
-    def __init__(self, parent, player):
+    def __init__(self, parent, player, change_callback=None):
         tk.Text.__init__(self, parent, wrap=tk.WORD, undo=True)
         self.player = player
         self.bind('<Key-Return>', (lambda evt: self.OnEnter()))
         self.bind('<Key>', (lambda evt: self.edit_separator()))
 
+        # called after every change to the text
+        self.change_callback = change_callback
+        # For each line, a pair (terms, slots): the result of
+        # timedtext.split for the line (including its newline), and the
+        # (start, end) columns of its timestamps and placeholders; None
+        # for lines that have changed since they were last parsed
+        self.lineCache = []
+        # keeps the lyrics up to date as lines change, for GetLyrics
+        self.parser = timedtext.LineParser()
+        # times of the onsets found in the song, in hundredths of a
+        # second, and whether to snap timestamps to them
+        self.onsets = []
+        self.snap = True
+
+        # Route the widget's Tcl command through Dispatch, so we see
+        # every edit, including ones made by the Text class bindings
+        self.orig_cmd = self._w + '_orig'
+        self.tk.call('rename', self._w, self.orig_cmd)
+        self.tk.createcommand(self._w, self.Dispatch)
+
+    def Dispatch(self, cmd, *args):
+        if cmd in ('insert', 'delete', 'replace'):
+            return self.Edit(cmd, args)
+        if cmd == 'edit' and args and args[0] in ('undo', 'redo'):
+            # undo and redo don't go through the widget command, so we
+            # can't tell which lines they touch
+            self.lineCache = []
+            self.parser.reset()
+            result = self.tk.call((self.orig_cmd, cmd) + args)
+            if self.change_callback is not None:
+                self.change_callback()
+            return result
+        return self.tk.call((self.orig_cmd, cmd) + args)
+
+    def LineOf(self, index):
+        return int(self.tk.call(self.orig_cmd, 'index', index).split('.')[0])
+
+    def EditedLines(self, cmd, args):
+        """Get the first and last lines an edit can change"""
+        if cmd == 'insert':
+            lines = [self.LineOf(args[0])]
+        elif cmd == 'replace':
+            lines = [self.LineOf(args[0]), self.LineOf(args[1])]
+        else:
+            # any number of ranges, the last of which may be a single
+            # character
+            lines = [self.LineOf(index) for index in args]
+            if len(args) % 2:
+                lines.append(self.LineOf(args[-1] + '+1c'))
+        return (min(lines), max(lines))
+
+    def Edit(self, cmd, args):
+        lastLine = self.LineOf(tk.END + '-1c')
+        first, last = (min(line, lastLine)
+                       for line in self.EditedLines(cmd, args))
+
+        result = self.tk.call((self.orig_cmd, cmd) + args)
+
+        if len(self.lineCache) == lastLine:
+            count = last - first + 1 + self.LineOf(tk.END + '-1c') - lastLine
+            if count > 0:
+                self.lineCache[first-1:last] = [None] * count
+                self.parser.replaceLines(first, last, count)
+            else:
+                # the edit didn't do what we expected; start over
+                self.lineCache = []
+                self.parser.reset()
+        if self.change_callback is not None:
+            self.change_callback()
+        return result
+
     def LoadLyrics(self, lyrics):
+        self.LoadText(timedtext.dump(lyrics, frac=True, words=True)
+                      if lyrics is not None else '')
+
+    def LoadText(self, text):
         self.edit_separator()
         self.delete('0.0', tk.END)
-        if lyrics is not None:
-            self.insert('0.0', timedtext.dump(lyrics, frac=True))
+        self.insert('0.0', text)
         self.edit_reset()
         self.edit_modified(False)
 
+    def GetText(self):
+        return self.get('0.0', tk.END + '-1c')
+
+    def CheckLineCache(self):
+        lastLine = self.LineOf(tk.END + '-1c')
+        if len(self.lineCache) != lastLine:
+            self.lineCache = [None] * lastLine
+            self.parser.reset()
+
+    def ParseLine(self, n):
+        """Get the (terms, slots) pair for line n (counting from 1)"""
+        cached = self.lineCache[n - 1]
+        if cached is None:
+            line = self.get('{}.0'.format(n), '{}.0 lineend'.format(n)) + '\n'
+            cached = (timedtext.split(line.replace('[]', '')),
+                      [m.span() for m in SLOT_RE.finditer(line)])
+            self.lineCache[n - 1] = cached
+        return cached
+
     def GetLyrics(self):
-        return timedtext.load(self.get('0.0', tk.END).replace('[]', ''))
+        # Only lines that changed since the last call are re-read, and
+        # only the phrases on them re-parsed
+        self.CheckLineCache()
+        return self.parser.lyrics(lambda n: self.ParseLine(n)[0],
+                                  len(self.lineCache))
 
     def AddPlaceholder(self):
         self.edit_separator()
@@ -122,32 +458,100 @@ class LyricsEditor(tk.Text):
         if pos is None:
             pos = tk.INSERT
 
-        atPos = self.get(pos, tk.END)
-        match = re.search(r'\[(\d\d:\d\d(.\d\d)?)?\]', atPos)
-        if not match:
-            return None
-        return ('{} + {} chars'.format(pos, match.start()),
-                '{} + {} chars'.format(pos, match.end()))
+        self.CheckLineCache()
+        line, col = (int(x) for x in self.index(pos).split('.'))
+        for n in xrange(line, len(self.lineCache) + 1):
+            for (start, end) in self.ParseLine(n)[1]:
+                if n > line or start >= col:
+                    return ('{}.{}'.format(n, start), '{}.{}'.format(n, end))
+        return None
+
+    def PreviousTime(self, pos):
+        """Get the time of the last timestamp before pos
+
+        Returns:
+            int. The time in hundredths of a second, or None if there's
+            no timestamp before pos.
+        """
+        self.CheckLineCache()
+        line, col = (int(x) for x in self.index(pos).split('.'))
+        for n in xrange(line, 0, -1):
+            for (start, end) in reversed(self.ParseLine(n)[1]):
+                if n == line and end > col:
+                    continue
+                m = SLOT_RE.match(self.get('{}.{}'.format(n, start),
+                                           '{}.{}'.format(n, end)))
+                if m.group(1) is not None:
+                    minutes, seconds = m.group(1).split(':')
+                    return (int(minutes) * 6000 + int(seconds[:2]) * 100
+                            + int(seconds[3:] or 0))
+        return None
+
+    def FillTimestamp(self, slot, time):
+        """Replace a timestamp or placeholder, and move to the next one
+
+        Args:
+            slot (tuple): (start, end) indices of the timestamp
+            time (int): new time, in milliseconds
+        """
+        self.mark_set('ts_end', slot[1])
+        self.delete(slot[0], slot[1])
+        self.insert(slot[0],
+                    '[{:02}:{:02}.{:02}]'.format(int(time / 60000),
+                                                 int(time / 1000) % 60,
+                                                 int(time / 10) % 100))
+
+        nextTimestamp = self.FindNextTimestamp('ts_end')
+        if nextTimestamp:
+            self.mark_set(tk.INSERT, nextTimestamp[0])
+
+    def SetOnsets(self, onsets):
+        """Set the onsets timestamps can be snapped to
+
+        Args:
+            onsets (list): times in hundredths of a second, in order, as
+                found by kchan.onsets.detect()
+        """
+        self.onsets = onsets
+
+    def SnapTime(self, time):
+        """Move a time in milliseconds to the closest onset near it, if any"""
+        if not self.snap:
+            return time
+        lo = bisect.bisect_left(self.onsets, (time - SNAP_BEFORE) / 10)
+        hi = bisect.bisect_right(self.onsets, (time + SNAP_AFTER) / 10)
+        if lo == hi:
+            return time
+        return 10 * min(self.onsets[lo:hi],
+                        key=lambda onset: abs(onset * 10 - time))
 
     def SetTimestamp(self):
+        # Get the time first, so the work below doesn't delay it
+        playTime = self.player.Tell()
         self.focus_set()
 
         nextTimestamp = self.FindNextTimestamp()
         if not nextTimestamp:
             return False
 
-        playTime = self.player.Tell()
-        self.mark_set('ts_end', nextTimestamp[1])
-        self.delete(nextTimestamp[0], nextTimestamp[1])
-        self.insert(nextTimestamp[0],
-                    '[{:02}:{:02}.{:02}]'.format(int(playTime / 60000),
-                                                 int(playTime / 1000) % 60,
-                                                 int(playTime / 10) % 100))
+        self.FillTimestamp(nextTimestamp, self.SnapTime(playTime))
+        return True
 
-        nextTimestamp = self.FindNextTimestamp('ts_end')
-        if nextTimestamp:
-            self.mark_set(tk.INSERT, nextTimestamp[0])
+    def SuggestTimestamp(self):
+        """Set the next timestamp to the first onset after the one before it"""
+        self.focus_set()
+
+        nextTimestamp = self.FindNextTimestamp()
+        if not nextTimestamp:
+            return False
+
+        previous = self.PreviousTime(nextTimestamp[0])
+        i = (bisect.bisect_right(self.onsets, previous)
+             if previous is not None else 0)
+        if i == len(self.onsets):
+            return False
 
+        self.FillTimestamp(nextTimestamp, self.onsets[i] * 10)
         return True
 
     def OnEnter(self):
@@ -157,3 +561,280 @@ class LyricsEditor(tk.Text):
 
     def DiscardEdits(self):
         self.edit_modified(False)
+
+
+class LibraryBrowser(tk.Toplevel):
+    # milliseconds between checks on a background scan
+    SCAN_POLL_INTERVAL = 200
+    # files examined at once by a scan; it runs on threads, since Tk's
+    # process mustn't fork
+    SCAN_THREADS = 4
+
+    def __init__(self, parent, dbpath, open_callback, queue_callback=None):
+        tk.Toplevel.__init__(self, parent)
+        self.title('Library - Karaoke-chan')
+        self.dbpath = dbpath
+        self.open_callback = open_callback
+        self.queue_callback = queue_callback
+        self.library = library.Library(dbpath)
+        self.scanThread = None
+        self.scanQueue = Queue.Queue()
+        self.scanTimer = None
+        # (path, time) for each row of the search results
+        self.resultItems = {}
+
+        searchFrame = tk.Frame(self)
+        tk.Label(searchFrame, text='Search lyrics:').pack(side=tk.LEFT)
+        self.searchVar = tk.StringVar()
+        searchEntry = tk.Entry(searchFrame, textvariable=self.searchVar)
+        searchEntry.pack(fill=tk.X, expand=1)
+        searchEntry.bind('<KeyRelease>', lambda evt: self.OnSearch())
+        searchFrame.pack(side=tk.TOP, fill=tk.X)
+
+        listFrame = tk.Frame(self)
+        columns = ('title', 'artist', 'album', 'length')
+        self.tree = ttk.Treeview(listFrame, columns=columns, show='headings')
+        for column in columns:
+            self.tree.heading(column, text=column.capitalize())
+        self.tree.column('length', width=60, stretch=False, anchor=tk.E)
+        self.tree.bind('<Double-1>', lambda evt: self.OnOpen())
+        self.tree.bind('<Return>', lambda evt: self.OnOpen())
+
+        columns = ('title', 'line', 'time')
+        self.results = ttk.Treeview(listFrame, columns=columns,
+                                    show='headings')
+        for column in columns:
+            self.results.heading(column, text=column.capitalize())
+        self.results.column('time', width=60, stretch=False, anchor=tk.E)
+        self.results.bind('<Double-1>', lambda evt: self.OnOpenResult())
+        self.results.bind('<Return>', lambda evt: self.OnOpenResult())
+
+        self.scrollbar = tk.Scrollbar(listFrame)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.ShowList(self.tree)
+
+        controlFrame = tk.Frame(self)
+        tk.Button(controlFrame, command=self.OnAddFolder,
+                  text='Add Folder...').pack(side=tk.LEFT)
+        self.rescanButton = tk.Button(controlFrame, command=self.Rescan,
+                                      text='Rescan')
+        self.rescanButton.pack(side=tk.LEFT)
+        if queue_callback is not None:
+            tk.Button(controlFrame, command=self.OnQueue,
+                      text='Add to Queue').pack(side=tk.LEFT)
+        self.statusLabel = tk.Label(controlFrame, text='')
+        self.statusLabel.pack(side=tk.RIGHT)
+        controlFrame.pack(side=tk.BOTTOM, fill=tk.X)
+        listFrame.pack(fill=tk.BOTH, expand=1)
+
+        self.protocol('WM_DELETE_WINDOW', self.OnClose)
+        self.Refresh()
+
+    def Refresh(self):
+        self.tree.delete(*self.tree.get_children())
+        for song in self.library.songs():
+            length = song['duration']
+            self.tree.insert('', tk.END, iid=song['path'], values=(
+                song['title'] or os.path.basename(song['path']),
+                song['artist'] or '', song['album'] or '',
+                '{}:{:02}'.format(length // 60000, (length // 1000) % 60)
+                if length is not None else ''))
+        self.statusLabel.config(
+            text='{} songs'.format(len(self.tree.get_children())))
+
+    def OnOpen(self):
+        selection = self.tree.selection()
+        if selection:
+            self.open_callback(selection[0])
+
+    def OnQueue(self):
+        if self.shown is self.tree:
+            for iid in self.tree.selection():
+                self.queue_callback(iid)
+        else:
+            for iid in self.results.selection():
+                self.queue_callback(self.resultItems[iid][0])
+
+    def ShowList(self, tree):
+        for other in (self.tree, self.results):
+            if other is not tree:
+                other.pack_forget()
+        tree.pack(fill=tk.BOTH, expand=1)
+        self.shown = tree
+        tree.config(yscrollcommand=self.scrollbar.set)
+        self.scrollbar.config(command=tree.yview)
+
+    def OnSearch(self):
+        query = self.searchVar.get()
+        if not query.strip():
+            self.ShowList(self.tree)
+            return
+
+        self.results.delete(*self.results.get_children())
+        self.resultItems = {}
+        for result in self.library.search(query):
+            time = result.time
+            iid = self.results.insert('', tk.END, values=(
+                result.title or os.path.basename(result.path), result.line,
+                '{}:{:02}'.format(time // 6000, (time // 100) % 60)
+                if time is not None else ''))
+            self.resultItems[iid] = (result.path, time)
+        self.ShowList(self.results)
+
+    def OnOpenResult(self):
+        selection = self.results.selection()
+        if selection:
+            self.open_callback(*self.resultItems[selection[0]])
+
+    def OnAddFolder(self):
+        path = tkFileDialog.askdirectory(parent=self)
+        if path:
+            self.library.addRoot(path)
+            self.Rescan()
+
+    def Rescan(self):
+        if self.scanThread is not None:
+            return
+        self.rescanButton.config(state=tk.DISABLED)
+        self.statusLabel.config(text='Scanning...')
+        self.scanThread = threading.Thread(target=self.Scan)
+        self.scanThread.daemon = True
+        self.scanThread.start()
+        self.scanTimer = self.after(self.SCAN_POLL_INTERVAL, self.PollScan)
+
+    def Scan(self):
+        # sqlite connections can't be shared between threads
+        scanLibrary = library.Library(self.dbpath)
+        try:
+            self.scanQueue.put(scanLibrary.scan(threads=self.SCAN_THREADS))
+        except Exception as e:
+            self.scanQueue.put(e)
+        finally:
+            scanLibrary.close()
+
+    def PollScan(self):
+        self.scanTimer = None
+        if not self.winfo_exists():
+            return
+        try:
+            result = self.scanQueue.get_nowait()
+        except Queue.Empty:
+            self.scanTimer = self.after(self.SCAN_POLL_INTERVAL,
+                                        self.PollScan)
+            return
+        self.scanThread = None
+        self.rescanButton.config(state=tk.NORMAL)
+        self.Refresh()
+        if isinstance(result, Exception):
+            self.statusLabel.config(text='Scan failed: {}'.format(result))
+
+    def OnClose(self):
+        if self.scanTimer is not None:
+            self.after_cancel(self.scanTimer)
+            self.scanTimer = None
+        self.library.close()
+        self.destroy()
+
+
+class WaveformCtrl(tk.Canvas):
+    """Overview of a song's waveform, with the start of each phrase marked"""
+
+    HEIGHT = 32
+
+    def __init__(self, parent):
+        tk.Canvas.__init__(self, parent, height=self.HEIGHT,
+                           highlightthickness=0, background='white')
+        # result of waveform.buildPyramid() for the song, and the start
+        # time of each phrase in hundredths of a second
+        self.pyramid = None
+        self.times = []
+        self.bind('<Configure>', lambda evt: self.Redraw())
+
+    def SetPyramid(self, pyramid):
+        self.pyramid = pyramid
+        self.Redraw()
+
+    def SetLyrics(self, lyrics):
+        self.times = (sorted(set(time for (time, idx) in lyrics.getTimes()))
+                      if lyrics is not None else [])
+        self.DrawPhrases()
+
+    def Clear(self):
+        self.pyramid = None
+        self.times = []
+        self.delete(tk.ALL)
+
+    def Redraw(self):
+        self.delete('wave')
+        if self.pyramid is not None:
+            mins, maxs = waveform.columns(self.pyramid, self.winfo_width())
+            middle = self.winfo_height() / 2
+            # a single polygon, along the tops of the columns and back
+            # along their bottoms
+            points = []
+            for (x, peak) in enumerate(maxs):
+                points.extend((x, middle - peak * middle))
+            for x in xrange(len(mins) - 1, -1, -1):
+                points.extend((x, middle - mins[x] * middle))
+            if points:
+                self.create_polygon(points, fill='gray60', outline='',
+                                    tags='wave')
+        self.DrawPhrases()
+
+    def DrawPhrases(self):
+        self.delete('phrase')
+        if self.pyramid is None or not waveform.duration(self.pyramid):
+            return
+        width = self.winfo_width()
+        height = self.winfo_height()
+        # times are in hundredths of a second, durations in milliseconds
+        scale = width * 10 / waveform.duration(self.pyramid)
+        for x in sorted(set(int(time * scale) for time in self.times)):
+            self.create_line(x, 0, x, height, fill='blue', tags='phrase')
+
+
+class PerfOverlay(tk.Label):
+    """Live summary of the performance measurements, shown over a widget
+
+    Showing the overlay turns instrumentation on, and hiding it turns
+    instrumentation off again unless it was already on.
+    """
+
+    # Milliseconds between refreshes of the summary
+    REFRESH_INTERVAL = 500
+
+    def __init__(self, parent):
+        tk.Label.__init__(self, parent, justify=tk.LEFT, anchor=tk.NW,
+                          font=('Courier', 9), background='lightyellow',
+                          relief=tk.SOLID, borderwidth=1)
+        self.timer = None
+        self.wasEnabled = perf.enabled
+
+    def Shown(self):
+        return self.timer is not None
+
+    def Show(self):
+        if self.Shown():
+            return
+        self.wasEnabled = perf.enabled
+        perf.enable()
+        self.place(relx=1, x=-4, y=4, anchor=tk.NE)
+        self.Refresh()
+
+    def Hide(self):
+        if not self.Shown():
+            return
+        self.after_cancel(self.timer)
+        self.timer = None
+        self.place_forget()
+        perf.enable(self.wasEnabled)
+
+    def Toggle(self):
+        if self.Shown():
+            self.Hide()
+        else:
+            self.Show()
+
+    def Refresh(self):
+        self.config(text=perf.report())
+        self.timer = self.after(self.REFRESH_INTERVAL, self.Refresh)
@@ -0,0 +1,167 @@
+#! /usr/bin/python2
+
+import os
+import sqlite3
+import threading
+import Queue
+
+import kchan.formats.lyrics3v2 as lyrics3v2
+import kchan.library as library
+
+# Suffix of the file editor drafts are autosaved to, next to the media file
+DRAFT_SUFFIX = ".kcdraft"
+
+TAG = "tag"
+DRAFT = "draft"
+
+
+def draftPath(filepath):
+    """Get the pathname of the autosaved editor draft for a media file"""
+    return filepath + DRAFT_SUFFIX
+
+
+def loadDraft(filepath):
+    """Get the autosaved editor draft for a media file
+
+    Args:
+        filepath (str): pathname of the media file
+
+    Returns:
+        str. The editor text that was autosaved, or None if there's no draft.
+    """
+    try:
+        with open(draftPath(filepath), 'rb') as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def discardDraft(filepath):
+    """Delete the autosaved editor draft for a media file, if any"""
+    try:
+        os.remove(draftPath(filepath))
+    except OSError:
+        pass
+
+
+def saveDraft(filepath, text):
+    """Atomically replace the autosaved editor draft for a media file"""
+    path = draftPath(filepath)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(text)
+    os.rename(path + '.tmp', path)
+
+
+class Writer(object):
+    """Writes lyrics and editor drafts to disk on a background thread
+
+    Jobs are carried out in the order they're submitted. Results are
+    collected by calling Results() from the UI thread, since Tk must
+    only be used from the thread running its mainloop.
+
+    If a library database is given, songs in the library have their
+    entries (including the lyrics search index) refreshed after their
+    lyrics are saved; likewise, if a LyricsCache is given, saved songs'
+    cached lyrics are dropped.
+    """
+
+    def __init__(self, dbpath=None, lyricsCache=None):
+        self.dbpath = dbpath
+        self.lyricsCache = lyricsCache
+        self.jobs = Queue.Queue()
+        self.results = Queue.Queue()
+        self.thread = threading.Thread(target=self.Run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def SaveLyrics(self, filepath, lyricsData):
+        """Queue Lyrics3 v2.00 data to be written to a media file
+
+        The autosaved draft for the file is discarded once the data has
+        been written.
+        """
+        self.jobs.put((TAG, filepath, lyricsData))
+
+    def SaveDraft(self, filepath, text):
+        """Queue editor text to be autosaved as a draft for a media file"""
+        self.jobs.put((DRAFT, filepath, text))
+
+    def Run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+
+            kind, filepath, data = job
+            try:
+                if kind == TAG:
+                    changed = lyrics3v2.write(filepath, data)
+                    discardDraft(filepath)
+                    if changed:
+                        self.InvalidateCache(filepath)
+                        self.RefreshLibrary(filepath)
+                else:
+                    saveDraft(filepath, data)
+                    changed = True
+                self.results.put((kind, filepath, changed, None))
+            except Exception as e:
+                # anything else would kill the thread, leaving Wait()
+                # and Close() blocked forever
+                self.results.put((kind, filepath, False, e))
+            finally:
+                self.jobs.task_done()
+
+    def InvalidateCache(self, filepath):
+        if self.lyricsCache is None:
+            return
+        try:
+            self.lyricsCache.invalidate(filepath)
+        except sqlite3.Error:
+            # the file's checksum will have changed anyway
+            pass
+
+    def RefreshLibrary(self, filepath):
+        if self.dbpath is None or not os.path.exists(self.dbpath):
+            return
+        # Only called from the background thread, which is the only
+        # thread allowed to use this connection
+        try:
+            lib = library.Library(self.dbpath)
+            try:
+                lib.refresh(os.path.abspath(filepath))
+            finally:
+                lib.close()
+        except sqlite3.Error:
+            # The save itself worked; the library will catch up on its
+            # next scan
+            pass
+
+    def Results(self):
+        """Get the results of all jobs finished since the last call
+
+        Returns:
+            list. A list of tuples (kind, filepath, changed, error)::
+                kind (str): TAG or DRAFT
+                filepath (str): pathname of the media file
+                changed (bool): whether anything on disk was modified
+                error (Exception): error raised by the job, or None
+        """
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except Queue.Empty:
+                return results
+
+    def Busy(self):
+        return self.jobs.unfinished_tasks > 0
+
+    def Wait(self):
+        """Block until all queued jobs have finished"""
+        self.jobs.join()
+
+    def Close(self):
+        """Finish all queued jobs and stop the background thread"""
+        self.jobs.put(None)
+        self.thread.join()